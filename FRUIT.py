@@ -10,10 +10,11 @@ import random       # random thumbnail generation
 import datetime     # str conversion and timeDelta
 import os           # file IO
 import json         # CONFIG handling
+import requests     # FMS errors
 
 # my functions, see python scripts in TOOLS
 from TOOLS.CredentialsPopUp import CredDialog
-from TOOLS.FMS import getMatchesFromFMS
+from TOOLS.FMS import getFMSClient
 from TOOLS.FMS import rewrapMatches
 from TOOLS.YouTube import authenticate_youtube
 from TOOLS.thumbnails import generateThumbnail
@@ -23,15 +24,26 @@ from TOOLS.Twitch import covertID2Username
 # processes to run on queued threads
 import threading
 from TOOLS.process_queue import watch
+from TOOLS.process_queue import capture
+from TOOLS.process_queue import publish
+from TOOLS.process_queue import resume
+from TOOLS.process_queue import bump
 from TOOLS.process_queue import process_queue_seek
-from TOOLS.process_queue import process_queue_build_live
-from TOOLS.process_queue import process_queue_build_static
+from TOOLS.process_queue import addPipeline
+from TOOLS.process_queue import pipelines
+from TOOLS.process_queue import eventMatches
+from TOOLS.process_queue import process_queue_source_live
+from TOOLS.process_queue import process_queue_source_static
+from TOOLS.process_queue import process_queue_build_pool
+from TOOLS.process_queue import startBuildPool
+from TOOLS.process_queue import process_queue_build_batch
 from TOOLS.process_queue import process_queue_send
+from TOOLS.process_queue import process_queue_metadata
+from TOOLS.process_queue import quotaLedger
+from TOOLS.process_queue import defaultBuild
 
 # create directories/files if missing
 os.makedirs('log/', exist_ok=True)
-open('log/seek.txt', 'a+').close()
-open('log/send.txt', 'a+').close()
 os.makedirs('output/', exist_ok=True)
 os.makedirs('output/thumbnails', exist_ok=True)
 
@@ -46,6 +58,9 @@ class MainWindow(QWidget):
         self.videoFilepath = None
         self.twitchUserID = None
         self.YouTube = None
+        self.matches = None
+        self.CONFIG = None
+        self.extraCONFIGs = []
         self.stop_event = threading.Event()
 
         '''
@@ -116,6 +131,14 @@ class MainWindow(QWidget):
         # Playlist
         self.video_playlist = QLineEdit("https://www.youtube.com/playlist?list=")
         layout.addRow('Playlist URL (optional):', self.video_playlist)
+        # Upload chunk size
+        self.video_chunkMegabytes = QLineEdit('8')
+        layout.addRow('Upload Chunk [MB]:', self.video_chunkMegabytes)
+        # Concurrent uploads & daily quota
+        self.video_workers = QLineEdit('2')
+        layout.addRow('Upload Workers:', self.video_workers)
+        self.video_dailyQuota = QLineEdit('10000')
+        layout.addRow('Daily Quota [units]:', self.video_dailyQuota)
         # Description
         self.video_description = QPlainTextEdit("Footage of this event is courtesy of FIRST Indiana Robotics.\n\nFollow us on Twitter (@FIRSTINRobotics), Facebook (FIRST Indiana Robotics), and Twitch (FIRSTINRobotics).\n\nFor more information and future event schedules, visit our website: https://www.firstindianarobotics.org")
         layout.addRow('Description:', self.video_description)
@@ -193,10 +216,44 @@ class MainWindow(QWidget):
         self.twitch_button.clicked.connect(self.test_twitch)
         layout.addRow(self.twitch_button)
         self.twitchDelay = QLineEdit('2.5'); layout.addRow('Stream Delay [sec]:', self.twitchDelay)
+        # record the stream locally so matches are cut seconds after the score is posted, not after the VOD catches up
+        self.twitch_capture = QCheckBox('Record stream locally (no VOD downloads)')
+        layout.addRow(self.twitch_capture)
+        self.twitch_captureSize = QLineEdit('4096'); layout.addRow('Recording Buffer [MB]:', self.twitch_captureSize)
         layout.addRow(QLabel('⸻ or ⸻'))
         self.mp4_VOD = QPushButton('Select File')
         self.mp4_VOD.clicked.connect(self.getFileVideo)
         layout.addRow('Video File:', self.mp4_VOD)
+        # cut engine (moviepy re-encodes everything, copy only re-encodes around the cuts)
+        self.build_engine = QComboBox(); self.build_engine.addItems(["moviepy", "copy"])
+        layout.addRow('Cut Engine:', self.build_engine)
+        # build worker processes, recycled after a number of matches to cap memory growth
+        self.build_workers = QLineEdit(str(max(1, (os.cpu_count() or 2)//2))); layout.addRow('Build Workers:', self.build_workers)
+        self.build_recycle = QLineEdit('10'); layout.addRow('Recycle Worker After [matches]:', self.build_recycle)
+        # encode processes per match, splits a match into chunks encoded side by side (lower latency per match)
+        self.build_encodeWorkers = QLineEdit('1'); layout.addRow('Encode Processes per Match:', self.build_encodeWorkers)
+        # encode profile, can be changed while running (auto drops to realtime while the build queue is backed up)
+        self.build_profile = QComboBox(); self.build_profile.addItems(["balanced", "realtime", "archive", "auto"])
+        self.build_profile.currentTextChanged.connect(self.changeProfile)
+        layout.addRow('Encode Profile:', self.build_profile)
+        self.build_autoQueueDepth = QLineEdit('3'); layout.addRow('Auto Profile Queue Depth:', self.build_autoQueueDepth)
+        # pick the bitrate from the measured upload speed so each upload takes at most this long (0 = off)
+        #   re-encoding engines only, the copy engine keeps the source bitrate
+        self.build_uploadBudget = QLineEdit('240'); layout.addRow('Upload Budget per Match [sec] (not with copy):', self.build_uploadBudget)
+        self.build_engine.currentTextChanged.connect(lambda engine: self.build_uploadBudget.setEnabled(engine != 'copy'))
+        self.build_uploadBudget.setEnabled(self.build_engine.currentText() != 'copy')
+        self.build_deadline = QLineEdit('900'); layout.addRow('Deadline after Post [sec]:', self.build_deadline)
+        self.build_sendBacklog = QLineEdit('10'); layout.addRow('Hold Builds at Videos Unsent:', self.build_sendBacklog)
+        self.build_buildBacklog = QLineEdit('50'); layout.addRow('Hold Seek at Matches Unbuilt:', self.build_buildBacklog)
+        self.build_minFree = QLineEdit('2048'); layout.addRow('Hold Builds below Free Disk [MB]:', self.build_minFree)
+        # downloaded Twitch segments are kept for overlapping matches and retries
+        self.build_cache = QLineEdit('2048'); layout.addRow('Segment Cache [MB]:', self.build_cache)
+        # live only: build the match segment during the score reveal wait, then add the score
+        self.build_early = QCheckBox('Start building before the score is posted')
+        layout.addRow(self.build_early)
+        # read the whole file once instead of seeking for every match (finished events only)
+        self.build_batch = QCheckBox('Single-pass batch render')
+        layout.addRow(self.build_batch)
         # reference match details
         self.match_type = QComboBox(); self.match_type.addItems(["Q = Quals", "P = Playoffs", "F = Finals"])
         layout.addRow('First Match Type:', self.match_type)
@@ -263,6 +320,10 @@ class MainWindow(QWidget):
         self.bake_config = QPushButton('Bake CONFIG')
         self.bake_config.clicked.connect(lambda: self.bakeCONFIG(self.bake_config))
         config_layout.addWidget(self.bake_config)
+        # more events (other fields, divisions) run beside this one from their own CONFIG files
+        self.add_config = QPushButton('Add Event CONFIG')
+        self.add_config.clicked.connect(lambda: self.addEventCONFIG(self.add_config))
+        config_layout.addWidget(self.add_config)
         main_layout.addWidget(config_container)
 
         self.startThreadButton = QPushButton('Make The Sauce')
@@ -278,10 +339,24 @@ class MainWindow(QWidget):
         self.status_seen = QLabel(" SEEN: X")
         self.status_built = QLabel("BUILT: X")
         self.status_sent = QLabel(" SENT: X")
+        self.status_quota = QLabel("QUOTA: X")
         
         status_layout.addWidget(self.status_seen)
         status_layout.addWidget(self.status_built)
         status_layout.addWidget(self.status_sent)
+        status_layout.addWidget(self.status_quota)
+
+        # move a match to the front of the build & send queues
+        self.bump_matchID = QLineEdit()
+        self.bump_matchID.setPlaceholderText('Match ID (Q41, or EVENT Q41)')
+        self.bump_button = QPushButton('Bump')
+        self.bump_button.clicked.connect(self.bumpMatch)
+        status_layout.addWidget(self.bump_matchID)
+        status_layout.addWidget(self.bump_button)
+
+        # quota is spent by the send workers, refresh it from the ledger
+        self.quotaTimer = QTimer(self)
+        self.quotaTimer.timeout.connect(self.updateQuota)
 
         main_layout.addWidget(status_container)
 
@@ -294,37 +369,97 @@ class MainWindow(QWidget):
         # clear the stop event
         self.stop_event.clear()
 
-        # Clear and entries in send log file that were not finished
-        with open('log/send.txt', 'r') as source_file, open('log/seek.txt', 'w') as destination_file:
-            # Read the contents of the source file and write them to the destination file
-            destination_file.write(source_file.read())
-        
-        with open('log/send.txt', 'r') as file:
-            # Count finished matches
-            count_finished = len([line for line in file if self.CONFIG['event']['code'] in line])
-
-        self.status_seen.setText(f" SEEN: {count_finished}")
-        self.status_built.setText(f"BUILT: {count_finished}")
-        self.status_sent.setText(f" SENT: {count_finished}")
+        # the event in the GUI and the events added from CONFIG files share the build pool, send workers and quota
+        events = {}
+        for CONFIG in [self.CONFIG] + self.extraCONFIGs:
+            if CONFIG['event']['code'] in events:
+                print(f"{CONFIG['event']['code']} is already running, not added twice")
+                continue
+            events[CONFIG['event']['code']] = CONFIG
+
+        # Queue matches that were not finished at the stage they were in, and count them
+        counts = {}
+        for CONFIG in events.values():
+            addPipeline(CONFIG)
+            for state, count in resume(CONFIG, not(CONFIG['build'].get('batch', False) and CONFIG['video']['type'] == 'static')).items():
+                counts[state] = counts.get(state, 0) + count
+
+        self.status_seen.setText(f" SEEN: {sum(counts.values()) - counts.get('early', 0)}")
+        self.status_built.setText(f"BUILT: {sum(counts.get(state, 0) for state in ('built', 'uploading', 'sent'))}")
+        self.status_sent.setText(f" SENT: {counts.get('sent', 0)}")
 
         # load API credentials
         with open("CREDENTIALS", "r") as file:
             CREDENTIALS = json.load(file)
 
-        # Create threads for each queue
-        self.thread_seek = threading.Thread(target=process_queue_seek, args=(self.CONFIG, self.stop_event, self.status_seen, CREDENTIALS))
-        if self.CONFIG['video']['type'] == 'live':
-            self.thread_build = threading.Thread(target=process_queue_build_live, args=(self.CONFIG, self.stop_event, self.status_built))
-        elif self.CONFIG['video']['type'] == 'static':
-            self.thread_build = threading.Thread(target=process_queue_build_static, args=(self.CONFIG, self.stop_event, self.status_built, self.matches))
-        self.thread_send = threading.Thread(target=process_queue_send, args=(self.CONFIG, self.stop_event, self.status_sent, self.YouTube))
-
-        # Start the threads
-        if self.CONFIG['video']['type'] == 'live':
-            watch(self.CONFIG['video']['twitchUserID'], self.stop_event, CREDENTIALS)
-        self.thread_seek.start()
-        self.thread_build.start()
-        self.thread_send.start()
+        # one set of build workers for every event, with the settings of the event in the GUI
+        startBuildPool(self.CONFIG)
+
+        # Create and start the threads of each event
+        self.thread_seek = []
+        for CONFIG in events.values():
+            self.start_event(CONFIG, CREDENTIALS, self.matches if CONFIG is self.CONFIG else None)
+
+        # Create threads shared by all events
+        self.thread_build = threading.Thread(target=process_queue_build_pool, args=(self.CONFIG, self.stop_event, self.status_built))
+        self.thread_metadata = threading.Thread(target=process_queue_metadata, args=(self.CONFIG, self.stop_event, self.YouTube))
+        self.thread_send = [threading.Thread(target=process_queue_send, args=(self.CONFIG, self.stop_event, self.status_sent, self.YouTube)) for i in range(self.CONFIG['YouTube'].get('workers', 1))]
+
+        # Start the threads (batch renders submit to the build workers themselves)
+        if not all(CONFIG['build'].get('batch', False) and CONFIG['video']['type'] == 'static' for CONFIG in events.values()):
+            self.thread_build.start()
+        for thread in self.thread_send:
+            thread.start()
+        if self.YouTube != None:
+            self.thread_metadata.start()
+        quotaLedger.dailyQuota = self.CONFIG['YouTube'].get('dailyQuota', 10000)
+        self.updateQuota()
+        self.quotaTimer.start(10000)
+
+    def start_event(self, CONFIG, CREDENTIALS, matches):
+        # FMS matches of the events added from CONFIG files are loaded by their own thread
+        def loadMatches():
+            return matches if matches is not None else eventMatches(CONFIG, CREDENTIALS, self.stop_event)
+
+        if CONFIG['video']['type'] == 'live':
+            if CONFIG['video'].get('capture', False):
+                capture(CONFIG, self.stop_event)
+            else:
+                watch(CONFIG, self.stop_event, CREDENTIALS)
+            threading.Thread(target=process_queue_source_live, args=(CONFIG, self.stop_event)).start()
+        elif CONFIG['build'].get('batch', False):
+            threading.Thread(target=lambda: process_queue_build_batch(CONFIG, self.stop_event, self.status_built, loadMatches())).start()
+        elif CONFIG['video']['type'] == 'static':
+            threading.Thread(target=lambda: process_queue_source_static(CONFIG, self.stop_event, loadMatches())).start()
+        if (CONFIG['program'] == 'FRC') and (CONFIG['TBA']['eventKey'] != ''):
+            publish(CONFIG, self.stop_event)
+
+        # the batch render finds its matches itself
+        if not(CONFIG['build'].get('batch', False) and CONFIG['video']['type'] == 'static'):
+            self.thread_seek.append(threading.Thread(target=process_queue_seek, args=(CONFIG, self.stop_event, self.status_seen, CREDENTIALS)))
+            self.thread_seek[-1].start()
+
+    def updateQuota(self):
+        exhaustion = quotaLedger.projectedExhaustion()
+        if exhaustion is None:
+            self.status_quota.setText(f"QUOTA: {quotaLedger.remaining()}")
+        else:
+            self.status_quota.setText(f"QUOTA: {quotaLedger.remaining()} (out ~{exhaustion:%H:%M})")
+
+    def bumpMatch(self):
+        # 'Q41' bumps Q41 of every event running, 'EVENT Q41' only that event's
+        words = self.bump_matchID.text().strip().upper().split()
+        if len(words) == 1:
+            bump(words[0])
+        elif len(words) == 2:
+            bump(words[1], words[0])
+
+    def changeProfile(self, profile):
+        # running builds pick up the profile on their next match, in every event
+        if self.CONFIG is not None:
+            self.CONFIG['build']['profile'] = profile
+        for pipeline in list(pipelines.values()):
+            pipeline['config']['build']['profile'] = profile
 
     def on_sauce_made(self, result):
         self.startThreadButton.setText(f"{result} matches processed!")
@@ -377,9 +512,9 @@ class MainWindow(QWidget):
         
         try:
             if self.program.currentText() == 'FRC':
-                matchesRaw = getMatchesFromFMS(year, eventCode, self.program.currentText(), CREDENTIALS['FRC_username'], CREDENTIALS['FRC_key'])
+                matchesRaw = getFMSClient(year, eventCode, self.program.currentText(), CREDENTIALS['FRC_username'], CREDENTIALS['FRC_key']).poll()
             elif self.program.currentText() == 'FTC':
-                matchesRaw = getMatchesFromFMS(year, eventCode, self.program.currentText(), CREDENTIALS['FTC_username'], CREDENTIALS['FTC_key'])
+                matchesRaw = getFMSClient(year, eventCode, self.program.currentText(), CREDENTIALS['FTC_username'], CREDENTIALS['FTC_key']).poll()
             
             self.matches = rewrapMatches(matchesRaw, self.program.currentText())
             
@@ -390,9 +525,12 @@ class MainWindow(QWidget):
             self.status_seen.setText(f" SEEN: {len(self.matches)}")
 
             self.tab.tabBar().setTabTextColor(1, QColor('green'))
-        except json.JSONDecodeError:
+        except ValueError:
             text.setText('<font color="red">Event does not exist!</font>')
             self.tab.tabBar().setTabTextColor(1, QColor('red'))
+        except requests.exceptions.RequestException as errorText:
+            text.setText(f'<font color="red">FMS not available: {errorText}</font>')
+            self.tab.tabBar().setTabTextColor(1, QColor('red'))
     
     def test_twitch(self):
         
@@ -488,12 +626,31 @@ class MainWindow(QWidget):
                 'YouTube' : {
                     'description' : self.video_description.toPlainText(),
                     'tags' : self.video_tags.text(),
-                    'playlist' : self.video_playlist.text().split('?list=')[-1]
+                    'playlist' : self.video_playlist.text().split('?list=')[-1],
+                    'chunkMegabytes' : int(self.video_chunkMegabytes.text()),
+                    'workers' : int(self.video_workers.text()),
+                    'dailyQuota' : int(self.video_dailyQuota.text())
                 },
                 'TBA' : {
                     'Auth_Id' : self.TBA_AuthID.text(),
                     'Auth_Secret': self.TBA_AuthSecret.text(),
                     'eventKey': self.TBA_eventCode.text()
+                },
+                'build' : {
+                    'engine' : self.build_engine.currentText(),
+                    'workers' : int(self.build_workers.text()),
+                    'recycleAfter' : int(self.build_recycle.text()),
+                    'batch' : self.build_batch.isChecked(),
+                    'cacheMegabytes' : int(self.build_cache.text()),
+                    'early' : self.build_early.isChecked(),
+                    'encodeWorkers' : int(self.build_encodeWorkers.text()),
+                    'profile' : self.build_profile.currentText(),
+                    'autoQueueDepth' : int(self.build_autoQueueDepth.text()),
+                    'uploadBudget' : float(self.build_uploadBudget.text()),
+                    'deadline' : float(self.build_deadline.text()),
+                    'sendBacklog' : int(self.build_sendBacklog.text()),
+                    'buildBacklog' : int(self.build_buildBacklog.text()),
+                    'minFreeMegabytes' : int(self.build_minFree.text())
                 }
             }
 
@@ -503,7 +660,10 @@ class MainWindow(QWidget):
                                    'matchID' : self.match_type.currentText()[0] + self.match_number_ref.text(),
                                    'matchTime' : (self.match_timeMin, self.match_timeSec)}
             else:
-                CONFIG['video'] = {'type': 'live', 'twitchUserID' : self.twitchUserID, 'streamDelay' : float(self.twitchDelay.text())}
+                CONFIG['video'] = {'type': 'live', 'twitchUserID' : self.twitchUserID, 'streamDelay' : float(self.twitchDelay.text()),
+                                   'twitchUser' : self.twitchUser.text(),
+                                   'capture' : self.twitch_capture.isChecked(),
+                                   'captureMegabytes' : int(self.twitch_captureSize.text())}
 
             self.CONFIG = CONFIG
 
@@ -516,6 +676,24 @@ class MainWindow(QWidget):
             button.setStyleSheet('color: red')
             button.setText('Bake CONFIG: ERROR')
     
+    def addEventCONFIG(self, button):
+        response = QFileDialog.getOpenFileName(
+            parent=self,
+            caption='Select a file',
+            directory=os.getcwd(),
+            filter='CONFIG File (*CONFIG)'
+        )
+
+        if response[0]!='':
+            with open(response[0], "r") as file:
+                CONFIG = json.load(file)
+            # CONFIGs baked before a build setting existed take its default
+            CONFIG['build'] = {**defaultBuild, **CONFIG.get('build', {})}
+            self.extraCONFIGs.append(CONFIG)
+            button.setText('Add Event CONFIG: '+', '.join(CONFIG['event']['code'] for CONFIG in self.extraCONFIGs))
+        else:
+            print('No CONFIG selected!')
+
     def loadCONFIG(self, button):
         response = QFileDialog.getOpenFileName(
             parent=self,
@@ -551,11 +729,30 @@ class MainWindow(QWidget):
                 self.video_description.setPlainText(CONFIG['YouTube']['description'])
                 self.video_tags.setText(CONFIG['YouTube']['tags'])
                 self.video_playlist.setText('https://www.youtube.com/playlist?list='+CONFIG['YouTube']['playlist'])
+                self.video_chunkMegabytes.setText(str(CONFIG['YouTube'].get('chunkMegabytes', 8)))
+                self.video_workers.setText(str(CONFIG['YouTube'].get('workers', 2)))
+                self.video_dailyQuota.setText(str(CONFIG['YouTube'].get('dailyQuota', 10000)))
 
                 self.TBA_AuthID.setText(CONFIG['TBA']['Auth_Id'])
                 self.TBA_AuthSecret.setText(CONFIG['TBA']['Auth_Secret'])
                 self.TBA_eventCode.setText(CONFIG['TBA']['eventKey'])
 
+                if 'build' in CONFIG:
+                    self.build_engine.setCurrentText(CONFIG['build']['engine'])
+                    self.build_workers.setText(str(CONFIG['build']['workers']))
+                    self.build_recycle.setText(str(CONFIG['build']['recycleAfter']))
+                    self.build_batch.setChecked(CONFIG['build'].get('batch', False))
+                    self.build_cache.setText(str(CONFIG['build'].get('cacheMegabytes', 2048)))
+                    self.build_early.setChecked(CONFIG['build'].get('early', False))
+                    self.build_encodeWorkers.setText(str(CONFIG['build'].get('encodeWorkers', 1)))
+                    self.build_profile.setCurrentText(CONFIG['build'].get('profile', 'balanced'))
+                    self.build_autoQueueDepth.setText(str(CONFIG['build'].get('autoQueueDepth', 3)))
+                    self.build_uploadBudget.setText(str(CONFIG['build'].get('uploadBudget', 240)))
+                    self.build_deadline.setText(str(CONFIG['build'].get('deadline', 900)))
+                    self.build_sendBacklog.setText(str(CONFIG['build'].get('sendBacklog', 10)))
+                    self.build_buildBacklog.setText(str(CONFIG['build'].get('buildBacklog', 50)))
+                    self.build_minFree.setText(str(CONFIG['build'].get('minFreeMegabytes', 2048)))
+
                 if CONFIG['video']['type'] == 'static':
                     self.videoFilepath = CONFIG['video']['filePath']
                     self.match_type.setCurrentText({'Q':"Q = Quals", 'P':"P = Playoffs", 'F':"F = Finals"}[CONFIG['video']['matchID'][0]])
@@ -565,6 +762,10 @@ class MainWindow(QWidget):
                 elif CONFIG['video']['type'] == 'live':
                     self.twitchUserID = CONFIG['video']['twitchUserID']
                     self.twitchDelay.setText(str(CONFIG['video']['streamDelay']))
+                    if 'capture' in CONFIG['video']:
+                        self.twitchUser.setText(CONFIG['video']['twitchUser'])
+                        self.twitch_capture.setChecked(CONFIG['video']['capture'])
+                        self.twitch_captureSize.setText(str(CONFIG['video']['captureMegabytes']))
 
         else:
             print('No CONFIG selected!')
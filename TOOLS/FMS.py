@@ -2,9 +2,21 @@ import json         # response handling
 import requests     # API data request
 import base64       # API hashing
 import datetime     # str conversion
+import threading    # snapshot shared by the GUI and the seek thread
+import time         # request statistics
+import statistics   # cycle time estimates
+
+from TOOLS.files import atomicWrite
+from TOOLS.httpclient import getClient
 
 translateSymbol = {'Q': 'Quals', 'P': 'Playoffs', 'F': 'Finals'}
 
+# seconds between refreshes of the schedule, see FMSClient.schedule
+scheduleSeconds = 600
+
+# seconds from match start to score post, until the event has posted a few
+defaultPostSeconds = 180
+
 # CREDENTIALS (dict): credentials from https://frc-events.firstinspires.org/services/api, contains "FRC_username" and "FRC_key" entries
 with open("CREDENTIALS", "r") as file:
     CREDENTIALS = json.load(file)  # contains username + authKey
@@ -75,8 +87,8 @@ def getMatchesFromFMS(year: int, eventCode: str, program: str, authUsr: str = CR
     headers = prepareHeadersFMS(authUsr, authKey)
 
     # make the API call (separately to prevent stale results)
-    responseQuals = requests.get(url+'?tournamentLevel=Qualification', headers=headers, verify=False)
-    responsePlayoffs = requests.get(url+'?tournamentLevel=Playoff', headers=headers, verify=False)
+    responseQuals = getClient('FMS').get(url+'?tournamentLevel=Qualification', headers=headers)
+    responsePlayoffs = getClient('FMS').get(url+'?tournamentLevel=Playoff', headers=headers)
 
     # combine the two match calls together
     if program == 'FRC':
@@ -86,12 +98,231 @@ def getMatchesFromFMS(year: int, eventCode: str, program: str, authUsr: str = CR
     
     return matchesRaw
 
-def rewrapMatches(matchesRaw:list, program:str):
+class FMSClient:
+    """
+    Match lists of one event, polled with conditional requests and kept as a snapshot shared by the GUI and the seek thread
+        * each tournament level is requested with If-Modified-Since/If-None-Match, unchanged lists come back as 304 without a body
+        * the Qualification list is no longer requested once every qual is posted and playoffs have started
+        * the snapshot is kept in memory and in snapshotPath, a restart continues from it
+    """
+
+    def __init__(self, year: int, eventCode: str, program: str, authUsr: str, authKey: str, snapshotPath: str = 'log/fms.json'):
+        # enforce program input
+        if program not in ('FRC', 'FTC'):
+            raise ValueError(f"Invalid input: {program}, must be 'FRC' or 'FTC'.")
+
+        # define API url, based on: https://frc-api-docs.firstinspires.org/#733f4607-ab40-4e00-b3e1-36cfb1a2e77e
+        if program == 'FRC':
+            self.url = 'https://frc-api.firstinspires.org/v3.0/'+str(year)+'/{endpoint}/'+eventCode
+        elif program == 'FTC':
+            self.url = 'http://ftc-api.firstinspires.org/v2.0/'+str(year)+'/{endpoint}/'+eventCode
+        self.program = program
+        self.key = f"{program}/{year}/{eventCode}"
+        self.snapshotPath = snapshotPath
+        self.client = getClient('FMS')
+        self.headers = prepareHeadersFMS(authUsr, authKey)
+        self.lock = threading.Lock()
+
+        # requests made and bytes transferred since this client was created
+        self.stats = {'requests': 0, 'notModified': 0, 'bytes': 0, 'since': time.monotonic()}
+
+        # tournament level: {'matches': list, 'lastModified': str, 'etag': str}
+        self.levels = {'Qualification': {'matches': [], 'lastModified': None, 'etag': None},
+                       'Playoff': {'matches': [], 'lastModified': None, 'etag': None}}
+
+        # same for the schedule of each level, refreshed every scheduleSeconds
+        self.schedules = {'Qualification': {'matches': [], 'lastModified': None, 'etag': None},
+                          'Playoff': {'matches': [], 'lastModified': None, 'etag': None}}
+        self.scheduleFetched = None
+
+        try:
+            with open(snapshotPath, 'r') as file:
+                snapshot = json.load(file)
+            if snapshot['key'] == self.key:
+                self.levels = snapshot['levels']
+                self.schedules = snapshot.get('schedules', self.schedules)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def qualsComplete(self):
+        quals = self.levels['Qualification']['matches']
+        playoffs = self.levels['Playoff']['matches']
+
+        return bool(quals) and all(match['postResultTime'] != None for match in quals) and any(match['actualStartTime'] != None for match in playoffs)
+
+    def fetchLevel(self, level: str, endpoint: str = 'matches'):
+        state = (self.levels if endpoint == 'matches' else self.schedules)[level]
+
+        headers = dict(self.headers)
+        if state['lastModified'] != None:
+            headers['If-Modified-Since'] = state['lastModified']
+        if state['etag'] != None:
+            headers['If-None-Match'] = state['etag']
+
+        response = self.client.get(self.url.format(endpoint=endpoint)+'?tournamentLevel='+level, headers=headers)
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(response.content)
+
+        if response.status_code == 304:
+            self.stats['notModified'] += 1
+            return
+
+        # the retries are used up (or the event does not exist), the cached list stays as it was
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f"{response.status_code} for {level} {endpoint}", response=response)
+
+        # FRC capitalizes the list, FTC does not
+        try:
+            if self.program == 'FRC':
+                matches = response.json()[endpoint.capitalize()]
+            elif self.program == 'FTC':
+                matches = response.json()[endpoint]
+        except (requests.exceptions.JSONDecodeError, KeyError) as errorText:
+            raise ValueError(f"unreadable {level} {endpoint} ({errorText})")
+        state['matches'] = matches
+        state['lastModified'] = response.headers.get('Last-Modified')
+        state['etag'] = response.headers.get('ETag')
+
+    def saveSnapshot(self):
+        # a crash must not lose the snapshot
+        atomicWrite(self.snapshotPath, json.dumps({'key': self.key, 'levels': self.levels, 'schedules': self.schedules}))
+
+    def poll(self):
+        """
+        Refreshes the snapshot from FMS
+
+        Returns:
+            matchesRaw (list): same as getMatchesFromFMS
+
+        Raises:
+            requests.exceptions.RequestException: FMS not reachable after the retries, or an error status
+            ValueError: response without a match list
+        """
+        with self.lock:
+            if not self.qualsComplete():
+                self.fetchLevel('Qualification')
+            self.fetchLevel('Playoff')
+            self.saveSnapshot()
+
+            return self.matches()
+
+    def schedule(self):
+        """
+        Scheduled matches of the event, from FMS at most every scheduleSeconds
+
+        Returns:
+            scheduleRaw (list): FMS schedule entries ('startTime', 'tournamentLevel', 'matchNumber', ...)
+        """
+        with self.lock:
+            if (self.scheduleFetched is None) or (time.monotonic() - self.scheduleFetched >= scheduleSeconds):
+                # the playoff schedule appears partway through the event, keep what we have on errors
+                try:
+                    if not self.qualsComplete():
+                        self.fetchLevel('Qualification', 'schedule')
+                    self.fetchLevel('Playoff', 'schedule')
+                except (requests.exceptions.RequestException, ValueError, KeyError) as errorText:
+                    print(f"FMS: schedule not available ({errorText})")
+                self.scheduleFetched = time.monotonic()
+                self.saveSnapshot()
+
+            return self.schedules['Qualification']['matches'] + self.schedules['Playoff']['matches']
+
+    def matches(self):
+        """
+        Matches in the snapshot, without asking FMS
+
+        Returns:
+            matchesRaw (list): same as getMatchesFromFMS
+        """
+        return self.levels['Qualification']['matches'] + self.levels['Playoff']['matches']
+
+    def report(self):
+        hours = max((time.monotonic() - self.stats['since'])/3600, 1/60)
+        print(f"FMS: {self.stats['requests']} requests ({self.stats['notModified']} not modified), {self.stats['bytes']/1024:.0f} KiB; {self.stats['requests']/hours:.0f} requests and {self.stats['bytes']/1024/hours:.0f} KiB per hour")
+
+# one client per event, so the GUI and the seek thread share its snapshot
+fmsClients = {}
+fmsClientsLock = threading.Lock()
+
+def getFMSClient(year: int, eventCode: str, program: str, authUsr: str = CREDENTIALS['FRC_username'], authKey: str = CREDENTIALS['FRC_key']):
+    """Shared FMSClient of an event, created on first use
+        * the credentials are taken on every call, a key changed in the GUI replaces the one the client was created with
+
+    Args:
+        year (int): season year
+        eventCode (str): event code
+        program (str): FIRST program; 'FRC' or 'FTC'
+        authUsr (str): username for respective FRC/FTC api
+        authKey (str): key for respective FRC/FTC api
+
+    Returns:
+        client (FMSClient)
+
+    """
+    with fmsClientsLock:
+        key = (int(year), eventCode, program)
+        if not(key in fmsClients):
+            # several events can run at once, each keeps its own snapshot
+            fmsClients[key] = FMSClient(year, eventCode, program, authUsr, authKey, f'log/fms_{eventCode}.json')
+        else:
+            fmsClients[key].headers = prepareHeadersFMS(authUsr, authKey)
+
+        return fmsClients[key]
+
+def estimateNextPost(matchesRaw: list, scheduleRaw: list):
+    """Estimates when the next score will be posted, from the schedule and the recent cycle times of the event
+        * a started match posts its score about as long after its start as the last few did
+        * otherwise the next scheduled match starts on its schedule shifted by how far behind the event runs,
+          and no sooner than one cycle time after the last match started
+
+    Args:
+        matchesRaw (list): FMS matches, see getMatchesFromFMS
+        scheduleRaw (list): FMS schedule, see FMSClient.schedule
+
+    Returns:
+        expectedPost (datetime.datetime): None once no more matches are scheduled
+
+    """
+    started = sorted([match for match in matchesRaw if match['actualStartTime'] != None], key=lambda match: match['actualStartTime'])
+    posted = [match for match in started if match['postResultTime'] != None]
+
+    # start to post of the last few matches
+    if posted:
+        postSeconds = statistics.median([(str2dte(match['postResultTime']) - str2dte(match['actualStartTime'])).total_seconds() for match in posted[-5:]])
+    else:
+        postSeconds = defaultPostSeconds
+
+    unposted = [str2dte(match['actualStartTime']) for match in started if match['postResultTime'] == None]
+    if unposted:
+        return min(unposted) + datetime.timedelta(seconds=postSeconds)
+
+    # scheduled matches that have not started yet
+    startedKeys = {(match['tournamentLevel'][0].upper(), match['matchNumber']) for match in started}
+    scheduled = {(entry['tournamentLevel'][0].upper(), entry['matchNumber']): str2dte(entry['startTime']) for entry in scheduleRaw if entry.get('startTime') != None}
+    upcoming = sorted(startTime for key, startTime in scheduled.items() if not(key in startedKeys))
+    if not upcoming:
+        return None
+
+    # how far behind schedule the event runs
+    drifts = [(str2dte(match['actualStartTime']) - scheduled[(match['tournamentLevel'][0].upper(), match['matchNumber'])]).total_seconds()
+              for match in started[-5:] if (match['tournamentLevel'][0].upper(), match['matchNumber']) in scheduled]
+    expectedStart = upcoming[0] + datetime.timedelta(seconds=statistics.median(drifts) if drifts else 0)
+
+    # cycle time of the last few matches, leaving out breaks
+    starts = [str2dte(match['actualStartTime']) for match in started[-6:]]
+    cycles = [(later - earlier).total_seconds() for earlier, later in zip(starts, starts[1:]) if (later - earlier).total_seconds() < 15*60]
+    if cycles:
+        expectedStart = max(expectedStart, starts[-1] + datetime.timedelta(seconds=statistics.median(cycles)))
+
+    return expectedStart + datetime.timedelta(seconds=postSeconds)
+
+def rewrapMatches(matchesRaw:list, program:str, includeUnposted:bool=False):
     """Reformats FMS matches response into a list of match dictionaries
 
     Args:
         matchesRaw (list): are the matches qualifications?
         program (str): FIRST program; 'FRC' or 'FTC'
+        includeUnposted (bool): also return matches that started but have no score posted yet ('post' is None)
 
     Returns:
         matchesSorted (list): [{'X0': {start': datetime.datetime, 'post': datetime.datetime, 'teamsRed': list(int), 'teamsBlue': list(int)]}, ...]
@@ -101,7 +332,7 @@ def rewrapMatches(matchesRaw:list, program:str):
     # reorganize them for future work
     matchesCleaned = []
     for match in matchesRaw:
-        if (match['actualStartTime'] != None)*(match['postResultTime'] != None):
+        if (match['actualStartTime'] != None)*((match['postResultTime'] != None) or includeUnposted):
             matchDict = {}
             # match ID (special things for finals)
             if program == 'FRC':
@@ -117,7 +348,7 @@ def rewrapMatches(matchesRaw:list, program:str):
                     matchDict['id'] = match['tournamentLevel'][0]+str(match['matchNumber'])
             # match information
             matchDict['start'] = str2dte(match['actualStartTime'])
-            matchDict['post'] = str2dte(match['postResultTime'])
+            matchDict['post'] = str2dte(match['postResultTime']) if match['postResultTime'] != None else None
             matchDict['teamsRed'] = [team['teamNumber'] for team in match['teams'] if team['station'][0]=='R']
             matchDict['teamsBlue'] = [team['teamNumber'] for team in match['teams'] if team['station'][0]=='B']
             # replay tag bool
@@ -1,5 +1,12 @@
 import requests
 import hashlib
+import json
+import random
+import threading
+import time
+
+from TOOLS.files import atomicWrite
+from TOOLS.httpclient import getClient
 
 def postTheBlueAlliance(TBA_Auth_Id:str, TBA_Auth_Secret:str, TBA_eventKey:str, data={}, TBA_Endpoint="/event/{eventKey}/match_videos/add"):
     """Pushes data to The Blue Alliance (TBA) using their write API
@@ -19,19 +26,20 @@ def postTheBlueAlliance(TBA_Auth_Id:str, TBA_Auth_Secret:str, TBA_eventKey:str,
     # generate the whole API endpoint
     endpoint = '/api/trusted/v1'+TBA_Endpoint.replace('{eventKey}', TBA_eventKey)
 
-    # prepare the information to be hashed, force it to use double-quotes
-    preHash = (TBA_Auth_Secret+endpoint+str(data)).replace("'", '"')
+    # sign exactly the body that is sent
+    body = json.dumps(data, separators=(',', ':'), sort_keys=True)
 
     # apply the md5 hash, as specified in the API documentation
-    postHash = hashlib.md5(preHash.encode("ascii")).hexdigest()
+    postHash = hashlib.md5((TBA_Auth_Secret+endpoint+body).encode("utf-8")).hexdigest()
 
     # define headers for API authentication
     headers = {
         "X-TBA-Auth-Id": TBA_Auth_Id,
-        "X-TBA-Auth-Sig": postHash
+        "X-TBA-Auth-Sig": postHash,
+        "Content-Type": "application/json"
     }
 
-    response = requests.post('https://www.thebluealliance.com'+endpoint, headers=headers, json=data)
+    response = getClient('TBA').post('https://www.thebluealliance.com'+endpoint, headers=headers, data=body.encode("utf-8"))
 
     return response
 
@@ -61,3 +69,124 @@ def translateMatchString(matchID):
         return 'f1m'+matchID[1:]
     else:
         raise AttributeError('matchID does not start with one of [Q, P, M, F]')
+
+
+class TBAPublisher:
+    """
+    Buffers match videos for The Blue Alliance and posts them together, runs as a thread of the main process
+        * flushed once the oldest entry is flushSeconds old, or maxEntries are waiting
+        * failed flushes are retried with backoff, the buffer is kept in bufferPath so nothing is lost on exit
+        * onPosted(matchKeys) is called after each successful flush
+    """
+
+    def __init__(self, TBA_Auth_Id:str, TBA_Auth_Secret:str, TBA_eventKey:str, bufferPath:str='log/tba.json', flushSeconds:float=10, maxEntries:int=20, onPosted=None):
+        self.onPosted = onPosted
+        self.TBA_Auth_Id = TBA_Auth_Id
+        self.TBA_Auth_Secret = TBA_Auth_Secret
+        self.TBA_eventKey = TBA_eventKey
+        self.bufferPath = bufferPath
+        self.flushSeconds = flushSeconds
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retryAt = 0
+        # set when an entry is added (or on stop), the publisher sleeps until the next flush is due otherwise
+        self.changed = threading.Event()
+
+        # entries left over from the last run go out first
+        try:
+            with open(bufferPath, 'r') as file:
+                self.buffer = json.load(file)
+        except (OSError, ValueError):
+            self.buffer = {}
+        self.oldest = time.monotonic() if self.buffer else None
+
+    def saveBuffer(self):
+        # a crash must not lose the entries
+        atomicWrite(self.bufferPath, json.dumps(self.buffer, indent=2))
+
+    def add(self, matchKey:str, videoID:str):
+        """
+        Queues a match video for TBA
+
+        Args:
+            matchKey (str): TBA match key, see translateMatchString
+            videoID (str): YouTube video ID
+
+        """
+        with self.lock:
+            self.buffer[matchKey] = videoID
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self.saveBuffer()
+        self.changed.set()
+
+    def untilDue(self):
+        # seconds until the buffer should be flushed, None while it is empty
+        with self.lock:
+            if not self.buffer:
+                return None
+
+            dueAt = time.monotonic() if len(self.buffer) >= self.maxEntries else self.oldest + self.flushSeconds
+            return max(dueAt, self.retryAt) - time.monotonic()
+
+    def flush(self):
+        """
+        Posts everything buffered in one request
+
+        Returns:
+            bool: the buffer was posted (or was empty)
+        """
+        with self.lock:
+            data = dict(self.buffer)
+        if not data:
+            return True
+
+        try:
+            response = postTheBlueAlliance(self.TBA_Auth_Id, self.TBA_Auth_Secret, self.TBA_eventKey, data)
+            posted = response.status_code == 200
+            errorText = f"{response.status_code}, {response.text}"
+        except requests.exceptions.RequestException as error:
+            posted = False
+            errorText = error
+
+        with self.lock:
+            if posted:
+                # entries added while posting stay for the next flush
+                for matchKey, videoID in data.items():
+                    if self.buffer.get(matchKey) == videoID:
+                        del self.buffer[matchKey]
+                self.oldest = time.monotonic() if self.buffer else None
+                self.failures = 0
+                self.retryAt = 0
+            else:
+                self.failures += 1
+                self.retryAt = time.monotonic() + min(2**self.failures, 300) + random.random()
+            self.saveBuffer()
+
+        if posted:
+            print(f"TBA: posted {len(data)} match videos ({', '.join(data)})")
+            if self.onPosted != None:
+                self.onPosted(list(data))
+        else:
+            print(f"TBA: unable to post {len(data)} match videos ({errorText}), retry {self.failures}")
+
+        return posted
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            self.changed.clear()
+            delay = self.untilDue()
+            if (delay is not None) and (delay <= 0):
+                self.flush()
+            else:
+                self.changed.wait(delay)
+
+        # one last try on the way out, whatever is left stays in bufferPath
+        self.flush()
+
+    def start(self, stop_event):
+        threading.Thread(target=self.run, args=(stop_event,), daemon=True).start()
+
+        # stopping wakes the publisher for its last flush
+        threading.Thread(target=lambda: (stop_event.wait(), self.changed.set()), daemon=True).start()
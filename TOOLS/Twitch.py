@@ -2,14 +2,50 @@ import requests
 import os
 import subprocess
 import streamlink
+import threading
+import concurrent.futures
+import json
+import time
+from urllib.parse import urljoin
 
-def getTwitchAuthHeader(client_id:str, client_secret:str):
+from TOOLS.files import atomicWrite
+from TOOLS.httpclient import getClient
+
+# segments downloaded at once per clip, over one pooled connection per worker (see TwitchVOD in TOOLS/httpclient.py)
+segmentWorkers = 8
+
+# app access tokens by client ID, reused until shortly before they expire and kept between runs, see getTwitchAuthHeader
+tokenCachePath = 'log/twitch_token.json'
+tokenCache = None
+tokenCacheLock = threading.Lock()
+tokenRefreshSeconds = 300
+
+# media playlist URL of every VOD resolved by this process, see getVODPlaylist
+vodPlaylists = {}
+vodPlaylistsLock = threading.Lock()
+
+def loadTokenCache():
+    try:
+        with open(tokenCachePath, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def saveTokenCache():
+    # a crash must not corrupt it
+    try:
+        atomicWrite(tokenCachePath, json.dumps(tokenCache))
+    except OSError as errorText:
+        print(f"unable to save Twitch token: {errorText}")
+
+def getTwitchAuthHeader(client_id:str, client_secret:str, rejected:str=None):
     """
-    Retrieves the access token for the Twitch API.
+    Retrieves the access token for the Twitch API, reusing the cached token until shortly before it expires
 
     Args:
         client_id (str): Your Twitch client ID.
         client_secret (str): Your Twitch client secret.
+        rejected (str): token the API rejected, a new one is fetched unless another thread already replaced it
 
     Returns:
         dict: header for use in requests.get for Twitch
@@ -17,19 +53,52 @@ def getTwitchAuthHeader(client_id:str, client_secret:str):
     Raises:
       Exception: Unable to obtain Twitch access token
     """
-    
-    params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
-    
-    response = requests.post("https://id.twitch.tv/oauth2/token", data=params)
+    global tokenCache
+
+    # one thread refreshes, the others wait for its token
+    with tokenCacheLock:
+        if tokenCache is None:
+            tokenCache = loadTokenCache()
+
+        cached = tokenCache.get(client_id)
+        if ((rejected is not None) and (cached is not None) and (cached['token'] == rejected)) or (cached is None) or (time.time() >= cached['expires'] - tokenRefreshSeconds):
+            params = {
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'grant_type': 'client_credentials'
+            }
+            
+            response = getClient('Twitch').post("https://id.twitch.tv/oauth2/token", data=params)
+
+            if response.status_code != 200:
+                raise Exception(f"Error: {response.status_code}, {response.text}")
+
+            cached = {'token': response.json()['access_token'], 'expires': time.time() + response.json()['expires_in']}
+            tokenCache[client_id] = cached
+            saveTokenCache()
+
+    return {'Client-ID': client_id, 'Authorization': f"Bearer {cached['token']}"}
+
+def getHelix(client_id:str, client_secret:str, url:str):
+    """
+    GET from the Twitch API with the cached token, getting a new one if it was revoked
+
+    Args:
+        client_id (str): Your Twitch client ID.
+        client_secret (str): Your Twitch client secret.
+        url (str): Twitch API URL
+
+    Returns:
+        response (requests.Response)
+    """
+    headers = getTwitchAuthHeader(client_id, client_secret)
+    response = getClient('Twitch').get(url, headers=headers)
+
+    # several threads may get a 401 for the same token, only the first one replaces it
+    if response.status_code == 401:
+        response = getClient('Twitch').get(url, headers=getTwitchAuthHeader(client_id, client_secret, rejected=headers['Authorization'][len('Bearer '):]))
 
-    if response.status_code == 200:
-        return {'Client-ID': client_id, 'Authorization': f'Bearer {response.json()['access_token']}'}
-    else:
-        raise Exception(f"Error: {response.status_code}, {response.text}")
+    return response
 
 
 def getTwitchVideoData(client_id:str, client_secret:str, vod_id:int):
@@ -46,8 +115,7 @@ def getTwitchVideoData(client_id:str, client_secret:str, vod_id:int):
     """
 
     # obtain data about VOD
-    headersTwitchAPI = getTwitchAuthHeader(client_id, client_secret)
-    response = requests.get('https://api.twitch.tv/helix/videos?id='+str(vod_id), headers=headersTwitchAPI)
+    response = getHelix(client_id, client_secret, 'https://api.twitch.tv/helix/videos?id='+str(vod_id))
 
     return response.json()['data'][0]
 
@@ -64,8 +132,7 @@ def covertID2Username(client_id:str, client_secret:str, username:int):
         user_id (str): Twitch user ID
     """
         
-    headersTwitchAPI = getTwitchAuthHeader(client_id, client_secret)
-    user_response = requests.get('https://api.twitch.tv/helix/users?login='+username, headers=headersTwitchAPI)
+    user_response = getHelix(client_id, client_secret, 'https://api.twitch.tv/helix/users?login='+username)
     user_data = user_response.json()
     user_id = user_data['data'][0]['id']
 
@@ -84,9 +151,8 @@ def getLatestTwitchVODs(client_id:str, client_secret:str, user_id:str):
         vods_data (list): list of VOD information
     """
         
-    headersTwitchAPI = getTwitchAuthHeader(client_id, client_secret)
     vods_url = f'https://api.twitch.tv/helix/videos?user_id={user_id}'
-    vods_response = requests.get(vods_url, headers=headersTwitchAPI)
+    vods_response = getHelix(client_id, client_secret, vods_url)
     vods_data = vods_response.json()['data']
 
     return vods_data
@@ -124,6 +190,127 @@ def downloadTwitchClip(vod_id: int, startTimestamp: str, durationSeconds: str, o
     # run command in terminal
     subprocess.run(command)
 
+def resolveVODPlaylist(vod_id: int):
+    """
+    Finds the media playlist (m3u8) of the best quality of a Twitch VOD, once per process
+
+    Args:
+        vod_id (int): twitch VOD ID
+
+    Returns:
+        str: URL of the media playlist
+    """
+    with vodPlaylistsLock:
+        if not(vod_id in vodPlaylists):
+            streams = streamlink.Streamlink().streams("https://www.twitch.tv/videos/"+str(vod_id))
+            if not('best' in streams):
+                raise ValueError(f"no streams found for VOD {vod_id}")
+            vodPlaylists[vod_id] = streams['best'].url
+
+        return vodPlaylists[vod_id]
+
+def getVODPlaylist(vod_id: int):
+    """
+    Reads the segment list of a Twitch VOD (grows while the stream is still live)
+
+    Args:
+        vod_id (int): twitch VOD ID
+
+    Returns:
+        dict: {'segments': [(start, duration, url), ...], 'init': url of the fMP4 header or None}
+    """
+    response = getClient('TwitchVOD').get(resolveVODPlaylist(vod_id), timeout=10)
+
+    # the playlist URL carries an access token that expires, resolve it again
+    if response.status_code in [401, 403, 404]:
+        with vodPlaylistsLock:
+            vodPlaylists.pop(vod_id, None)
+        response = getClient('TwitchVOD').get(resolveVODPlaylist(vod_id), timeout=10)
+    response.raise_for_status()
+
+    playlist = {'segments': [], 'init': None}
+    position = 0
+    duration = None
+    for line in response.text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line.startswith('#EXT-X-MAP:'):
+            playlist['init'] = urljoin(response.url, line.split('URI="')[1].split('"')[0])
+        elif line and not line.startswith('#') and (duration is not None):
+            playlist['segments'].append((position, duration, urljoin(response.url, line)))
+            position += duration
+            duration = None
+
+    return playlist
+
+def downloadSegment(url: str):
+    response = getClient('TwitchVOD').get(url)
+    response.raise_for_status()
+
+    return response.content
+
+def downloadTwitchSegments(vod_id: int, startSeconds: float, endSeconds: float, outputBase: str, cache=None):
+    """
+    Downloads exactly the VOD segments covering a time range, in parallel, into a single file
+        * segments are joined as they are (no remux), MPEG-TS or fragmented MP4 depending on the VOD
+        * local time 0 of the file is the start of its first segment
+
+    Args:
+        vod_id (int): twitch VOD ID
+        startSeconds (float): start of the range in VOD time
+        endSeconds (float): end of the range in VOD time
+        outputBase (str): location & name of output filepath, without extension
+        cache (SegmentCache): segments already downloaded, see TOOLS/segmentcache.py
+
+    Returns:
+        dict: {'filePath': str, 'start': VOD time of local 0 (float), 'bytes': int downloaded, 'cacheHits': int, 'cacheMisses': int, 'bytesSaved': int}
+
+    Raises:
+        ValueError: range is not (yet) in the VOD
+    """
+    playlist = getVODPlaylist(vod_id)
+    indices = [i for i, segment in enumerate(playlist['segments']) if (segment[0] + segment[1] > startSeconds) and (segment[0] < endSeconds)]
+
+    if (not indices) or (sum(playlist['segments'][indices[-1]][0:2]) < endSeconds):
+        raise ValueError(f"VOD {vod_id} does not reach {endSeconds:.1f}s yet")
+
+    # (cache key, url) of every piece of the file
+    pieces = [(i, playlist['segments'][i][2]) for i in indices]
+    if playlist['init'] is not None:
+        pieces.insert(0, ('init', playlist['init']))
+
+    result = {'filePath': outputBase + ('.mp4' if playlist['init'] is not None else '.ts'), 'start': playlist['segments'][indices[0]][0],
+              'bytes': 0, 'cacheHits': 0, 'cacheMisses': 0, 'bytesSaved': 0}
+
+    def fetchPiece(piece):
+        content = cache.get(vod_id, piece[0]) if cache is not None else None
+        if content is not None:
+            return content, True
+
+        content = downloadSegment(piece[1])
+        if cache is not None:
+            cache.put(vod_id, piece[0], content)
+
+        return content, False
+
+    # download concurrently, write in order
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=segmentWorkers) as pool:
+            with open(result['filePath'], 'wb') as file:
+                for content, cached in pool.map(fetchPiece, pieces):
+                    file.write(content)
+                    if cached:
+                        result['cacheHits'] += 1
+                        result['bytesSaved'] += len(content)
+                    else:
+                        result['cacheMisses'] += 1
+                        result['bytes'] += len(content)
+    except requests.exceptions.RequestException as errorText:
+        raise ValueError(f"unable to download VOD {vod_id}: {errorText}")
+
+    return result
+
 def durationStr2Sec(duration):
     """
     translates duration in string format to integer
@@ -2,6 +2,25 @@ import google_auth_oauthlib.flow
 import googleapiclient.discovery
 import googleapiclient.errors
 import googleapiclient.http
+import httplib2
+import json
+import os
+import random
+import threading
+import time
+
+from TOOLS.files import atomicWrite
+from TOOLS.quota import uploadCost
+from TOOLS.quota import thumbnailCost
+from TOOLS.quota import playlistCost
+
+# resumable upload sessions of unfinished uploads, see saveUploadSession
+uploadSessionsPath = 'log/uploads.json'
+uploadSessionsLock = threading.Lock()
+
+# upload errors worth retrying, and how many times
+retryStatuses = [500, 502, 503, 504]
+maxRetries = 10
 
 def authenticate_youtube(SCOPES: list=["https://www.googleapis.com/auth/youtube.upload", "https://www.googleapis.com/auth/youtube"]):
     """Authenticates a session with YouTube using oauth
@@ -23,8 +42,79 @@ def authenticate_youtube(SCOPES: list=["https://www.googleapis.com/auth/youtube.
 
     return youtube
 
-def upload_video(youtube, media_file:str, request_body:dict, thumbnail: str=None, playlistID:str=''):
+def loadUploadSessions():
+    """
+    Resumable upload sessions of videos whose upload has not finished, by video file
+
+    Returns:
+        dict: {media_file: {'uri': str, 'signature': [size, mtime]}}
+    """
+    try:
+        with open(uploadSessionsPath, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def saveUploadSession(media_file:str, uri:str=None):
+    """
+    Remembers (or, without a uri, forgets) the resumable upload session of a video file
+
+    Args:
+        media_file (str): path to video file
+        uri (str): resumable session URI
+
+    """
+    # several send workers upload at once
+    with uploadSessionsLock:
+        sessions = loadUploadSessions()
+
+        if uri is None:
+            sessions.pop(media_file, None)
+        else:
+            stat = os.stat(media_file)
+            sessions[media_file] = {'uri': uri, 'signature': [stat.st_size, stat.st_mtime]}
+
+        # a crash must not lose the other sessions
+        atomicWrite(uploadSessionsPath, json.dumps(sessions, indent=2))
+
+def hasUploadSession(media_file:str):
+    """
+    Whether a video file has an interrupted upload that can be resumed (the file is unchanged since)
+
+    Args:
+        media_file (str): path to video file
+
+    Returns:
+        bool
+    """
+    session = loadUploadSessions().get(media_file)
+    if session is None:
+        return False
+
+    try:
+        stat = os.stat(media_file)
+    except OSError:
+        return False
+
+    return session['signature'] == [stat.st_size, stat.st_mtime]
+
+def askUploadProgress(request, ask:bool=True):
+    """
+    Makes the next chunk of a resumable upload ask the server how far it got before sending (or not)
+        * googleapiclient has no public way to do this, the private flag is from google-api-python-client 2.123.0 (requirements.txt), check it when upgrading
+
+    Args:
+        request : resumable videos().insert request
+        ask (bool): ask the server first
+
+    """
+    request._in_error_state = ask
+
+def upload_video(youtube, media_file:str, request_body:dict, thumbnail: str=None, playlistID:str='', uplink=None, chunkMegabytes:int=8, ledger=None, extras:bool=True):
     """Uploads a video to YouTube; uses 1700 quota (1600 upload + 50 thumbnail + 50 playlist)
+        * the video is sent in chunks, transient errors are retried with backoff from where the server got to
+        * the resumable session is kept in log/uploads.json, an upload interrupted by a restart resumes without a new insert
+        * the upload quota is spent when the session is created (the insert), not again when it is resumed
 
     Args:
         youtube : youtube session
@@ -32,30 +122,109 @@ def upload_video(youtube, media_file:str, request_body:dict, thumbnail: str=None
         request_body (dict): document following YouTube format for upload
         thumbnail (str): path to thumbnail file
         playlistID (str): YouTube playlist ID to add video to (everything after https://www.youtube.com/playlist?list=)
+        uplink (UplinkMonitor): records the upload throughput, see TOOLS/uplink.py
+        chunkMegabytes (int): size of each upload request
+        ledger (QuotaLedger): records the quota spent, see TOOLS/quota.py
+        extras (bool): also set the thumbnail and add to the playlist (see upload_extras), False defers them to the caller
 
     Returns:
         responseID : successfully uploaded YouTube video ID
     """
+    fileSize = os.path.getsize(media_file)
 
     # Upload the video
     request = youtube.videos().insert(
         part="snippet,status",
         body=request_body,
-        media_body=googleapiclient.http.MediaFileUpload(media_file, chunksize=-1, resumable=True)
+        media_body=googleapiclient.http.MediaFileUpload(media_file, chunksize=chunkMegabytes*1024*1024, resumable=True)
     )
 
+    # continue an interrupted upload, asking the server how far it got first
+    if hasUploadSession(media_file):
+        request.resumable_uri = loadUploadSessions()[media_file]['uri']
+        askUploadProgress(request)
+        print(f"Resuming upload of {media_file}")
+
+    timeStart = time.perf_counter()
+    resumedFrom = None
+    bytesResent = 0
+    retries = 0
     response = None
     while response is None:
-        status, response = request.next_chunk()
+        progressBefore = request.resumable_progress
+        try:
+            status, response = request.next_chunk()
+        except googleapiclient.errors.HttpError as errorText:
+            # the session expired (about a week), start over
+            if (errorText.resp.status in [404, 410]) and (request.resumable_uri is not None):
+                print(f"Upload session of {media_file} expired, starting over")
+                saveUploadSession(media_file)
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                askUploadProgress(request, False)
+                continue
+            if not (errorText.resp.status in retryStatuses) or (retries >= maxRetries):
+                raise
+            retries += 1
+            bytesResent += min(request.resumable.chunksize(), fileSize - progressBefore)
+            askUploadProgress(request)
+            time.sleep(min(2**retries, 64) + random.random())
+            continue
+        except (ConnectionError, TimeoutError, OSError, httplib2.HttpLib2Error) as errorText:
+            if retries >= maxRetries:
+                raise
+            retries += 1
+            bytesResent += min(request.resumable.chunksize(), fileSize - progressBefore)
+            print(f"Upload interrupted ({errorText}), retry {retries} of {maxRetries}")
+            askUploadProgress(request)
+            time.sleep(min(2**retries, 64) + random.random())
+            continue
+
+        # keep the session once the server has handed it out, the insert is what costs quota
+        if request.resumable_uri is not None and not hasUploadSession(media_file):
+            saveUploadSession(media_file, request.resumable_uri)
+            if ledger != None:
+                ledger.spend(uploadCost, media_file)
+        if resumedFrom is None:
+            # the server's progress before the chunk this call sent (a finished upload does not move the progress past its last chunk)
+            resumedFrom = request.resumable_progress if response is not None else request.resumable_progress - request.resumable.chunksize()
         if status:
             print(f"Uploaded {int(status.progress() * 100)}%")
+
+    saveUploadSession(media_file)
+
+    if resumedFrom:
+        print(f"Resumed upload of {media_file} at {resumedFrom/2**20:.1f} MiB")
+    if retries:
+        print(f"Upload of {media_file} retried {retries} times, {bytesResent/2**20:.1f} MiB re-sent")
+
+    if uplink != None:
+        uplink.record(fileSize - (resumedFrom or 0) + bytesResent, time.perf_counter() - timeStart)
+    
+    if extras:
+        upload_extras(youtube, response['id'], thumbnail, playlistID, ledger)
     
+    return response['id']
+
+def upload_extras(youtube, videoID:str, thumbnail:str=None, playlistID:str='', ledger=None):
+    """Sets the thumbnail of an uploaded video and adds it to a playlist; uses 100 quota (50 thumbnail + 50 playlist)
+
+    Args:
+        youtube : youtube session
+        videoID (str): YouTube video ID
+        thumbnail (str): path to thumbnail file
+        playlistID (str): YouTube playlist ID to add video to (everything after https://www.youtube.com/playlist?list=)
+        ledger (QuotaLedger): records the quota spent, see TOOLS/quota.py
+
+    """
     if thumbnail != None:
         request = youtube.thumbnails().set(
-            videoId=response['id'],
+            videoId=videoID,
             media_body=googleapiclient.http.MediaFileUpload(thumbnail)
         )
         response_thumbnail = request.execute()
+        if ledger != None:
+            ledger.spend(thumbnailCost, f"thumbnail of {videoID}")
     
     if playlistID != '':
         request = youtube.playlistItems().insert(
@@ -65,14 +234,79 @@ def upload_video(youtube, media_file:str, request_body:dict, thumbnail: str=None
                     "playlistId": playlistID,
                     "resourceId": {
                         "kind": "youtube#video",
-                        "videoId": response['id']
+                        "videoId": videoID
                     }
                 }
             }
         )
         response_playlist = request.execute()
-    
-    return response['id']
+        if ledger != None:
+            ledger.spend(playlistCost, f"playlist entry of {videoID}")
+
+def upload_extras_batch(youtube, extrasList:list, ledger=None):
+    """Sets the thumbnails of several uploaded videos and adds them to their playlists, the playlist entries in one batch request
+        * thumbnails are media uploads, which the API does not allow in a batch, they are set one at a time
+        * a failed call only fails its own video, it is returned to be tried again
+        * a thumbnail the channel is not allowed to set (403 other than quota) is dropped, trying again would not help
+
+    Args:
+        youtube : youtube session
+        extrasList (list): [{'videoID': str, 'thumbnail': path or None, 'playlistID': str}, ...]
+        ledger (QuotaLedger): records the quota spent, see TOOLS/quota.py
+
+    Returns:
+        failed (list): extras of the calls that failed, without the parts that were done
+    """
+    failed = []
+
+    for extras in extrasList:
+        try:
+            upload_extras(youtube, extras['videoID'], extras['thumbnail'], '', ledger)
+        except googleapiclient.errors.HttpError as errorText:
+            print(f"unable to set thumbnail of {extras['videoID']}: {errorText}")
+            if (errorText.resp.status != 403) or (b'quotaExceeded' in errorText.content):
+                failed.append({'videoID': extras['videoID'], 'thumbnail': extras['thumbnail'], 'playlistID': ''})
+        except (OSError, httplib2.HttpLib2Error) as errorText:
+            print(f"unable to set thumbnail of {extras['videoID']}: {errorText}")
+            failed.append({'videoID': extras['videoID'], 'thumbnail': extras['thumbnail'], 'playlistID': ''})
+
+    answered = set()
+
+    def added(request_id, response, exception):
+        answered.add(request_id)
+        extras = extrasList[int(request_id)]
+        if exception is not None:
+            print(f"unable to add {extras['videoID']} to playlist: {exception}")
+            failed.append({'videoID': extras['videoID'], 'thumbnail': None, 'playlistID': extras['playlistID']})
+        elif ledger != None:
+            ledger.spend(playlistCost, f"playlist entry of {extras['videoID']}")
+
+    batch = youtube.new_batch_http_request(callback=added)
+    for i, extras in enumerate(extrasList):
+        if extras['playlistID'] != '':
+            batch.add(youtube.playlistItems().insert(
+                part="snippet",
+                body={
+                    "snippet": {
+                        "playlistId": extras['playlistID'],
+                        "resourceId": {
+                            "kind": "youtube#video",
+                            "videoId": extras['videoID']
+                        }
+                    }
+                }
+            ), request_id=str(i))
+
+    try:
+        batch.execute()
+    except (googleapiclient.errors.HttpError, OSError, httplib2.HttpLib2Error) as errorText:
+        # the entries without an answer are tried again
+        print(f"unable to add videos to playlists: {errorText}")
+        for i, extras in enumerate(extrasList):
+            if (extras['playlistID'] != '') and not(str(i) in answered):
+                failed.append({'videoID': extras['videoID'], 'thumbnail': None, 'playlistID': extras['playlistID']})
+
+    return failed
 
 def formatYouTubeTitle(matchID:str, event_title:str, year:int, replay:bool=False):
     """
@@ -0,0 +1,157 @@
+"""
+Single-pass batch render of a whole recorded event
+    * the recording is split once, sequentially and without re-encoding, at the edges of every match window
+    * each match window is handed off as soon as the pass gets past it, parts nobody needs are deleted right away
+    * headless: python -m TOOLS.batch CONFIG
+        * builds only, nothing is uploaded: the matches are left 'built' in log/ledger.db and sent by the next FRUIT run of the event (resume)
+"""
+
+import json         # CONFIG handling
+import os           # file IO
+import shutil       # scratch cleanup
+import subprocess   # running ffmpeg
+import sys          # command line (headless)
+import threading    # stop event (headless)
+
+from TOOLS.sources import FFMPEG_BINARY
+from TOOLS.sources import probeSource
+
+# split this long before a window so the part holding its start is short (longer than any GOP)
+windowMargin = 10
+
+# split long gaps between windows too, so no part holds more than this much unneeded video
+gapSplitSeconds = 5*60
+
+
+def planBoundaries(windows:list, duration:float):
+    """
+    Times to split the recording at so every window is covered by short parts
+
+    Args:
+        windows (list): [(start, end), ...] in seconds
+        duration (float): recording duration (seconds)
+
+    Returns:
+        list: sorted split times (seconds)
+    """
+    boundaries = set()
+    for windowStart, windowEnd in windows:
+        boundaries.add(max(windowStart - windowMargin, 0))
+        boundaries.add(windowEnd)
+
+    boundaries.update(range(gapSplitSeconds, int(duration), gapSplitSeconds))
+
+    return sorted(boundary for boundary in boundaries if 0 < boundary < duration)
+
+
+def renderBatch(filePath:str, windows:list, onWindow, scratchDir:str='output/scratch', stop_event=None):
+    """
+    Reads a recording once, handing over a small local copy of every window as soon as it has been read
+        * windows may overlap (a score segment running into the next match)
+        * window files are MPEG-TS, local time 0 is the start of the window file
+
+    Args:
+        filePath (str): path to recording
+        windows (list): [(start, end), ...] in seconds, one per match
+        onWindow: function(i, windowPath, windowStart) called once the i-th window file is ready, it owns the file
+        scratchDir (str): directory for parts and window files
+        stop_event: (bool) or threading.Event(), used to stop processing
+
+    Returns:
+        missing (list): indices of windows that are not inside the recording
+        unread (list): indices of windows that were not handed over (stopped, or ffmpeg failed)
+    """
+    duration = probeSource(filePath)['duration']
+    partsDir = os.path.join(scratchDir, 'batch')
+    shutil.rmtree(partsDir, ignore_errors=True)
+    os.makedirs(partsDir)
+
+    # windows that are waiting to be read, in order of their start
+    pending = sorted(range(len(windows)), key=lambda i: windows[i][0])
+    missing = [i for i in pending if windows[i][1] > duration]
+    pending = [i for i in pending if not(i in missing)]
+
+    # one sequential stream-copy pass, the segment muxer writes every part to the list (stdout) once it is complete
+    boundaries = planBoundaries([windows[i] for i in pending], duration)
+    process = subprocess.Popen([FFMPEG_BINARY, '-hide_banner', '-nostdin', '-v', 'error', '-i', filePath,
+                                '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+                                '-f', 'segment', '-segment_format', 'mpegts', '-segment_times', ','.join(f"{boundary:.3f}" for boundary in boundaries),
+                                '-segment_list', 'pipe:1', '-segment_list_type', 'csv', os.path.join(partsDir, 'part%06d.ts')],
+                               stdout=subprocess.PIPE, text=True)
+
+    parts = []      # [(path, start, end), ...] for parts that are complete and still needed
+    finished = False
+
+    while pending and not finished:
+        # a stop is noticed between parts, they are short (see gapSplitSeconds)
+        if stop_event is not None and stop_event.is_set():
+            break
+
+        # wait for the next part, the list ends with the pass
+        line = process.stdout.readline()
+        finished = not line
+        if finished:
+            process.wait()
+        else:
+            name, partStart, partEnd = line.strip().rsplit(',', 2)
+            parts.append((os.path.join(partsDir, name), float(partStart), float(partEnd)))
+
+        # the end of the last part is the end of what has been read so far, a failed pass did not get to the end
+        readUntil = duration if finished and (process.returncode == 0) else parts[-1][2] if parts else 0
+
+        # hand over every window that has been read completely
+        for i in [i for i in pending if windows[i][1] <= readUntil]:
+            windowParts = [part for part in parts if (part[2] > windows[i][0]) and (part[1] < windows[i][1])]
+            if not windowParts:
+                continue
+            windowPath = os.path.join(scratchDir, f'window{i:04}.ts')
+
+            # MPEG-TS parts join by appending their bytes
+            with open(windowPath, 'wb') as windowFile:
+                for partPath, partStart, partEnd in windowParts:
+                    with open(partPath, 'rb') as partFile:
+                        shutil.copyfileobj(partFile, windowFile)
+
+            pending.remove(i)
+            onWindow(i, windowPath, windowParts[0][1])
+
+        # drop parts that end before every window still waiting
+        neededFrom = min(windows[i][0] for i in pending) if pending else float('inf')
+        for part in [part for part in parts if part[2] <= neededFrom]:
+            os.remove(part[0])
+            parts.remove(part)
+
+    if process.poll() is None:
+        process.terminate()
+    process.wait()
+    process.stdout.close()
+    if finished and process.returncode != 0:
+        print(f"batch pass over {filePath} failed (ffmpeg exit code {process.returncode})")
+    shutil.rmtree(partsDir, ignore_errors=True)
+
+    return missing, pending
+
+
+if __name__ == '__main__':
+    from TOOLS.FMS import getFMSClient
+    from TOOLS.FMS import rewrapMatches
+    from TOOLS.process_queue import process_queue_build_batch
+    from TOOLS.process_queue import defaultBuild
+
+    if len(sys.argv) != 2:
+        print('usage: python -m TOOLS.batch CONFIG')
+        sys.exit(1)
+
+    with open(sys.argv[1], "r") as file:
+        CONFIG = json.load(file)
+    # same as FRUIT.py, for CONFIGs baked before a build setting existed
+    CONFIG['build'] = {**defaultBuild, **CONFIG.get('build', {})}
+    with open("CREDENTIALS", "r") as file:
+        CREDENTIALS = json.load(file)
+
+    os.makedirs('log/', exist_ok=True)
+
+    matchesRaw = getFMSClient(CONFIG['season']['year'], CONFIG['event']['code'], CONFIG['program'], CREDENTIALS[CONFIG['program']+'_username'], CREDENTIALS[CONFIG['program']+'_key']).poll()
+    matches = rewrapMatches(matchesRaw, CONFIG['program'])
+
+    process_queue_build_batch(CONFIG, threading.Event(), None, matches)
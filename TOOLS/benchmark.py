@@ -0,0 +1,365 @@
+"""
+Benchmarks for the build stage, run from the FRUIT folder:
+    * python -m TOOLS.benchmark engines recording.mp4
+    * python -m TOOLS.benchmark keyframes recording.mp4
+    * python -m TOOLS.benchmark batch recording.mp4
+    * python -m TOOLS.benchmark twitch VOD_ID
+    * python -m TOOLS.benchmark workers recording.mp4
+    * python -m TOOLS.benchmark profiles recording.mp4
+    * python -m TOOLS.benchmark capture
+"""
+
+import argparse     # command line
+import datetime     # streamlink timestamps
+import http.server  # live playlist stand-in
+import os           # file IO
+import random       # random lookups
+import tempfile     # capture directory
+import threading    # live playlist stand-in
+import time         # timing
+
+from TOOLS.batch import renderBatch
+from TOOLS.cutting import renderMatch
+from TOOLS.cutting import encodeProfiles
+from TOOLS.cutting import selectProfile
+from TOOLS.keyframes import KeyframeIndex
+from TOOLS.keyframes import scanPackets
+from TOOLS.keyframes import saveKeyframeIndex
+from TOOLS.keyframes import readKeyframeIndex
+from TOOLS.sources import probeSource
+from TOOLS.Twitch import downloadTwitchClip
+from TOOLS.Twitch import downloadTwitchSegments
+from TOOLS.capture import LiveCapture, assembleCapture
+
+# default timings from the Match Timing tab, in seconds
+season = {'secondsBeforeStart': 3+3.159, 'secondsOfMatch': 15+5+135, 'secondsAfterEnd': 5+3, 'secondsBeforePost': -8.06, 'secondsAfterPost': 25+8}
+
+
+def fakeSegments(count:int, firstStart:float=30, cycle:float=7*60, postDelay:float=200):
+    """
+    Match and score segments spaced like a real event, for recordings without FMS data
+
+    Args:
+        count (int): number of matches
+        firstStart (float): recording time (seconds) the first match starts at
+        cycle (float): seconds between match starts
+        postDelay (float): seconds between match start and score post
+
+    Returns:
+        list: [[(start, end) of match, (start, end) of score], ...]
+    """
+    segmentsList = []
+    for i in range(count):
+        secStart = firstStart + i*cycle
+        secPost = secStart + postDelay
+        segmentsList.append([(secStart - season['secondsBeforeStart'], secStart + season['secondsOfMatch'] + season['secondsAfterEnd']),
+                             (secPost - season['secondsBeforePost'], secPost + season['secondsAfterPost'])])
+
+    return segmentsList
+
+
+def benchmarkEngines(filePath:str, count:int, engines:list):
+    """
+    Renders the same matches with each cut engine and reports matches/hour
+
+    Args:
+        filePath (str): path to recording
+        count (int): number of matches to render per engine
+        engines (list): cut engines to compare
+
+    """
+    os.makedirs('output/benchmark', exist_ok=True)
+    segmentsList = fakeSegments(count)
+
+    results = {}
+    for engine in engines:
+        timeStart = time.perf_counter()
+        for i, segments in enumerate(segmentsList):
+            renderMatch(filePath, segments, f'output/benchmark/{engine}_{i}.mp4', engine)
+        results[engine] = time.perf_counter() - timeStart
+
+    print(f"{'engine':>10} {'seconds':>10} {'matches/hour':>14}")
+    for engine, seconds in results.items():
+        print(f"{engine:>10} {seconds:>10.1f} {3600*count/seconds:>14.1f}")
+
+
+def benchmarkKeyframes(filePath:str, lookups:int):
+    """
+    Times building, saving and loading a keyframe index, and keyframe and byte offset lookups against it
+
+    Args:
+        filePath (str): path to recording
+        lookups (int): number of random lookups to time
+
+    """
+    info = probeSource(filePath)
+
+    timeStart = time.perf_counter()
+    index = KeyframeIndex(*scanPackets(filePath, info['start']))
+    timeBuild = time.perf_counter() - timeStart
+
+    timeStart = time.perf_counter()
+    saveKeyframeIndex(filePath, index)
+    timeSave = time.perf_counter() - timeStart
+
+    timeStart = time.perf_counter()
+    index = readKeyframeIndex(filePath)
+    timeLoad = time.perf_counter() - timeStart
+
+    times = [random.uniform(0, info['duration']) for i in range(lookups)]
+    timeStart = time.perf_counter()
+    for seconds in times:
+        index.keyframeBefore(seconds)
+    timeLookup = time.perf_counter() - timeStart
+
+    timeStart = time.perf_counter()
+    for seconds in times:
+        index.offsetFor(seconds)
+    timeOffset = time.perf_counter() - timeStart
+
+    # later keyframes are further into the file
+    if index.offsetFor(info['duration']) is None:
+        print("no byte offsets, the index was built without ffprobe")
+    elif any(index.offsets[i] > index.offsets[i+1] for i in range(len(index)-1)):
+        print("keyframe byte offsets are not in time order")
+
+    print(f"{len(index)} keyframes in {info['duration']/3600:.2f} hours of video, index is {os.path.getsize(filePath+'.kfi')/1024:.1f} KiB")
+    print(f"build {timeBuild:.2f}s, save {timeSave*1000:.2f}ms, load {timeLoad*1000:.2f}ms, lookup {timeLookup/lookups*1e6:.2f}us, offset lookup {timeOffset/lookups*1e6:.2f}us")
+
+
+def benchmarkBatch(filePath:str, count:int, engine:str):
+    """
+    Renders the same matches seeking per match and from a single batch pass, and reports matches/hour
+
+    Args:
+        filePath (str): path to recording
+        count (int): number of matches to render
+        engine (str): cut engine to render with
+
+    """
+    os.makedirs('output/benchmark', exist_ok=True)
+    segmentsList = fakeSegments(count)
+
+    timeStart = time.perf_counter()
+    for i, segments in enumerate(segmentsList):
+        renderMatch(filePath, segments, f'output/benchmark/seek_{i}.mp4', engine)
+    timeSeek = time.perf_counter() - timeStart
+
+    def onWindow(i, windowPath, windowStart):
+        segments = [(segmentStart - windowStart, segmentEnd - windowStart) for segmentStart, segmentEnd in segmentsList[i]]
+        renderMatch(windowPath, segments, f'output/benchmark/batch_{i}.mp4', engine)
+        os.remove(windowPath)
+
+    timeStart = time.perf_counter()
+    windows = [(min(segment[0] for segment in segments), max(segment[1] for segment in segments)) for segments in segmentsList]
+    missing, unread = renderBatch(filePath, windows, onWindow, 'output/benchmark')
+    timeBatch = time.perf_counter() - timeStart
+
+    print(f"{'mode':>10} {'seconds':>10} {'matches/hour':>14}")
+    print(f"{'seek':>10} {timeSeek:>10.1f} {3600*count/timeSeek:>14.1f}")
+    print(f"{'batch':>10} {timeBatch:>10.1f} {3600*(count-len(missing)-len(unread))/timeBatch:>14.1f}")
+
+
+def benchmarkTwitch(vod_id:int, startSeconds:float, durationSeconds:float):
+    """
+    Downloads the same VOD range with the streamlink command and the native segment fetcher, and reports time-to-clip and bytes
+
+    Args:
+        vod_id (int): twitch VOD ID
+        startSeconds (float): start of the range in VOD time
+        durationSeconds (float): length of the range
+
+    """
+    os.makedirs('output/benchmark', exist_ok=True)
+
+    # the command is given the same 10 second padding build_match_live used to add
+    timeStart = time.perf_counter()
+    downloadTwitchClip(vod_id, str(datetime.timedelta(seconds=int(startSeconds//10)*10)), str(datetime.timedelta(seconds=(((startSeconds % 10 + durationSeconds)//10)+2)*10)), 'output/benchmark/streamlink.mp4')
+    timeCommand = time.perf_counter() - timeStart
+    bytesCommand = os.path.getsize('output/benchmark/streamlink.mp4')
+
+    timeStart = time.perf_counter()
+    clip = downloadTwitchSegments(vod_id, startSeconds, startSeconds + durationSeconds, 'output/benchmark/segments')
+    timeNative = time.perf_counter() - timeStart
+
+    print(f"{'fetcher':>10} {'seconds':>10} {'MiB':>10}")
+    print(f"{'streamlink':>10} {timeCommand:>10.1f} {bytesCommand/2**20:>10.1f}")
+    print(f"{'segments':>10} {timeNative:>10.1f} {clip['bytes']/2**20:>10.1f}")
+
+
+def benchmarkWorkers(filePath:str, engine:str, workersList:list):
+    """
+    Renders a single match with different numbers of encode processes and reports the wall time
+
+    Args:
+        filePath (str): path to recording
+        engine (str): cut engine to render with
+        workersList (list): numbers of encode processes to compare
+
+    """
+    os.makedirs('output/benchmark', exist_ok=True)
+    segments = fakeSegments(1)[0]
+
+    results = {}
+    for workers in workersList:
+        timeStart = time.perf_counter()
+        renderMatch(filePath, segments, f'output/benchmark/workers_{workers}.mp4', engine, 'output/scratch', (True, True), workers)
+        results[workers] = time.perf_counter() - timeStart
+
+    print(f"{'workers':>10} {'seconds':>10} {'speedup':>10}")
+    for workers, seconds in results.items():
+        print(f"{workers:>10} {seconds:>10.1f} {results[workersList[0]]/seconds:>10.2f}")
+
+
+def benchmarkProfiles(filePath:str, engine:str, profiles:list):
+    """
+    Renders the same match with each encode profile and reports encode fps and output size
+
+    Args:
+        filePath (str): path to reference recording
+        engine (str): cut engine to render with
+        profiles (list): encode profile names to compare
+
+    """
+    os.makedirs('output/benchmark', exist_ok=True)
+    segments = fakeSegments(1)[0]
+    frames = sum(segmentEnd - segmentStart for segmentStart, segmentEnd in segments) * probeSource(filePath)['fps']
+
+    print(f"{'profile':>10} {'seconds':>10} {'fps':>10} {'MiB':>10}")
+    for profile in profiles:
+        outputFileName = f'output/benchmark/profile_{profile}.mp4'
+        timeStart = time.perf_counter()
+        renderMatch(filePath, segments, outputFileName, engine, 'output/scratch', (True, True), 1, selectProfile({'profile': profile}))
+        seconds = time.perf_counter() - timeStart
+        print(f"{profile:>10} {seconds:>10.1f} {frames/seconds:>10.1f} {os.path.getsize(outputFileName)/2**20:>10.1f}")
+
+
+def benchmarkCapture(polls:int):
+    """
+    Polls a local stand-in for a Twitch live playlist, with stitched ads in it, and checks what the capture kept
+        * 3 new 2 second segments per poll, of every 20 segments 2 are ads titled Amazon and 2 are under an ad date range
+        * a match window around the first ad break is joined with assembleCapture
+
+    Args:
+        polls (int): number of polls
+
+    """
+    origin = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) - datetime.timedelta(seconds=6*polls)
+    state = {'poll': 0}
+
+    def isAd(sequence):
+        return 10 <= sequence % 20 < 14
+
+    class StandIn(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/live.m3u8':
+                first = 3*state['poll']
+                lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', f'#EXT-X-MEDIA-SEQUENCE:{first}']
+                for sequence in range(first, first+6):
+                    start = (origin + datetime.timedelta(seconds=2*sequence)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                    if sequence % 20 == 12:
+                        lines.append(f'#EXT-X-DATERANGE:ID="stitched-ad-{sequence}",CLASS="twitch-stitched-ad",START-DATE="{start}",DURATION=4.000')
+                    lines += [f'#EXT-X-PROGRAM-DATE-TIME:{start}', '#EXTINF:2.000,'+('Amazon|123' if sequence % 20 in (10, 11) else 'live'), f'segment/{sequence}.ts']
+                body = '\n'.join(lines).encode()
+            else:
+                sequence = int(self.path.split('/')[-1].split('.')[0])
+                body = (b'ad' if isAd(sequence) else b'live') + str(sequence).encode()
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as captureDir:
+        capture = LiveCapture(f'http://127.0.0.1:{server.server_port}/live.m3u8', captureDir)
+        timeStart = time.perf_counter()
+        for state['poll'] in range(polls):
+            capture.poll()
+        timePolls = time.perf_counter() - timeStart
+        server.shutdown()
+
+        contents = {}
+        for number, (name, start, duration, size, adSeconds) in capture.segments.items():
+            with open(os.path.join(captureDir, name), 'rb') as file:
+                contents[number] = file.read()
+
+        # segments 8 to 15 of the stream, 10 to 13 are the ad break
+        segments = list(capture.segments.values())
+        windowStart = segments[0][1] + datetime.timedelta(seconds=2*8)
+        try:
+            assembleCapture(windowStart, windowStart + datetime.timedelta(seconds=2*8), os.path.join(captureDir, 'match.ts'), captureDir, waitSeconds=0)
+            with open(os.path.join(captureDir, 'match.ts'), 'rb') as file:
+                joined = file.read()
+        except ValueError as errorText:
+            joined = str(errorText).encode()
+
+    ads = [content for content in contents.values() if content.startswith(b'ad')]
+    gaps = [previous for previous, segment in zip(segments, segments[1:]) if abs((segment[1] - previous[1]).total_seconds() - previous[2] - segment[4]) > 1]
+    expected = [sequence for sequence in range(3*polls+3) if not isAd(sequence)]
+    expectedJoined = b''.join(b'live'+str(sequence).encode() for sequence in range(8, 16) if not isAd(sequence))
+
+    print(f"{polls} polls, {len(segments)} segments kept of {len(expected)} live, {len(ads)} ads kept, {len(gaps)} gaps besides ad breaks, {1000*timePolls/polls:.1f} ms per poll")
+    if ads or gaps or (len(segments) != len(expected)):
+        print("capture kept ads or lost live segments")
+    if joined != expectedJoined:
+        print(f"match across an ad break joined wrong: {joined[:80]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FRUIT build stage benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parserEngines = subparsers.add_parser('engines', help='compare cut engines (matches/hour)')
+    parserEngines.add_argument('filePath', help='recording to cut matches from')
+    parserEngines.add_argument('--matches', type=int, default=5, help='matches to render per engine')
+    parserEngines.add_argument('--engines', default='moviepy,copy', help='comma-delimited cut engines')
+
+    parserKeyframes = subparsers.add_parser('keyframes', help='keyframe index build time, keyframe and byte offset lookup latency')
+    parserKeyframes.add_argument('filePath', help='recording to index')
+    parserKeyframes.add_argument('--lookups', type=int, default=100000, help='random lookups to time')
+
+    parserBatch = subparsers.add_parser('batch', help='per-match seeking vs a single batch pass (matches/hour)')
+    parserBatch.add_argument('filePath', help='recording to cut matches from')
+    parserBatch.add_argument('--matches', type=int, default=5, help='matches to render')
+    parserBatch.add_argument('--engine', default='copy', help='cut engine')
+
+    parserTwitch = subparsers.add_parser('twitch', help='streamlink command vs native segment fetcher (time-to-clip, bytes)')
+    parserTwitch.add_argument('vod_id', type=int, help='Twitch VOD ID')
+    parserTwitch.add_argument('--start', type=float, default=600, help='start of the clip in VOD time (seconds)')
+    parserTwitch.add_argument('--duration', type=float, default=250, help='length of the clip (seconds)')
+
+    parserWorkers = subparsers.add_parser('workers', help='single match wall time by encode processes per match')
+    parserWorkers.add_argument('filePath', help='recording to cut a match from')
+    parserWorkers.add_argument('--engine', default='moviepy', help='cut engine')
+    parserWorkers.add_argument('--workers', default='1,2,4,8', help='comma-delimited encode process counts')
+
+    parserProfiles = subparsers.add_parser('profiles', help='encode fps and output size by encode profile')
+    parserProfiles.add_argument('filePath', help='reference recording to cut a match from')
+    parserProfiles.add_argument('--engine', default='moviepy', help='cut engine')
+    parserProfiles.add_argument('--profiles', default=','.join(encodeProfiles), help='comma-delimited encode profiles')
+
+    parserCapture = subparsers.add_parser('capture', help='live capture polls against a local playlist stand-in with stitched ads (ads dropped, ms per poll)')
+    parserCapture.add_argument('--polls', type=int, default=20, help='playlist polls')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'engines':
+        benchmarkEngines(args.filePath, args.matches, args.engines.split(','))
+    elif args.benchmark == 'keyframes':
+        benchmarkKeyframes(args.filePath, args.lookups)
+    elif args.benchmark == 'batch':
+        benchmarkBatch(args.filePath, args.matches, args.engine)
+    elif args.benchmark == 'twitch':
+        benchmarkTwitch(args.vod_id, args.start, args.duration)
+    elif args.benchmark == 'workers':
+        benchmarkWorkers(args.filePath, args.engine, [int(workers) for workers in args.workers.split(',')])
+    elif args.benchmark == 'profiles':
+        benchmarkProfiles(args.filePath, args.engine, args.profiles.split(','))
+    elif args.benchmark == 'capture':
+        benchmarkCapture(args.polls)
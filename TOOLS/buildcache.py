@@ -0,0 +1,126 @@
+"""
+Cache of built match videos
+    * each output/<match>.mp4 gets a sidecar (output/<match>.build.json) with the hash of everything that went into it
+      (source, cut points, timing offsets, engine & encode settings) and its size & duration
+    * before building, a match whose sidecar has the same key and whose video still checks out is reused
+    * the check reads the MP4 box headers only (size, moov present, mvhd duration), no decode
+"""
+
+import datetime     # match times in keys
+import hashlib      # input keys
+import json         # sidecar files
+import os           # file IO
+import struct       # MP4 box headers
+
+from TOOLS.files import atomicWrite
+
+# how far the duration of the video may be off from its sidecar (seconds)
+durationTolerance = 0.5
+
+
+def buildKey(inputs:dict):
+    """
+    Hash of the inputs of a build
+
+    Args:
+        inputs (dict): everything that changes the video (datetimes allowed)
+
+    Returns:
+        str: hex digest
+    """
+    text = json.dumps(inputs, sort_keys=True, default=lambda value: value.isoformat() if isinstance(value, datetime.datetime) else str(value))
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def sidecarPath(outputFileName:str):
+    return os.path.splitext(outputFileName)[0] + '.build.json'
+
+def mp4Duration(filePath:str):
+    """
+    Duration of an MP4 from its movie header, without decoding
+
+    Args:
+        filePath (str): MP4 file
+
+    Returns:
+        float: seconds, None if the file has no (complete) movie header
+    """
+    try:
+        with open(filePath, 'rb') as file:
+            fileSize = os.fstat(file.fileno()).st_size
+            position = 0
+            end = fileSize
+
+            # walk the top level boxes to moov, then into it to mvhd
+            while position + 8 <= end:
+                file.seek(position)
+                size, boxType = struct.unpack('>I4s', file.read(8))
+                header = 8
+                if size == 1:
+                    size = struct.unpack('>Q', file.read(8))[0]
+                    header = 16
+                elif size == 0:
+                    size = end - position
+                if size < header or position + size > fileSize:
+                    return None
+
+                if boxType == b'moov':
+                    position, end = position + header, position + size
+                    continue
+
+                if boxType == b'mvhd':
+                    version = file.read(1)[0]
+                    file.read(3)
+                    if version == 1:
+                        file.read(16)
+                        timescale, duration = struct.unpack('>IQ', file.read(12))
+                    else:
+                        file.read(8)
+                        timescale, duration = struct.unpack('>II', file.read(8))
+                    return duration / timescale if timescale else None
+
+                position += size
+    except (OSError, struct.error, IndexError):
+        return None
+
+    return None
+
+def recordArtifact(outputFileName:str, key:str):
+    """
+    Writes the sidecar of a video that was just built
+
+    Args:
+        outputFileName (str): the video
+        key (str): see buildKey
+
+    """
+    # without a sidecar the video is only rebuilt, never lost
+    try:
+        artifact = {'key': key, 'bytes': os.path.getsize(outputFileName), 'duration': mp4Duration(outputFileName)}
+
+        atomicWrite(sidecarPath(outputFileName), json.dumps(artifact))
+    except OSError as errorText:
+        print(f"unable to record build of {outputFileName}: {errorText}")
+
+def validArtifact(outputFileName:str, key:str):
+    """
+    Whether a video was built from the same inputs and is still intact
+
+    Args:
+        outputFileName (str): the video
+        key (str): see buildKey
+
+    Returns:
+        bool
+    """
+    try:
+        with open(sidecarPath(outputFileName), 'r') as file:
+            artifact = json.load(file)
+        if (artifact['key'] != key) or (os.path.getsize(outputFileName) != artifact['bytes']):
+            return False
+    except (OSError, ValueError, KeyError):
+        return False
+
+    duration = mp4Duration(outputFileName)
+
+    return (duration is not None) and (artifact['duration'] is not None) and (abs(duration - artifact['duration']) <= durationTolerance)
@@ -0,0 +1,315 @@
+"""
+Rolling local capture of the live stream
+    * the live HLS playlist is polled and every new segment is saved to a ring buffer on disk
+    * ads Twitch stitches into the playlist are not saved, the index records how long each ad break was and matches are joined across it
+    * each segment is stamped with its wall-clock start (EXT-X-PROGRAM-DATE-TIME), the same clock as FMS
+    * segments are evicted once they are older than every match still to be built (and the size cap)
+    * segments of an earlier run are kept and re-indexed on start, matches not built before a restart still need them
+    * build workers read the index file (index.csv) and join the segments covering a match, see assembleCapture
+"""
+
+import collections  # ordered segments
+import csv          # capture index
+import datetime     # segment wall-clock times
+import io           # capture index
+import os           # file IO
+import re           # playlist attributes
+import shutil       # joining segments
+import threading    # capture thread
+import time         # polling
+from urllib.parse import urljoin
+
+import requests
+import streamlink
+
+from TOOLS.files import atomicWrite
+from TOOLS.httpclient import getClient
+
+# segments from before (now - retainSeconds) are kept only for matches that are still to be built
+retainSeconds = 15*60
+
+# Twitch stitches ads into the live playlist, marked by a date range of this class or an EXTINF title starting with this
+adClass = 'twitch-stitched-ad'
+adTitle = 'Amazon'
+
+
+def parseDateTime(text:str):
+    # same clock as FMS (device local time, no timezone)
+    return datetime.datetime.fromisoformat(text.replace('Z', '+00:00')).astimezone().replace(tzinfo=None)
+
+def parseAttributes(text:str):
+    # KEY=VALUE,KEY="VALUE, with commas",...
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+
+def parseLivePlaylist(text:str, url:str):
+    """
+    Reads the segments of a live HLS media playlist, marking the ads Twitch stitches in
+
+    Args:
+        text (str): playlist
+        url (str): playlist URL, segment URLs are relative to it
+
+    Returns:
+        (list, float): [(media sequence number, wall-clock start or None, duration, url, is an ad), ...], target duration
+    """
+    segments = []
+    sequence = 0
+    targetDuration = 2
+    duration = None
+    title = ''
+    programDateTime = None
+    # (start, end) wall-clock times of the stitched ads
+    adRanges = []
+
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':')[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            targetDuration = float(line.split(':')[1])
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            programDateTime = parseDateTime(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-DATERANGE:'):
+            attributes = parseAttributes(line.split(':', 1)[1])
+            if (attributes.get('CLASS') == adClass) and ('START-DATE' in attributes):
+                adStart = parseDateTime(attributes['START-DATE'])
+                adRanges.append((adStart, adStart + datetime.timedelta(seconds=float(attributes.get('DURATION', 0)))))
+        elif line.startswith('#EXTINF:'):
+            duration, title = (line[len('#EXTINF:'):].split(',', 1) + [''])[0:2]
+            duration = float(duration)
+        elif line and not line.startswith('#') and (duration is not None):
+            segments.append((sequence, programDateTime, duration, urljoin(url, line), title))
+            sequence += 1
+            duration = None
+            title = ''
+            programDateTime = None
+
+    # ads keep their media sequence numbers, the stream goes on after them
+    def isAd(start, title):
+        return title.startswith(adTitle) or ((start is not None) and any(adStart <= start < adEnd for adStart, adEnd in adRanges))
+
+    return [segment[0:4] + (isAd(segment[1], segment[4]),) for segment in segments], targetDuration
+
+
+class LiveCapture:
+    """
+    Records a live stream to a ring buffer of segments, runs as a thread of the main process
+        * source is a Twitch user name, or the URL of any live HLS playlist (a local stand-in server for testing)
+        * keepFrom is set by the build loop to the start of the oldest match still to be built
+    """
+
+    def __init__(self, source:str, captureDir:str='output/capture', maxBytes:int=4*2**30):
+        self.source = source
+        self.captureDir = captureDir
+        self.maxBytes = maxBytes
+        self.keepFrom = None
+        self.playlistURL = None
+        self.client = getClient('TwitchLive')
+
+        # segment number: (file name, wall-clock start, duration, bytes, seconds of ads left out just before it), numbers keep counting across restarts
+        self.segments = collections.OrderedDict()
+        # media sequence number of the newest segment saved, None until the first poll
+        self.lastSequence = None
+        # seconds of ads left out since the newest segment saved
+        self.adSeconds = 0
+
+        os.makedirs(captureDir, exist_ok=True)
+        for path, start, duration, adSeconds in readCaptureIndex(captureDir):
+            try:
+                self.segments[int(os.path.splitext(os.path.basename(path))[0])] = (os.path.basename(path), start, duration, os.path.getsize(path), adSeconds)
+            except (OSError, ValueError):
+                pass
+
+        # a segment saved just before a crash did not make it into the index
+        indexed = [segment[0] for segment in self.segments.values()]
+        for name in os.listdir(captureDir):
+            if name.endswith('.ts') and not(name in indexed):
+                os.remove(os.path.join(captureDir, name))
+
+        if self.segments:
+            # keep them all until the build loop says which matches are still to be built
+            self.keepFrom = next(iter(self.segments.values()))[1]
+            print(f"CAPTURE: kept {len(self.segments)} segments from {self.keepFrom:%H:%M:%S} of the last run")
+
+    def resolvePlaylist(self):
+        if self.source.startswith('http'):
+            return self.source
+
+        streams = streamlink.Streamlink().streams('https://www.twitch.tv/'+self.source)
+        if not('best' in streams):
+            raise ValueError(f"{self.source} is not live")
+
+        return streams['best'].url
+
+    def poll(self):
+        """
+        Downloads the segments that are new in the live playlist
+
+        Returns:
+            float: seconds to wait before polling again
+        """
+        if self.playlistURL is None:
+            self.playlistURL = self.resolvePlaylist()
+
+        # the playlist URL carries an access token that expires, errors resolve it again (see run)
+        response = self.client.get(self.playlistURL, timeout=10)
+        response.raise_for_status()
+
+        segments, targetDuration = parseLivePlaylist(response.text, response.url)
+        for sequence, start, duration, url, isAd in segments:
+            if (self.lastSequence is not None) and (sequence <= self.lastSequence):
+                continue
+
+            # ads are not saved, the next segment records the time they took (see assembleCapture)
+            if isAd:
+                if self.segments:
+                    self.adSeconds += duration
+                self.lastSequence = sequence
+                continue
+
+            # skip what the saved segments already cover (the first poll after a restart)
+            if self.segments and (start is not None):
+                previous = self.segments[next(reversed(self.segments))]
+                if start < previous[1] + datetime.timedelta(seconds=previous[2]/2):
+                    self.lastSequence = sequence
+                    continue
+
+            response = self.client.get(url)
+            response.raise_for_status()
+            content = response.content
+
+            # without a program date time, continue from the previous segment (or now)
+            if start is None:
+                if self.segments:
+                    previous = self.segments[next(reversed(self.segments))]
+                    start = previous[1] + datetime.timedelta(seconds=previous[2])
+                else:
+                    start = datetime.datetime.now() - datetime.timedelta(seconds=duration)
+
+            number = next(reversed(self.segments)) + 1 if self.segments else 0
+            name = f"{number}.ts"
+            with open(os.path.join(self.captureDir, name), 'wb') as file:
+                file.write(content)
+            self.segments[number] = (name, start, duration, len(content), self.adSeconds)
+            self.lastSequence = sequence
+            self.adSeconds = 0
+
+        self.evict()
+        self.saveIndex()
+
+        return targetDuration/2
+
+    def evict(self):
+        keepFrom = datetime.datetime.now() - datetime.timedelta(seconds=retainSeconds)
+        if self.keepFrom is not None:
+            keepFrom = min(keepFrom, self.keepFrom)
+
+        totalBytes = sum(segment[3] for segment in self.segments.values())
+        while self.segments:
+            number, (name, start, duration, size, adSeconds) = next(iter(self.segments.items()))
+
+            if start + datetime.timedelta(seconds=duration) >= keepFrom:
+                if totalBytes <= self.maxBytes:
+                    break
+                print(f"CAPTURE: over {self.maxBytes/2**20:.0f} MiB, dropping video from {start:%H:%M:%S} before it was built")
+
+            try:
+                os.remove(os.path.join(self.captureDir, name))
+            except OSError:
+                pass
+            totalBytes -= size
+            del self.segments[number]
+
+    def saveIndex(self):
+        # build workers may be reading it
+        text = io.StringIO()
+        writer = csv.writer(text)
+        for name, start, duration, size, adSeconds in self.segments.values():
+            writer.writerow([name, start.isoformat(), duration, adSeconds])
+        atomicWrite(os.path.join(self.captureDir, 'index.csv'), text.getvalue())
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                delay = self.poll()
+            except (requests.exceptions.RequestException, ValueError, streamlink.exceptions.StreamlinkError) as errorText:
+                print(f"CAPTURE: {errorText}")
+                self.playlistURL = None
+                delay = 5
+            # poll again once new segments are expected, a stop ends the wait
+            stop_event.wait(delay)
+
+    def start(self, stop_event):
+        threading.Thread(target=self.run, args=(stop_event,), daemon=True).start()
+
+
+def readCaptureIndex(captureDir:str='output/capture'):
+    """
+    Segments currently in the capture ring buffer
+
+    Args:
+        captureDir (str): capture directory
+
+    Returns:
+        list: [(path, wall-clock start, duration, seconds of ads left out just before it), ...] in stream order
+    """
+    try:
+        with open(os.path.join(captureDir, 'index.csv'), 'r', newline='') as file:
+            # indexes written before ads were recorded have 3 columns
+            return [(os.path.join(captureDir, row[0]), datetime.datetime.fromisoformat(row[1]), float(row[2]), float(row[3]) if len(row) > 3 else 0) for row in csv.reader(file)]
+    except OSError:
+        return []
+
+
+def assembleCapture(startTime:datetime.datetime, endTime:datetime.datetime, outputFileName:str, captureDir:str='output/capture', waitSeconds:float=60):
+    """
+    Joins the captured segments covering a wall-clock range into one MPEG-TS file, waiting for the end to be captured
+
+    Args:
+        startTime (datetime.datetime): start of the range
+        endTime (datetime.datetime): end of the range
+        outputFileName (str): location & name of output filepath (.ts)
+        captureDir (str): capture directory
+        waitSeconds (float): how long to wait for the end of the range to be captured
+
+    Returns:
+        datetime.datetime: wall-clock time of local time 0 of the file
+
+    Raises:
+        ValueError: range is not (or no longer) captured, or the capture has a gap in it that is not an ad break
+    """
+    deadline = time.monotonic() + waitSeconds
+    while True:
+        segments = readCaptureIndex(captureDir)
+        capturedUntil = segments[-1][1] + datetime.timedelta(seconds=segments[-1][2]) if segments else None
+        if (capturedUntil is not None) and (capturedUntil >= endTime):
+            break
+        if time.monotonic() > deadline:
+            raise ValueError(f"capture does not reach {endTime:%H:%M:%S} yet")
+
+        # the capture runs in the main process and this in a build worker, no event reaches across, so sleep for as long as it is behind
+        #   (at least a second) instead, usually once as a match is built after its end was captured
+        behind = (endTime - capturedUntil).total_seconds() if capturedUntil is not None else 1
+        time.sleep(min(max(behind, 1), max(deadline - time.monotonic(), 0)))
+
+    segments = [segment for segment in segments if (segment[1] + datetime.timedelta(seconds=segment[2]) > startTime) and (segment[1] < endTime)]
+
+    if (not segments) or (segments[0][1] > startTime):
+        raise ValueError(f"capture no longer holds {startTime:%H:%M:%S}")
+
+    # a gap the length of the ads left out there is joined across, the file keeps the stream's timestamps
+    for previous, segment in zip(segments, segments[1:]):
+        if abs((segment[1] - previous[1]).total_seconds() - previous[2] - segment[3]) > 1:
+            raise ValueError(f"capture has a gap at {previous[1]:%H:%M:%S}")
+
+    # MPEG-TS segments join by appending their bytes
+    try:
+        with open(outputFileName, 'wb') as outputFile:
+            for path, start, duration, adSeconds in segments:
+                with open(path, 'rb') as segmentFile:
+                    shutil.copyfileobj(segmentFile, outputFile)
+    except OSError as errorText:
+        raise ValueError(f"capture segment evicted while reading: {errorText}")
+
+    return segments[0][1]
@@ -0,0 +1,365 @@
+import concurrent.futures  # parallel ffmpeg processes
+import os           # file IO
+import shutil       # scratch cleanup
+import tempfile     # scratch directories
+
+from moviepy.editor import concatenate_videoclips
+from moviepy.audio.fx.all import audio_fadeout, audio_fadein
+
+from TOOLS.sources import runFFMPEG
+from TOOLS.sources import openSource
+
+# encoders used to re-encode the head/tail of a segment, must match the source codec so the pieces join
+reencodeCodec = {'h264': 'libx264', 'hevc': 'libx265'}
+
+# encoder profiles for the profile names ffmpeg reports for the source (see probeSource), same reason
+reencodeProfile = {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high', 'Progressive High': 'high',
+                   'Constrained High': 'high', 'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444', 'Main 10': 'main10'}
+
+# audio fades (seconds) applied to the start of the match segment and the end of the score segment
+fadeInSeconds = 0.5
+fadeOutSeconds = 2
+
+# named encode profiles, CONFIG['build']['profiles'] may add to or override them
+#   codec/preset/crf: x264/x265 settings (bitrate, if set, replaces crf)
+#   threads: encoder threads, 0 lets the encoder decide
+#   faststart: put the index (moov) at the front so YouTube can start processing while it uploads
+encodeProfiles = {'realtime': {'codec': 'libx264', 'preset': 'ultrafast', 'crf': 28, 'bitrate': None, 'threads': 0, 'faststart': True},
+                  'balanced': {'codec': 'libx264', 'preset': 'medium', 'crf': 23, 'bitrate': None, 'threads': 0, 'faststart': True},
+                  'archive': {'codec': 'libx264', 'preset': 'slow', 'crf': 18, 'bitrate': None, 'threads': 0, 'faststart': True}}
+
+# profile used by 'auto' while the build queue is short, and once it is longer than CONFIG['build']['autoQueueDepth']
+autoProfiles = ('balanced', 'realtime')
+
+# longest chunk (seconds) a segment is split into when a match is encoded by several processes
+chunkSeconds = 30
+
+
+def planPieces(segmentStart:float, segmentEnd:float, keyframes:list, fps:float):
+    """
+    Splits a segment into pieces that are either re-encoded or stream-copied
+
+        * [start, first keyframe) is re-encoded
+        * [first keyframe, last keyframe) is copied
+        * [last keyframe, end) is re-encoded
+
+    Args:
+        segmentStart (float): segment start (seconds)
+        segmentEnd (float): segment end (seconds)
+        keyframes (list): keyframe times within the segment
+        fps (float): frame rate, pieces shorter than a frame are dropped
+
+    Returns:
+        list: [('encode' or 'copy', start, end), ...]
+    """
+    if len(keyframes) < 2:
+        return [('encode', segmentStart, segmentEnd)]
+
+    pieces = [('encode', segmentStart, keyframes[0]), ('copy', keyframes[0], keyframes[-1]), ('encode', keyframes[-1], segmentEnd)]
+
+    return [piece for piece in pieces if (piece[2] - piece[1]) >= 1/fps]
+
+
+def selectProfile(buildConfig:dict, queueDepth:int=0):
+    """
+    Encode profile to build the next match with
+
+    Args:
+        buildConfig (dict): CONFIG['build'], 'profile' is a profile name or 'auto'
+        queueDepth (int): matches waiting to be built
+
+    Returns:
+        dict: encode profile, with its 'name'
+    """
+    profiles = {**encodeProfiles, **buildConfig.get('profiles', {})}
+    name = buildConfig.get('profile', 'balanced')
+
+    # drop to a faster profile while the queue is backed up
+    if name == 'auto':
+        name = autoProfiles[1] if queueDepth > buildConfig.get('autoQueueDepth', 3) else autoProfiles[0]
+
+    if not (name in profiles):
+        raise ValueError(f"Invalid input: {name}, must be one of {list(profiles)} or 'auto'.")
+
+    return {**encodeProfiles['balanced'], **profiles[name], 'name': name}
+
+
+def videoEncodeArgs(encode:dict):
+    """
+    ffmpeg arguments for the quality and threading of an encode profile (codec, and faststart, are up to the caller)
+    """
+    quality = ['-b:v', str(encode['bitrate'])] if encode['bitrate'] else ['-crf', str(encode['crf'])]
+
+    return ['-preset', encode['preset']] + quality + ['-threads', str(encode['threads'])]
+
+
+def sourceEncodeArgs(info:dict):
+    """
+    ffmpeg arguments that encode a piece with the pixel format, profile and level of the source stream, so it joins the copied pieces
+    """
+    arguments = []
+    if info.get('pixFmt'):
+        arguments += ['-pix_fmt', info['pixFmt']]
+    if info.get('profile') in reencodeProfile:
+        arguments += ['-profile:v', reencodeProfile[info['profile']]]
+
+    # level_idc is 10x the level for H.264, 30x for HEVC
+    if info.get('level') and (info['videoCodec'] == 'h264'):
+        arguments += ['-level', f"{info['level']/10:.1f}"]
+    elif info.get('level') and (info['videoCodec'] == 'hevc'):
+        arguments += ['-x265-params', f"level-idc={info['level']/30:.1f}"]
+
+    return arguments
+
+
+def renderMoviepy(filePath:str, segments:list, outputFileName:str, scratchDir:str='output/scratch', fades:tuple=(True, True), encode:dict=None):
+    """
+    Creates a match video by decoding and re-encoding every frame with moviepy
+
+    Args:
+        filePath (str): path to source video
+        segments (list): [(start, end) of match, (start, end) of score] in seconds
+        outputFileName (str): location & name of output filepath
+        scratchDir (str): directory for the temporary audio file
+        fades (tuple): (fade in the first segment, fade out the last segment)
+        encode (dict): encode profile, see selectProfile
+
+    """
+    encode = encode or selectProfile({})
+    os.makedirs(scratchDir, exist_ok=True)
+    source = openSource(filePath)
+
+    with source.lock:
+        video = source.clip
+
+        # clip the match and the scores, adding audio fades to taste
+        clips = [video.subclip(*segment) for segment in segments]
+        if fades[0]:
+            clips[0] = audio_fadein(clips[0], fadeInSeconds)
+        if fades[1]:
+            clips[-1] = audio_fadeout(clips[-1], fadeOutSeconds)
+
+        # merge together match and scores
+        final = concatenate_videoclips(clips)
+
+        # save the results as a file
+        final.write_videofile(outputFileName, codec=encode['codec'], audio_codec='aac', temp_audiofile=os.path.join(scratchDir, os.path.basename(outputFileName)+'.m4a'),
+                              preset=encode['preset'], bitrate=encode['bitrate'], threads=encode['threads'] or None,
+                              ffmpeg_params=([] if encode['bitrate'] else ['-crf', str(encode['crf'])]) + (['-movflags', '+faststart'] if encode['faststart'] else []))
+
+
+def renderAudio(filePath:str, segments:list, audioPath:str, fades:tuple=(True, True)):
+    """
+    Encodes the audio of all segments at once, with the fades
+
+    Args:
+        filePath (str): path to source video
+        segments (list): [(start, end), ...] in seconds
+        audioPath (str): location & name of output audio file (.m4a)
+        fades (tuple): (fade in the first segment, fade out the last segment)
+
+    """
+    audioArgs = []
+    for segmentStart, segmentEnd in segments:
+        audioArgs += ['-ss', f"{segmentStart:.6f}", '-t', f"{segmentEnd-segmentStart:.6f}", '-i', filePath]
+
+    audioFilter = ''
+    for i, (segmentStart, segmentEnd) in enumerate(segments):
+        audioFades = []
+        if (i == 0) and fades[0]:
+            audioFades.append(f"afade=t=in:d={fadeInSeconds}")
+        if (i == len(segments)-1) and fades[1]:
+            audioFades.append(f"afade=t=out:st={max(segmentEnd-segmentStart-fadeOutSeconds, 0):.6f}:d={fadeOutSeconds}")
+        audioFilter += f"[{i}:a]{','.join(audioFades) or 'anull'}[a{i}];"
+    audioFilter += ''.join(f"[a{i}]" for i in range(len(segments))) + f"concat=n={len(segments)}:v=0:a=1[a]"
+
+    runFFMPEG(audioArgs + ['-filter_complex', audioFilter, '-map', '[a]', '-c:a', 'aac', audioPath])
+
+
+def muxPieces(piecePaths:list, audioPath:str, outputFileName:str, workDir:str, faststart:bool=True, timescale:int=None):
+    """
+    Joins video pieces through the concat demuxer and adds the audio, no re-encoding
+
+    Args:
+        piecePaths (list): paths of the video pieces, in order
+        audioPath (str): path of the audio for all pieces
+        outputFileName (str): location & name of output filepath
+        workDir (str): directory for the piece list
+        faststart (bool): put the index at the front of the file
+        timescale (int): video track timescale of the output, None for the muxer's default
+
+    """
+    listPath = os.path.join(workDir, 'pieces.txt')
+    with open(listPath, 'w') as file:
+        for piecePath in piecePaths:
+            file.write(f"file '{os.path.abspath(piecePath)}'\n")
+
+    runFFMPEG(['-f', 'concat', '-safe', '0', '-i', listPath, '-i', audioPath, '-map', '0:v', '-map', '1:a', '-c', 'copy'] + (['-movflags', '+faststart'] if faststart else [])
+              + (['-video_track_timescale', str(timescale)] if timescale else []) + [outputFileName])
+
+
+def renderCopy(filePath:str, segments:list, outputFileName:str, scratchDir:str='output/scratch', fades:tuple=(True, True), workers:int=1, encode:dict=None):
+    """
+    Creates a match video by stream-copying whole GOPs and only re-encoding around the cut points
+        * video pieces are cut to MPEG-TS so they can be joined by the container
+        * re-encoded pieces take the pixel format, profile and level of the source, so the decoder sees one stream
+        * audio is cheap, so it is re-encoded in one go with the fades
+        * pieces (and the audio) are separate ffmpeg processes, run up to workers of them at once
+
+    Args:
+        filePath (str): path to source video
+        segments (list): [(start, end) of match, (start, end) of score] in seconds
+        outputFileName (str): location & name of output filepath
+        scratchDir (str): directory for intermediate pieces
+        fades (tuple): (fade in the first segment, fade out the last segment)
+        workers (int): ffmpeg processes to run at once
+        encode (dict): encode profile for the re-encoded pieces (the codec always follows the source), see selectProfile
+
+    Raises:
+        ValueError: segment is outside the video or the video codec cannot be re-encoded to match
+    """
+    encode = encode or selectProfile({})
+    source = openSource(filePath)
+    info = source.info
+
+    if not (info['videoCodec'] in reencodeCodec):
+        raise ValueError(f"cannot stream-copy {info['videoCodec']} video")
+
+    for segmentStart, segmentEnd in segments:
+        if (segmentStart < 0) or (segmentEnd > info['duration']) or (segmentStart >= segmentEnd):
+            raise ValueError(f"segment ({segmentStart}, {segmentEnd}) is outside of video duration {info['duration']}")
+
+    os.makedirs(scratchDir, exist_ok=True)
+    workDir = tempfile.mkdtemp(dir=scratchDir)
+
+    try:
+        # cut every segment into pieces, copying whole GOPs and re-encoding the rest
+        piecePaths = []
+        jobs = []
+        for segmentStart, segmentEnd in segments:
+            keyframes = source.keyframesBetween(segmentStart, segmentEnd)
+
+            for mode, pieceStart, pieceEnd in planPieces(segmentStart, segmentEnd, keyframes, info['fps']):
+                piecePath = os.path.join(workDir, f"{len(piecePaths):03}.ts")
+
+                if mode == 'copy':
+                    # nudge past the keyframe so rounding never seeks to the previous GOP
+                    jobs.append((runFFMPEG, ['-ss', f"{pieceStart+0.001:.6f}", '-i', filePath, '-t', f"{pieceEnd-pieceStart:.6f}", '-map', '0:v:0', '-c:v', 'copy', piecePath]))
+                else:
+                    jobs.append((runFFMPEG, ['-ss', f"{pieceStart:.6f}", '-i', filePath, '-t', f"{pieceEnd-pieceStart:.6f}", '-map', '0:v:0', '-c:v', reencodeCodec[info['videoCodec']]] + videoEncodeArgs(encode) + sourceEncodeArgs(info) + [piecePath]))
+
+                piecePaths.append(piecePath)
+
+        audioPath = os.path.join(workDir, 'audio.m4a')
+        jobs.append((renderAudio, filePath, segments, audioPath, fades))
+
+        # the work happens in ffmpeg processes, threads are enough to run them side by side
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(*job) for job in jobs]:
+                future.result()
+
+        # the copied pieces keep the timestamps of the source, keep its timescale too
+        muxPieces(piecePaths, audioPath, outputFileName, workDir, encode['faststart'], info.get('timescale'))
+
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def renderMoviepyParallel(filePath:str, segments:list, outputFileName:str, scratchDir:str='output/scratch', fades:tuple=(True, True), workers:int=2, encode:dict=None):
+    """
+    Creates a match video by re-encoding every frame, as renderMoviepy does, in chunks encoded by several ffmpeg processes at once
+        * chunks are video only and joined without re-encoding, the audio is encoded once with the fades
+        * the ffmpeg processes are driven from threads (see renderCopy), a build worker never starts processes of its own
+          that would keep it from being recycled
+
+    Args:
+        filePath (str): path to source video
+        segments (list): [(start, end) of match, (start, end) of score] in seconds
+        outputFileName (str): location & name of output filepath
+        scratchDir (str): directory for intermediate chunks
+        fades (tuple): (fade in the first segment, fade out the last segment)
+        workers (int): ffmpeg processes to run at once
+        encode (dict): encode profile, see selectProfile
+
+    """
+    encode = encode or selectProfile({})
+
+    # split long segments into chunks of at most chunkSeconds, without leaving a sliver at the end
+    chunks = []
+    for segmentStart, segmentEnd in segments:
+        chunkStart = segmentStart
+        while chunkStart < segmentEnd:
+            chunkEnd = chunkStart + chunkSeconds if (segmentEnd - chunkStart) >= 1.5*chunkSeconds else segmentEnd
+            chunks.append((chunkStart, chunkEnd))
+            chunkStart = chunkEnd
+
+    os.makedirs(scratchDir, exist_ok=True)
+    workDir = tempfile.mkdtemp(dir=scratchDir)
+
+    try:
+        # the encoders running side by side share the cores, instead of each taking all of them
+        chunkEncode = {**encode, 'threads': encode['threads'] or max((os.cpu_count() or 1)//workers, 1)}
+
+        chunkPaths = [os.path.join(workDir, f"{i:03}.mp4") for i in range(len(chunks))]
+        jobs = [(runFFMPEG, ['-ss', f"{chunkStart:.6f}", '-i', filePath, '-t', f"{chunkEnd-chunkStart:.6f}", '-map', '0:v:0', '-c:v', encode['codec']] + videoEncodeArgs(chunkEncode) + [chunkPath])
+                for (chunkStart, chunkEnd), chunkPath in zip(chunks, chunkPaths)]
+
+        audioPath = os.path.join(workDir, 'audio.m4a')
+        jobs.append((renderAudio, filePath, segments, audioPath, fades))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(*job) for job in jobs]:
+                future.result()
+
+        muxPieces(chunkPaths, audioPath, outputFileName, workDir, encode['faststart'])
+
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def renderMatch(filePath:str, segments:list, outputFileName:str, engine:str='moviepy', scratchDir:str='output/scratch', fades:tuple=(True, True), workers:int=1, encode:dict=None):
+    """
+    Creates a match video from a match segment and a score segment
+
+    Args:
+        filePath (str): path to source video
+        segments (list): [(start, end) of match, (start, end) of score] in seconds
+        outputFileName (str): location & name of output filepath
+        engine (str): 'moviepy' (full re-encode) or 'copy' (stream-copy with re-encoded cut points)
+        scratchDir (str): directory for intermediate files
+        fades (tuple): (fade in the first segment, fade out the last segment), off when building a video in parts
+        workers (int): ffmpeg processes for this match, 1 encodes it in this process
+        encode (dict): encode profile, see selectProfile (default 'balanced')
+
+    """
+    if engine == 'copy':
+        renderCopy(filePath, segments, outputFileName, scratchDir, fades, workers, encode)
+    elif (engine == 'moviepy') and (workers > 1):
+        renderMoviepyParallel(filePath, segments, outputFileName, scratchDir, fades, workers, encode)
+    elif engine == 'moviepy':
+        renderMoviepy(filePath, segments, outputFileName, scratchDir, fades, encode)
+    else:
+        raise ValueError(f"Invalid input: {engine}, must be 'moviepy' or 'copy'.")
+
+
+def joinParts(partPaths:list, outputFileName:str, scratchDir:str='output/scratch'):
+    """
+    Joins videos rendered separately from the same source with the same engine, without re-encoding
+
+    Args:
+        partPaths (list): paths of the parts, in order
+        outputFileName (str): location & name of output filepath
+        scratchDir (str): directory for the part list
+
+    """
+    os.makedirs(scratchDir, exist_ok=True)
+    listPath = os.path.join(scratchDir, os.path.basename(outputFileName)+'.txt')
+
+    with open(listPath, 'w') as file:
+        for partPath in partPaths:
+            file.write(f"file '{os.path.abspath(partPath)}'\n")
+
+    try:
+        runFFMPEG(['-f', 'concat', '-safe', '0', '-i', listPath, '-c', 'copy', '-movflags', '+faststart', outputFileName])
+    finally:
+        os.remove(listPath)
@@ -0,0 +1,23 @@
+"""
+File helpers shared by the TOOLS modules
+    * state files (ledgers, indexes, caches) are rewritten whole, other workers and a crash must only ever see a complete file
+"""
+
+import os           # file IO
+import threading    # temporary file names
+
+
+def atomicWrite(path:str, data):
+    """
+    Replaces a file with new contents in one step: written to a temporary file next to it, then renamed over it
+
+    Args:
+        path (str): file to write
+        data (str or bytes): new contents, str is written as text
+
+    """
+    # one temporary file per writer, several processes (build workers) and threads (send workers) write the same files
+    tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmpPath, 'wb' if isinstance(data, bytes) else 'w', newline='' if isinstance(data, str) else None) as file:
+        file.write(data)
+    os.replace(tmpPath, path)
@@ -0,0 +1,146 @@
+"""
+Shared HTTP clients for the external APIs (FMS, Twitch, TBA)
+    * one pooled keep-alive session per service, created on first use in each process
+    * every call has a timeout, 5xx/429 responses and connection errors are retried with exponential backoff
+    * each service is rate limited to a minimum interval between requests
+    * latency, retries and errors of every call are counted per service, see report
+"""
+
+import random       # backoff jitter
+import threading    # clients are shared between threads
+import time         # rate limits, backoff & latency
+
+import requests
+
+# service: settings, see ServiceClient
+serviceSettings = {
+    'FMS':        {'minInterval': 0.5, 'timeout': (5, 30), 'retries': 3, 'poolSize': 4},
+    'Twitch':     {'minInterval': 0.1, 'timeout': (5, 30), 'retries': 3, 'poolSize': 4},
+    'TwitchVOD':  {'minInterval': 0,   'timeout': (5, 30), 'retries': 3, 'poolSize': 8},
+    'TwitchLive': {'minInterval': 0,   'timeout': (5, 30), 'retries': 1, 'poolSize': 4},
+    'TBA':        {'minInterval': 1,   'timeout': (5, 30), 'retries': 3, 'poolSize': 2},
+}
+
+# responses worth retrying
+retryStatuses = [429, 500, 502, 503, 504]
+
+# longest wait between retries (seconds)
+maxBackoff = 30
+
+
+class ServiceClient:
+    """
+    Pooled session of one service, with timeouts, retries, a rate limit and latency counters
+    """
+
+    def __init__(self, name:str, minInterval:float=0, timeout=(5, 30), retries:int=3, poolSize:int=4):
+        self.name = name
+        self.minInterval = minInterval
+        self.timeout = timeout
+        self.retries = retries
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.lock = threading.Lock()
+        self.nextSlot = 0
+        self.stats = {'calls': 0, 'retries': 0, 'errors': 0, 'seconds': 0, 'maxSeconds': 0}
+
+    def waitForSlot(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.nextSlot, now)
+            self.nextSlot = slot + self.minInterval
+        time.sleep(slot - now)
+
+    def count(self, seconds:float, error:bool=False):
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['seconds'] += seconds
+            self.stats['maxSeconds'] = max(self.stats['maxSeconds'], seconds)
+            if error:
+                self.stats['errors'] += 1
+
+    def request(self, method:str, url:str, **kwargs):
+        """
+        Makes a request, retrying 5xx/429 responses and connection errors
+
+        Args:
+            method (str): 'GET', 'POST', ...
+            url (str): URL
+            **kwargs: passed on to requests (headers, data, json, params, timeout, ...)
+
+        Returns:
+            response (requests.Response): the last response, which may still be an error status
+
+        Raises:
+            requests.exceptions.RequestException: connection errors and timeouts, after the last retry
+        """
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    self.stats['retries'] += 1
+
+            self.waitForSlot()
+            timeStart = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as errorText:
+                self.count(time.perf_counter() - timeStart, error=True)
+                if attempt == self.retries:
+                    raise
+                print(f"{self.name}: {errorText}, retry {attempt+1} of {self.retries}")
+                time.sleep(min(2**attempt, maxBackoff) + random.random())
+                continue
+
+            self.count(time.perf_counter() - timeStart, error=response.status_code >= 400)
+            if not(response.status_code in retryStatuses) or (attempt == self.retries):
+                return response
+
+            # the server may say how long to wait
+            try:
+                delay = float(response.headers.get('Retry-After', ''))
+            except ValueError:
+                delay = 2**attempt + random.random()
+            print(f"{self.name}: {response.status_code} from {url.split('?')[0]}, retry {attempt+1} of {self.retries}")
+            time.sleep(min(delay, maxBackoff))
+
+    def get(self, url:str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url:str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+clients = {}
+clientsLock = threading.Lock()
+
+def getClient(name:str):
+    """
+    Shared client of a service, created on first use
+
+    Args:
+        name (str): service, one of serviceSettings
+
+    Returns:
+        client (ServiceClient)
+    """
+    with clientsLock:
+        if not(name in clients):
+            clients[name] = ServiceClient(name, **serviceSettings[name])
+
+        return clients[name]
+
+def report():
+    """
+    Prints calls, latency, retries and errors of every service used by this process
+    """
+    with clientsLock:
+        for name, client in clients.items():
+            stats = dict(client.stats)
+            if stats['calls']:
+                print(f"HTTP {name}: {stats['calls']} calls, {1000*stats['seconds']/stats['calls']:.0f} ms mean, {1000*stats['maxSeconds']:.0f} ms max, {stats['retries']} retries, {stats['errors']} errors")
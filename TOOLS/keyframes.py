@@ -0,0 +1,223 @@
+import array        # compact keyframe tables
+import bisect       # keyframe lookups
+import os           # file IO
+import shutil       # finding ffprobe
+import struct       # sidecar header
+import subprocess   # running ffprobe/ffmpeg
+import sys          # byte order
+import time         # waiting for another worker's scan
+
+from TOOLS.files import atomicWrite
+from TOOLS.sources import FFMPEG_BINARY
+
+# sidecar layout: header, then count float64 keyframe times, then count int64 byte offsets (little-endian)
+indexMagic = b'FRUITKFI'
+indexVersion = 1
+indexHeader = struct.Struct('<8sIqdI')  # magic, version, file size, file mtime, count
+
+# a worker finding no index waits for another one already scanning the video, unless its lock is older than this (seconds)
+scanLockSeconds = 60*60
+
+# ffprobe is optional (imageio-ffmpeg does not ship it), it reports byte offsets, ffmpeg does not
+FFPROBE_BINARY = shutil.which('ffprobe') or shutil.which(os.path.join(os.path.dirname(FFMPEG_BINARY), os.path.basename(FFMPEG_BINARY).replace('ffmpeg', 'ffprobe')))
+
+
+class KeyframeIndex:
+    """
+    Keyframe times and byte offsets of a video, backed by arrays
+        * times are seconds from the start of the video (the same clock as moviepy and ffmpeg -ss)
+        * offsets are -1 when the index was built without ffprobe
+    """
+
+    def __init__(self, times:array.array, offsets:array.array):
+        self.times = times
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.times)
+
+    def keyframeBefore(self, seconds:float):
+        """
+        Nearest keyframe at or before a time, None if there is not one
+        """
+        i = bisect.bisect_right(self.times, seconds)
+
+        return self.times[i-1] if i > 0 else None
+
+    def keyframeAfter(self, seconds:float):
+        """
+        Nearest keyframe at or after a time, None if there is not one
+        """
+        i = bisect.bisect_left(self.times, seconds)
+
+        return self.times[i] if i < len(self.times) else None
+
+    def between(self, startSeconds:float, endSeconds:float):
+        """
+        Keyframe times within [startSeconds, endSeconds]
+        """
+        return list(self.times[bisect.bisect_left(self.times, startSeconds):bisect.bisect_right(self.times, endSeconds)])
+
+    def offsetFor(self, seconds:float):
+        """
+        Byte offset to start reading from to decode a time (offset of the keyframe at or before it)
+            * 0 before the first keyframe, None when the index was built without ffprobe
+        """
+        i = bisect.bisect_right(self.times, seconds)
+        if i == 0:
+            return 0
+
+        return self.offsets[i-1] if self.offsets[i-1] >= 0 else None
+
+
+def scanPackets(filePath:str, startSeconds:float=0):
+    """
+    Streams the keyframe times and byte offsets of a video without decoding frames
+
+    Args:
+        filePath (str): path to video file
+        startSeconds (float): container start time, subtracted from ffprobe timestamps
+
+    Returns:
+        (array.array, array.array): keyframe times (seconds), byte offsets
+    """
+    times = array.array('d')
+    offsets = array.array('q')
+
+    if FFPROBE_BINARY:
+        process = subprocess.Popen([FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,pos,flags', '-of', 'csv=p=0', filePath], stdout=subprocess.PIPE, text=True)
+        for line in process.stdout:
+            ptsTime, pos, flags = line.strip().split(',')[0:3]
+            if ('K' in flags) and (ptsTime != 'N/A'):
+                times.append(float(ptsTime) - startSeconds)
+                offsets.append(int(pos) if pos != 'N/A' else -1)
+    else:
+        # packets are stream-copied into a framecrc listing, keyframes are the lines without flags
+        process = subprocess.Popen([FFMPEG_BINARY, '-hide_banner', '-nostdin', '-v', 'error', '-i', filePath, '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'], stdout=subprocess.PIPE, text=True)
+        timebase = 1
+        for line in process.stdout:
+            if line.startswith('#tb 0:'):
+                numerator, denominator = line.split(':')[1].strip().split('/')
+                timebase = int(numerator)/int(denominator)
+            elif not line.startswith('#') and not ('F=' in line):
+                times.append(int(line.split(',')[2])*timebase)
+                offsets.append(-1)
+
+    if process.wait() != 0:
+        raise ValueError(f"unable to read keyframes from {filePath}")
+
+    # packets arrive in decode order
+    if any(times[i] > times[i+1] for i in range(len(times)-1)):
+        pairs = sorted(zip(times, offsets))
+        times = array.array('d', [pair[0] for pair in pairs])
+        offsets = array.array('q', [pair[1] for pair in pairs])
+
+    return times, offsets
+
+
+def saveKeyframeIndex(filePath:str, index:KeyframeIndex):
+    """
+    Writes a keyframe index next to its video (<video>.kfi)
+
+    Args:
+        filePath (str): path to video file
+        index (KeyframeIndex): index of the video
+
+    """
+    stat = os.stat(filePath)
+    times = array.array('d', index.times)
+    offsets = array.array('q', index.offsets)
+    if sys.byteorder != 'little':
+        times.byteswap()
+        offsets.byteswap()
+
+    # other workers may be reading it
+    atomicWrite(filePath+'.kfi', indexHeader.pack(indexMagic, indexVersion, stat.st_size, stat.st_mtime, len(times)) + times.tobytes() + offsets.tobytes())
+
+
+def readKeyframeIndex(filePath:str):
+    """
+    Reads the keyframe index of a video if it is still valid for the file
+
+    Args:
+        filePath (str): path to video file
+
+    Returns:
+        KeyframeIndex or None
+    """
+    stat = os.stat(filePath)
+
+    try:
+        with open(filePath+'.kfi', 'rb') as file:
+            magic, version, size, mtime, count = indexHeader.unpack(file.read(indexHeader.size))
+            if (magic != indexMagic) or (version != indexVersion) or (size != stat.st_size) or (mtime != stat.st_mtime):
+                return None
+
+            times = array.array('d')
+            offsets = array.array('q')
+            times.fromfile(file, count)
+            offsets.fromfile(file, count)
+    except (OSError, EOFError, struct.error):
+        return None
+
+    if sys.byteorder != 'little':
+        times.byteswap()
+        offsets.byteswap()
+
+    return KeyframeIndex(times, offsets)
+
+
+def loadKeyframeIndex(filePath:str, startSeconds:float=0):
+    """
+    Returns the keyframe index of a video, building and saving it if missing or stale
+        * only one process scans a video (<video>.kfi.lock), the others wait for its index
+
+    Args:
+        filePath (str): path to video file
+        startSeconds (float): container start time (see probeSource)
+
+    Returns:
+        KeyframeIndex
+    """
+    index = readKeyframeIndex(filePath)
+    if index is not None:
+        return index
+
+    lockPath = filePath+'.kfi.lock'
+    while True:
+        try:
+            os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            pass
+        except OSError:
+            # no lock next to the video (read-only directory), scan anyway
+            lockPath = None
+            break
+
+        time.sleep(1)
+        index = readKeyframeIndex(filePath)
+        if index is not None:
+            return index
+
+        # the scanning process died
+        try:
+            if time.time() - os.path.getmtime(lockPath) > scanLockSeconds:
+                os.remove(lockPath)
+        except OSError:
+            pass
+
+    try:
+        # another process may have finished while this one waited for the lock
+        index = readKeyframeIndex(filePath)
+        if index is None:
+            index = KeyframeIndex(*scanPackets(filePath, startSeconds))
+            try:
+                saveKeyframeIndex(filePath, index)
+            except OSError as errorText:
+                print(f"unable to save keyframe index of {filePath}: {errorText}")
+    finally:
+        if lockPath is not None:
+            os.remove(lockPath)
+
+    return index
@@ -0,0 +1,200 @@
+"""
+Job ledger of every match the pipeline has seen, in SQLite (log/ledger.db)
+    * one row per match2str with its state: early, seen, building, built, uploading, sent (or skipped, failed)
+    * every change is a transaction, a crash leaves each match in its last state
+    * on restart the unfinished matches are queued again at the stage they were in, see process_queue.resume
+    * replaces log/seek.txt, log/early.txt and log/send.txt (send.txt is imported once, see importSendLog)
+"""
+
+import datetime     # match times and timings
+import json         # match data
+import os           # ledger directory
+import sqlite3      # the ledger
+import threading    # shared between the pipeline threads
+
+# state: column holding when the match reached it
+stateTimes = {'seen': 'seenAt', 'built': 'builtAt', 'sent': 'sentAt'}
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    matchString TEXT PRIMARY KEY,
+    event TEXT NOT NULL,
+    state TEXT NOT NULL,
+    match TEXT,
+    artifact TEXT,
+    videoID TEXT,
+    tbaKey TEXT,
+    tbaPosted INTEGER DEFAULT 0,
+    seenAt TEXT,
+    builtAt TEXT,
+    sentAt TEXT,
+    buildSeconds REAL,
+    sendSeconds REAL,
+    updatedAt TEXT
+);
+CREATE INDEX IF NOT EXISTS jobsEventState ON jobs (event, state);
+CREATE INDEX IF NOT EXISTS jobsEventTBA ON jobs (event, tbaKey);
+"""
+
+
+def encodeMatch(match:dict):
+    return json.dumps({key: (value.isoformat() if isinstance(value, datetime.datetime) else value) for key, value in match.items()})
+
+def decodeMatch(text:str):
+    match = json.loads(text)
+    for key in ('start', 'post'):
+        if match.get(key) != None:
+            match[key] = datetime.datetime.fromisoformat(match[key])
+
+    return match
+
+
+class JobLedger:
+    """
+    State of every match by match2str, shared by the seek, build and send threads
+    """
+
+    def __init__(self, ledgerPath:str='log/ledger.db'):
+        self.ledgerPath = ledgerPath
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def db(self):
+        # opened on first use, the log directory is created at startup
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.ledgerPath) or '.', exist_ok=True)
+            self.connection = sqlite3.connect(self.ledgerPath, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(schema)
+
+        return self.connection
+
+    def claim(self, matches:list, matchStrings:list, event:str, state:str='seen'):
+        """
+        Adds matches that are new to the ledger, in one transaction
+
+        Args:
+            matches (list): match data dictionaries
+            matchStrings (list): match2str of each match
+            event (str): FMS event code
+            state (str): 'seen', or 'early' for matches built before their score is posted
+
+        Returns:
+            list: the matches that were added (or promoted from early to seen), to be queued
+        """
+        claimed = []
+        now = datetime.datetime.now().isoformat()
+
+        with self.lock, self.db() as connection:
+            for match, matchString in zip(matches, matchStrings):
+                row = connection.execute('SELECT state, match FROM jobs WHERE matchString = ?', (matchString,)).fetchone()
+
+                if row is None:
+                    connection.execute('INSERT INTO jobs (matchString, event, state, match, seenAt, updatedAt) VALUES (?, ?, ?, ?, ?, ?)',
+                                       (matchString, event, state, encodeMatch(match), now, now))
+                    claimed.append(match)
+                elif (state == 'seen') and ((row[0] == 'early') or ((row[0] == 'failed') and (decodeMatch(row[1]).get('post') is None))):
+                    # the score of a match built early was posted (failed early builds are retried as whole matches)
+                    connection.execute('UPDATE jobs SET state = ?, match = ?, seenAt = ?, updatedAt = ? WHERE matchString = ?',
+                                       ('seen', encodeMatch(match), now, now, matchString))
+                    claimed.append(match)
+
+        return claimed
+
+    def transition(self, matchString:str, state:str, **fields):
+        """
+        Moves a match to a new state
+
+        Args:
+            matchString (str): see match2str
+            state (str): new state
+            **fields: other columns to set (artifact, videoID, tbaKey, buildSeconds, sendSeconds)
+
+        """
+        now = datetime.datetime.now().isoformat()
+        fields['state'] = state
+        fields['updatedAt'] = now
+        if state in stateTimes:
+            fields[stateTimes[state]] = now
+
+        with self.lock, self.db() as connection:
+            connection.execute(f"UPDATE jobs SET {', '.join(key+' = ?' for key in fields)} WHERE matchString = ?", list(fields.values()) + [matchString])
+
+    def markPosted(self, event:str, tbaKeys:list):
+        """
+        Records match videos posted to The Blue Alliance
+
+        Args:
+            event (str): FMS event code
+            tbaKeys (list): TBA match keys, see translateMatchString
+
+        """
+        with self.lock, self.db() as connection:
+            connection.executemany('UPDATE jobs SET tbaPosted = 1 WHERE event = ? AND tbaKey = ?', [(event, tbaKey) for tbaKey in tbaKeys])
+
+    def unfinished(self, event:str):
+        """
+        Matches of an event that were not sent, in match order
+
+        Args:
+            event (str): FMS event code
+
+        Returns:
+            list: [(state, match), ...]
+        """
+        with self.lock:
+            rows = self.db().execute("SELECT state, match FROM jobs WHERE event = ? AND state NOT IN ('sent', 'skipped') AND match IS NOT NULL", (event,)).fetchall()
+
+        return sorted([(state, decodeMatch(match)) for state, match in rows], key=lambda row: row[1]['start'])
+
+    def counts(self, event:str):
+        """
+        Number of matches of an event in each state
+
+        Args:
+            event (str): FMS event code
+
+        Returns:
+            dict: {state: count}
+        """
+        with self.lock:
+            return dict(self.db().execute('SELECT state, COUNT(*) FROM jobs WHERE event = ? GROUP BY state', (event,)).fetchall())
+
+    def videoOf(self, matchString:str):
+        """
+        YouTube video ID of a match that was uploaded
+
+        Args:
+            matchString (str): see match2str
+
+        Returns:
+            str: video ID, None if the match was not uploaded
+        """
+        with self.lock:
+            row = self.db().execute('SELECT videoID FROM jobs WHERE matchString = ?', (matchString,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def importSendLog(self, event:str, sendPath:str='log/send.txt'):
+        """
+        Adds the matches of an event sent before the ledger existed, once
+
+        Args:
+            event (str): FMS event code
+            sendPath (str): send log of earlier versions
+
+        """
+        if self.counts(event) or not os.path.exists(sendPath):
+            return
+
+        with open(sendPath, 'r') as file:
+            matchStrings = [line.strip() for line in file if line.startswith(event+'_')]
+
+        now = datetime.datetime.now().isoformat()
+        with self.lock, self.db() as connection:
+            connection.executemany('INSERT OR IGNORE INTO jobs (matchString, event, state, sentAt, updatedAt) VALUES (?, ?, ?, ?, ?)',
+                                   [(matchString, event, 'sent', now, now) for matchString in matchStrings])
+
+        if matchStrings:
+            print(f"LEDGER: imported {len(matchStrings)} sent matches from {sendPath}")
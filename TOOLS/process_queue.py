@@ -2,80 +2,587 @@ import queue #queues
 import time #waiting
 import datetime #datetime math
 import threading #multiprocess
-import math #ceil for Twitch segments
 import os #checking if a file exists
-
-from moviepy.editor import VideoFileClip, concatenate_videoclips
-from moviepy.audio.fx.all import audio_fadeout, audio_fadein
+import shutil #clearing scratch directories
+import collections #ordered pending builds
+import concurrent.futures #build worker processes
+import itertools #queue order
+import json #early part settings
+import requests #VOD list errors
+import httplib2 #upload errors
+import googleapiclient.errors #upload errors
 
 from TOOLS.Twitch import getLatestTwitchVODs
 from TOOLS.Twitch import durationStr2Sec
-from TOOLS.Twitch import downloadTwitchClip
+from TOOLS.Twitch import downloadTwitchSegments
 
-from TOOLS.FMS import getMatchesFromFMS
+from TOOLS.FMS import getFMSClient
 from TOOLS.FMS import rewrapMatches
+from TOOLS.FMS import estimateNextPost
+from TOOLS.httpclient import report as reportHTTP
 
-from TOOLS.logging import listNotInLog
+from TOOLS.ledger import JobLedger
 from TOOLS.logging import match2str
 
+from TOOLS.cutting import renderMatch
+from TOOLS.cutting import joinParts
+from TOOLS.cutting import selectProfile
+from TOOLS.uplink import UplinkMonitor
+from TOOLS.batch import renderBatch
+from TOOLS.sources import openSource
+from TOOLS.sources import closeSource
+from TOOLS.segmentcache import SegmentCache
+from TOOLS.buildcache import buildKey
+from TOOLS.buildcache import validArtifact
+from TOOLS.buildcache import recordArtifact
+from TOOLS.capture import LiveCapture
+from TOOLS.capture import assembleCapture
+
 from TOOLS.thumbnails import generateThumbnail
 from TOOLS.YouTube import formatYouTubeTitle
 from TOOLS.YouTube import upload_video
+from TOOLS.YouTube import hasUploadSession
+from TOOLS.YouTube import upload_extras_batch
+from TOOLS.quota import QuotaLedger
+from TOOLS.quota import nextReset
+from TOOLS.quota import uploadCost
+from TOOLS.quota import thumbnailCost
+from TOOLS.quota import playlistCost
 from TOOLS.TBA import translateMatchString
-from TOOLS.TBA import postTheBlueAlliance
+from TOOLS.TBA import TBAPublisher
 
 # determine local timezone
 device_timezone = datetime.datetime.now().astimezone().tzinfo
 #event_timezone = datetime.timezone(datetime.timedelta(seconds=2*60*60), 'Israel Standard Time')
 
-# Define the queues
-queue_build = queue.Queue()
-queue_send = queue.Queue()
+# finals first, then playoffs, then quals (what people are watching, and quota may run out before the end of the day)
+levelRank = {'F': 0, 'M': 1, 'P': 1, 'Q': 2}
+
+# a match waiting longer than this goes ahead of everything but bumped matches (seconds)
+starvationSeconds = 30*60
+
+# matches moved to the front of both queues from the GUI, by (event code, match ID), until they are settled (see bump)
+bumped = set()
+
+class MatchQueue(queue.Queue):
+    """
+    Queue of matches handed out by priority, recomputed on every get
+        1. bumped matches
+        2. matches waiting longer than starvationSeconds, oldest first
+        3. by level (levelRank), then matches still within deadlineSeconds of their score post by nearest deadline,
+           then the ones past it newest first (a backlog after an outage does not hold up what is being watched)
+    Events take turns within each level, the one served least recently goes first (see pipelines)
+    Matches of a held event (its video source is not ready yet) stay queued but are not handed out, see hold
+    Bounded by maxsize, not counting held matches: offer waits for room (backpressure), requeue never waits
+    Consumers block in take until a match is due, changed is set whenever a match is queued or handed out
+    """
+
+    def __init__(self, name:str, deadlineSeconds:float=15*60, changed=None):
+        self.name = name
+        self.deadlineSeconds = deadlineSeconds
+        self.changed = changed if changed is not None else threading.Event()
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.order = itertools.count()
+        # events not handed out, and the turn each event was last served at
+        self.held = set()
+        self.turns = itertools.count()
+        self.lastServed = {}
+        # waits of the matches handed out, by level
+        self.waits = {'F': [], 'P': [], 'Q': []}
+
+    def _qsize(self):
+        return len([entry for entry in self.queue if not(entry[2]['event'] in self.held)])
+
+    def _put(self, match, dueAt:float=0):
+        self.queue.append((time.monotonic(), next(self.order), match, dueAt))
+        self.changed.set()
+
+    def due(self, now:float):
+        # matches that can be handed out now, a match put back with a delay is not due until then (see requeue)
+        return [entry for entry in self.queue if not(entry[2]['event'] in self.held) and entry[3] <= now]
+
+    def rank(self, entry, now:float):
+        enqueued, order, match, dueAt = entry
+        if (match['event'], match['id']) in bumped:
+            return (-2, order, 0)
+        if now - enqueued >= starvationSeconds:
+            return (-1, enqueued, order)
+
+        turn = self.lastServed.get(match['event'], -1)
+        deadline = ((match['post'] or match['start']) + datetime.timedelta(seconds=self.deadlineSeconds)).timestamp()
+        if time.time() <= deadline:
+            return (levelRank.get(match['id'][0], 2), 0, turn, deadline, order)
+        return (levelRank.get(match['id'][0], 2), 1, turn, -deadline, order)
+
+    def _get(self):
+        now = time.monotonic()
+        entry = min(self.due(now), key=lambda entry: self.rank(entry, now))
+        self.queue.remove(entry)
+        self.lastServed[entry[2]['event']] = next(self.turns)
+        self.changed.set()
+
+        level = {0: 'F', 1: 'P'}.get(levelRank.get(entry[2]['id'][0], 2), 'Q')
+        self.waits[level].append(now - entry[0])
+        if sum(len(waits) for waits in self.waits.values()) % 10 == 0:
+            self.report()
+
+        return entry[2]
+
+    def take(self, stop_event, block:bool=True):
+        """
+        Hands out the next match, waiting until one is due
+
+        Args:
+            stop_event: threading.Event(), used to stop processing (see wakeOnStop)
+            block (bool): wait for a match
+
+        Returns:
+            dict: match, None once stopped (or when none is due and block is False)
+        """
+        with self.not_empty:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if self.due(now):
+                    match = self._get()
+                    self.not_full.notify()
+                    return match
+                if not block:
+                    return None
+
+                # wait for a put, or for the next match put back with a delay
+                self.not_empty.wait(self.secondsToDue(now))
+
+        return None
+
+    def secondsToDue(self, now:float):
+        # until the next match put back with a delay is due, None if there is not one (see requeue)
+        later = [entry[3] for entry in self.queue if not(entry[2]['event'] in self.held) and entry[3] > now]
+
+        return min(later) - now if later else None
+
+    def nextDue(self):
+        """
+        Seconds until the next match put back with a delay is due, None if there is not one
+        """
+        with self.mutex:
+            return self.secondsToDue(time.monotonic())
+
+    def offer(self, match:dict, stop_event):
+        """
+        Queues a match, waiting while the queue is full; once stopped it does not wait (the ledger has the match)
+
+        Args:
+            match (dict): match data dictionary
+            stop_event: threading.Event(), used to stop processing (see wakeOnStop)
+
+        """
+        with self.not_full:
+            while (self.maxsize > 0) and (self._qsize() >= self.maxsize) and not stop_event.is_set():
+                self.not_full.wait()
+            self._put(match)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def requeue(self, match:dict, delaySeconds:float=0):
+        """
+        Puts a match (back) without waiting for room: retries, and matches resumed from the ledger
+
+        Args:
+            match (dict): match data dictionary
+            delaySeconds (float): not handed out before this many seconds
+
+        """
+        with self.mutex:
+            self._put(match, time.monotonic() + delaySeconds)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def wake(self):
+        # wakes every thread waiting on the queue, see wakeOnStop
+        with self.mutex:
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+            self.changed.set()
+
+    def matches(self):
+        """
+        Matches waiting (held ones included), in no particular order
+        """
+        with self.mutex:
+            return [entry[2] for entry in self.queue]
+
+    def hold(self, event:str):
+        """
+        Stops handing out the matches of an event, until release
+
+        Args:
+            event (str): FMS event code
+        
+        """
+        with self.mutex:
+            self.held.add(event)
+
+    def release(self, event:str):
+        with self.mutex:
+            self.held.discard(event)
+            self.not_empty.notify_all()
+            self.changed.set()
+
+    def report(self):
+        classes = [f"{level} median {sorted(waits)[len(waits)//2]:.0f}s max {max(waits):.0f}s (n={len(waits)})" for level, waits in self.waits.items() if waits]
+        print(f"QUEUE {self.name}: waited "+', '.join(classes))
+
+# Define the queues, the build pool waits on queueChanged for either to move (see process_queue_build_pool)
+queueChanged = threading.Event()
+queue_build = MatchQueue('build', changed=queueChanged)
+queue_send = MatchQueue('send', changed=queueChanged)
+
+# set when the send workers leave thumbnail/playlist calls for the metadata stage, they wait in the quota ledger (see process_queue_metadata)
+metadataReady = threading.Event()
+
+# seconds the metadata stage waits for more videos to batch with, and the most it batches at once
+metadataWait = 5
+metadataBatch = 50
+
+# event pipelines of this instance by FMS event code, sharing the queues, build pool, send workers and quota, see addPipeline
+pipelines = {}
+
+# seconds between VOD list refreshes, see watch
+watchSeconds = 15*60
+
+# the build pool takes no new builds while this many videos wait to be sent, or the output disk has less free space (MiB)
+#   the send queue holds at most sendBacklog videos, and the build queue buildBacklog matches (seek waits for room)
+sendBacklog = 10
+buildBacklog = 50
+minFreeMegabytes = 2048
+
+# build settings of the Build tab before anything is changed, for CONFIGs baked before a setting existed (FRUIT.py and python -m TOOLS.batch)
+defaultBuild = {'engine': 'moviepy', 'workers': max(1, (os.cpu_count() or 2)//2), 'recycleAfter': 10, 'batch': False,
+                'cacheMegabytes': 2048, 'early': False, 'encodeWorkers': 1, 'profile': 'balanced', 'autoQueueDepth': 3,
+                'uploadBudget': 240, 'deadline': 900, 'sendBacklog': sendBacklog, 'buildBacklog': buildBacklog, 'minFreeMegabytes': minFreeMegabytes}
+
+# scratch directory and VOD segment cache of this build worker process, see initBuildWorker
+scratchDir = 'output/scratch'
+segmentCache = None
+
+# upload throughput, drives the bitrate of upcoming builds (see withProfile)
+uplink = UplinkMonitor()
+
+# state of every match, see TOOLS/ledger.py
+jobLedger = JobLedger()
+
+# YouTube quota spent per Pacific day, shared by the send workers (see TOOLS/quota.py)
+quotaLedger = QuotaLedger()
+
+# the GUI counters are incremented from several threads
+counterLock = threading.Lock()
+
+# seconds from score post to sent, for every match sent this run, see logLatency
+latencies = []
+
+# seconds each match spent in the send stage this run, see process_queue_send
+sendSeconds = []
 
-VODs = {}
+# seek polling: fast around an expected score post, at most seekMaxSeconds apart otherwise (breaks, end of day), see seekDelay
+seekFastSeconds = 10
+seekLeadSeconds = 15
+seekOverdueSeconds = 60
+seekMaxSeconds = 300
+
+# a match its VOD does not reach yet is built again after this long (Twitch adds to a live VOD every few seconds to minutes)
+buildRetrySeconds = 60
+
+# seek backoff while FMS is not reachable, doubling up to seekMaxSeconds
+seekErrorSeconds = 15
+
+# seconds from score post to first seen by seek, for matches posted this run
+discoveryLags = {}
+
+# build worker processes shared by the events of this instance and the threads using them, see acquireBuildPool
+buildPool = None
+buildPoolUsers = 0
+buildPoolLock = threading.Lock()
+
+# VOD segment cache use of the current event, summed over all build workers
+cacheStats = {'hits': 0, 'misses': 0, 'bytesSaved': 0}
+
+def wakeOnStop(stop_event):
+    """
+    Wakes the threads waiting on the queues once stop_event is set, they wait without timeouts
+
+    Args:
+        stop_event: threading.Event(), used to stop processing
+
+    """
+    def wake():
+        stop_event.wait()
+        queue_build.wake()
+        queue_send.wake()
+        metadataReady.set()
+
+    threading.Thread(target=wake, daemon=True).start()
 
 def incrementCountText(textObject):
-    textLabel = textObject.text()[0:7]
-    value = int(textObject.text()[7:])
-    textObject.setText(textLabel+str(value+1))
+    # headless runs have no GUI counters
+    if textObject is None:
+        return
+    with counterLock:
+        textLabel = textObject.text()[0:7]
+        value = int(textObject.text()[7:])
+        textObject.setText(textLabel+str(value+1))
 
-def watch(twitch_user_id:str, stop_event, CREDENTIALS, latestVODs:dict=VODs):
+def addPipeline(user_data:dict):
     """
-    Checks for new VODs on a Twitch channel
+    Registers an event with this instance, its matches are held in the build queue until its video source is ready
 
     Args:
-        twitch_user_id (str): User ID of a Twitch channel
+        user_data (dict): user inputs from FRUIT GUI (CONFIG) of the event
+
+    Returns:
+        dict: {'config', 'VODs', 'vodsFound', 'capture', 'publisher', 'prepareJob', 'describeSource'}
+    """
+    pipelines[user_data['event']['code']] = {'config': user_data,
+                                             'VODs': {},                         # details of VODs found, see watch
+                                             'vodsFound': threading.Event(),     # set once watch has found a VOD
+                                             'capture': None,                    # rolling capture of the live stream, see capture
+                                             'publisher': None,                  # buffered match videos for The Blue Alliance, see publish
+                                             'prepareJob': None,                 # function(match, jobData) returning the (worker function, *args) that builds it, set by its source thread
+                                             'describeSource': None}             # function(match) returning what the match is cut from, part of its build cache key (see buildInputs)
+    queue_build.hold(user_data['event']['code'])
+
+    # bumps last for one run, a match left over from the last one is queued again by resume at its own priority
+    for key in [key for key in list(bumped) if key[0] == user_data['event']['code']]:
+        bumped.discard(key)
+
+    return pipelines[user_data['event']['code']]
+
+def pipelineOf(match:dict):
+    # matches carry the FMS event code they were queued for
+    return pipelines[match['event']]
+
+def eventMatches(user_data:dict, CREDENTIALS:dict, stop_event):
+    """
+    Posted matches of an event from FMS, for the events added without loading them in the GUI
+        * asks again with a backoff while FMS is not reachable, a stop returns the matches of the snapshot
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        CREDENTIALS (dict)
+        stop_event: threading.Event(), used to stop processing
+
+    Returns:
+        list: match data dictionaries
+    """
+    fms = getFMSClient(user_data['season']['year'], user_data['event']['code'], user_data['program'], CREDENTIALS[user_data['program']+'_username'], CREDENTIALS[user_data['program']+'_key'])
+    errorDelay = seekErrorSeconds
+    matchesRaw = None
+    while (matchesRaw is None) and not stop_event.is_set():
+        try:
+            matchesRaw = fms.poll()
+        except (requests.exceptions.RequestException, ValueError, KeyError) as errorText:
+            print(f"FMS: {user_data['event']['code']} not available ({errorText}), trying again in {errorDelay} s")
+            stop_event.wait(errorDelay)
+            errorDelay = min(2*errorDelay, seekMaxSeconds)
+    if matchesRaw is None:
+        matchesRaw = fms.matches()
+
+    matches = rewrapMatches(matchesRaw, user_data['program'])
+    for match in matches:
+        match['event'] = user_data['event']['code']
+
+    return matches
+
+def watch(user_data:dict, stop_event, CREDENTIALS):
+    """
+    Checks for new VODs on the Twitch channel of an event, in a thread of its own until stopped
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
         stop_event: (bool) or threading.Event(), used to stop processing
-        latestVODs (dict): details of VODs found
 
     """
-    if stop_event.is_set():
-        return
-    
-    # get the latest VODs for a user ID (pagination ignored)
-    new_VODs_list = getLatestTwitchVODs(CREDENTIALS['Twitch_clientID'], CREDENTIALS['Twitch_clientSecret'], twitch_user_id)
-
-    # covert information into more useable form
-    new_VODs = {}
-    for vod in new_VODs_list:
-        created_at_datetime = datetime.datetime.fromisoformat(vod['created_at'])
-        vod['created_at'] =  created_at_datetime.astimezone(device_timezone).replace(tzinfo=None)
-        vod['duration'] = durationStr2Sec(vod['duration'])
-        new_VODs[vod['id']] = vod
-    
-    newIDs = [vodID for vodID in new_VODs.keys() if not(vodID in VODs.keys())]
-    if newIDs:
-        print('New VODs!', newIDs)
-    
-    # Clear the existing VODs and append all new VODs to the shared list
-    latestVODs.update(new_VODs)
-    
-    # Schedule the function to run again after 15 minutes
-    threading.Timer(15*60, watch, args=(twitch_user_id, stop_event, CREDENTIALS, latestVODs)).start()
+    pipeline = pipelines[user_data['event']['code']]
+    threading.Thread(target=watchVODs, args=(user_data['video']['twitchUserID'], stop_event, CREDENTIALS, pipeline['VODs'], pipeline['vodsFound']), daemon=True).start()
+
+def watchVODs(twitch_user_id:str, stop_event, CREDENTIALS, latestVODs:dict, vodsFound):
+    while not stop_event.is_set():
+        try:
+            # get the latest VODs for a user ID (pagination ignored)
+            new_VODs_list = getLatestTwitchVODs(CREDENTIALS['Twitch_clientID'], CREDENTIALS['Twitch_clientSecret'], twitch_user_id)
+        except (requests.exceptions.RequestException, KeyError) as errorText:
+            print(f"unable to list VODs: {errorText}")
+            new_VODs_list = []
+
+        # covert information into more useable form
+        new_VODs = {}
+        for vod in new_VODs_list:
+            created_at_datetime = datetime.datetime.fromisoformat(vod['created_at'])
+            vod['created_at'] =  created_at_datetime.astimezone(device_timezone).replace(tzinfo=None)
+            vod['duration'] = durationStr2Sec(vod['duration'])
+            new_VODs[vod['id']] = vod
+        
+        newIDs = [vodID for vodID in new_VODs.keys() if not(vodID in latestVODs.keys())]
+        if newIDs:
+            print('New VODs!', newIDs)
+        
+        # Clear the existing VODs and append all new VODs to the shared list
+        latestVODs.update(new_VODs)
+        if latestVODs:
+            vodsFound.set()
+
+        # look again in 15 minutes, every minute until the stream has a VOD
+        stop_event.wait(watchSeconds if latestVODs else 60)
+
+def capture(user_data:dict, stop_event):
+    """
+    Starts recording the live stream to local disk so matches are cut without waiting for the VOD
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        stop_event: (bool) or threading.Event(), used to stop processing
+
+    """
+    pipeline = pipelines[user_data['event']['code']]
+    pipeline['capture'] = LiveCapture(user_data['video']['twitchUser'], captureDir(user_data), user_data['video']['captureMegabytes']*2**20)
+    pipeline['capture'].start(stop_event)
+
+def captureDir(user_data:dict):
+    # one capture directory per event
+    return os.path.join('output/capture', user_data['event']['code'])
+
+def publish(user_data:dict, stop_event):
+    """
+    Starts posting match videos to The Blue Alliance in batches, see TOOLS/TBA.py
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        stop_event: (bool) or threading.Event(), used to stop processing
+
+    """
+    pipelines[user_data['event']['code']]['publisher'] = TBAPublisher(user_data['TBA']['Auth_Id'], user_data['TBA']['Auth_Secret'], user_data['TBA']['eventKey'],
+                                                                      f"log/tba_{user_data['TBA']['eventKey']}.json", onPosted=lambda tbaKeys: jobLedger.markPosted(user_data['event']['code'], tbaKeys))
+    pipelines[user_data['event']['code']]['publisher'].start(stop_event)
+
+def seekDelay(expectedPost, freshAt:list):
+    """
+    Seconds until seek should poll FMS again
+
+    Args:
+        expectedPost (datetime.datetime): when the next score is expected, see estimateNextPost (None: nothing scheduled)
+        freshAt (list): times seen matches become old enough to build
+
+    Returns:
+        float: seconds
+    """
+    now = datetime.datetime.now()
+
+    if expectedPost is None:
+        delay = seekMaxSeconds
+    else:
+        untilPost = (expectedPost - now).total_seconds()
+        if untilPost > seekLeadSeconds:
+            # wake up just before it
+            delay = min(untilPost - seekLeadSeconds, seekMaxSeconds)
+        elif untilPost > -5*60:
+            delay = seekFastSeconds
+        else:
+            # long overdue, the field is likely held up
+            delay = seekOverdueSeconds
+
+    for freshTime in freshAt:
+        delay = min(delay, (freshTime - now).total_seconds())
+
+    return max(delay, 1)
+
+def logDiscovery(matches:list, user_data:dict, seekStarted:datetime.datetime):
+    """
+    Records how long after its score was posted each match was first seen, and prints the distribution so far
+
+    Args:
+        matches (list): posted matches from FMS
+        user_data (dict): user inputs from FRUIT GUI
+        seekStarted (datetime.datetime): matches posted before seek started are not counted
+
+    """
+    now = datetime.datetime.now()
+
+    for match in matches:
+        matchString = match2str(match, user_data['event']['code'])
+        if (matchString in discoveryLags) or (match['post'] < seekStarted):
+            continue
+
+        discoveryLags[matchString] = (now - match['post']).total_seconds()
+        with open('log/discovery.csv', 'a') as file:
+            file.write(f"{matchString},{discoveryLags[matchString]:.1f}\n")
+
+        ordered = sorted(discoveryLags.values())
+        print(f"DISCOVERY: {matchString} seen {discoveryLags[matchString]:.0f}s after its score was posted (median {ordered[len(ordered)//2]:.0f}s, max {ordered[-1]:.0f}s over {len(ordered)} matches)")
+
+def bump(matchID:str, event:str=None):
+    """
+    Moves a match to the front of the build and send queues
+
+    Args:
+        matchID (str): match ID (Q41, P3, F1, ...)
+        event (str): FMS event code, None for that match of every event running
+
+    """
+    for code in ([event] if event else list(pipelines)):
+        bumped.add((code, matchID))
+        print(f"BUMP: {code} {matchID}")
+
+def settle(match:dict, state:str, **fields):
+    """
+    Moves a match to a final state of this run (sent, skipped or failed), it is no longer bumped
+
+    Args:
+        match (dict): match data, with the event it was queued for
+        state (str): final state
+        **fields: other columns to set, see JobLedger.transition
+
+    """
+    bumped.discard((match['event'], match['id']))
+    jobLedger.transition(match2str(match, match['event']), state, **fields)
+
+def resume(user_data:dict, queueBuilds:bool=True):
+    """
+    Queues the matches that were not sent when FRUIT last stopped, at the stage they were in
+        * a match that was uploaded is not uploaded again, only its thumbnail/playlist and TBA are redone (see process_queue_send)
+        * a match built early is left to seek, unless its match segment did not get built
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        queueBuilds (bool): also queue the matches that were not built (the batch render finds those itself)
+
+    Returns:
+        dict: number of matches of the event in each state, see JobLedger.counts
+    """
+    jobLedger.importSendLog(user_data['event']['code'])
+
+    for state, match in jobLedger.unfinished(user_data['event']['code']):
+        # matches recorded before several events could run at once are not tagged with theirs
+        match['event'] = user_data['event']['code']
+        if state in ('built', 'uploading'):
+            queue_send.requeue(match)
+        elif (state == 'early') and (readPart(os.path.join('output/parts', match2str(match, user_data['event']['code'])+'.mp4'), user_data['build']['engine']) is not None):
+            # its match segment is built, seek queues it again once the score is posted
+            continue
+        elif queueBuilds:
+            # an early match without its part is built early again (it has no post time yet)
+            queue_build.requeue(match)
+        else:
+            continue
+        print(f"RESUME: {match2str(match, user_data['event']['code'])} ({state})")
+
+    return jobLedger.counts(user_data['event']['code'])
 
 def process_queue_seek(user_data, stop_event, QLabelCounter, CREDENTIALS):
     """
     Looks for new matches from FMS and adds them to the queue
+        * polls fast around the expected next score post and backs off in between (breaks, end of day), see seekDelay
 
     Args:
         user_data (dict): user inputs from FRUIT GUI
@@ -84,231 +591,969 @@ def process_queue_seek(user_data, stop_event, QLabelCounter, CREDENTIALS):
         CREDENTIALS (dict)
 
     """
+    fms = getFMSClient(user_data['season']['year'], user_data['event']['code'], user_data['program'], CREDENTIALS[user_data['program']+'_username'], CREDENTIALS[user_data['program']+'_key'])
+    lastReport = time.monotonic()
+    seekStarted = datetime.datetime.now()
+    errorDelay = seekErrorSeconds
+
     while not stop_event.is_set():
-        # obtain match information from FMS
-        if user_data['program'] == 'FRC':
-            matchesRaw = getMatchesFromFMS(user_data['season']['year'], user_data['event']['code'], 'FRC', CREDENTIALS['FRC_username'], CREDENTIALS['FRC_key'])
-            matches = rewrapMatches(matchesRaw, "FRC")
-        elif user_data['program'] == 'FTC':
-            matchesRaw = getMatchesFromFMS(user_data['season']['year'], user_data['event']['code'], 'FTC', CREDENTIALS['FTC_username'], CREDENTIALS['FTC_key'])
-            matches = rewrapMatches(matchesRaw, "FTC")
+        # obtain match information from FMS (the shared snapshot, only changed lists are downloaded)
+        try:
+            matchesRaw = fms.poll()
+        except (requests.exceptions.RequestException, ValueError, KeyError) as errorText:
+            print(f"SEEK: FMS not available ({errorText}), trying again in {errorDelay} s")
+            stop_event.wait(errorDelay)
+            errorDelay = min(2*errorDelay, seekMaxSeconds)
+            continue
+        errorDelay = seekErrorSeconds
+        matches = rewrapMatches(matchesRaw, user_data['program'], includeUnposted=True)
+        for match in matches:
+            match['event'] = user_data['event']['code']
+
+        if time.monotonic() - lastReport >= 3600:
+            fms.report()
+            reportHTTP()
+            lastReport = time.monotonic()
+
+        # start building live matches once their gameplay has aired, the score is added when it is posted
+        if (user_data['video']['type'] == 'live') and user_data['build'].get('early', False):
+            airedSeconds = user_data['season']['secondsOfMatch'] + user_data['season']['secondsAfterEnd'] + user_data['video']['streamDelay']
+            matches_early = [match for match in matches if (match['post'] is None) and ((datetime.datetime.now() - match['start']).total_seconds() >= airedSeconds)]
+            for match in jobLedger.claim(matches_early, [match2str(match, user_data['event']['code']) for match in matches_early], user_data['event']['code'], 'early'):
+                queue_build.offer(match, stop_event)
+                print('SEEK (early): '+match2str(match, user_data['event']['code']))
+        matchesUnposted = [match for match in matches if match['post'] is None]
+        matches = [match for match in matches if match['post'] is not None]
+        logDiscovery(matches, user_data, seekStarted)
+
+        # reformat into list and remove ones that are too fresh (the capture is local, only wait for the score to be shown)
+        if user_data['video'].get('capture', False):
+            freshSeconds = user_data['season']['secondsAfterPost'] + user_data['video']['streamDelay']
+        else:
+            freshSeconds = 50
+        matches_list = [match for match in matches if (datetime.datetime.now() - match['post']).total_seconds() >= freshSeconds] # + datetime.timedelta(seconds=7*60*60)
+
+        # determine which matches have not already been processed, add them to the ledger
+        matches_new = jobLedger.claim(matches_list, [match2str(match, user_data['event']['code']) for match in matches_list], user_data['event']['code'])
+
+        # sent matches to builder to be generated and count
+        for match in matches_new:
+            match_str = match2str(match, user_data['event']['code'])
+            queue_build.offer(match, stop_event)
+            incrementCountText(QLabelCounter)
+            print('SEEK: '+match_str)
+
+        # poll again around the next expected score post, or once a seen match is old enough to build
+        freshAt = [match['post'] + datetime.timedelta(seconds=freshSeconds) for match in matches if not(match in matches_list)]
+        # or once the gameplay of a running match has aired, for early builds
+        if (user_data['video']['type'] == 'live') and user_data['build'].get('early', False):
+            freshAt += [match['start'] + datetime.timedelta(seconds=airedSeconds) for match in matchesUnposted if match['start'] + datetime.timedelta(seconds=airedSeconds) > datetime.datetime.now()]
+        delay = seekDelay(estimateNextPost(matchesRaw, fms.schedule()), freshAt)
+        stop_event.wait(delay)
+
+def initBuildWorker(scratchRoot:str, cacheMegabytes:int):
+    """
+    Gives each build worker process its own scratch directory, and the shared VOD segment cache
+
+    Args:
+        scratchRoot (str): directory holding the scratch directories of all workers
+        cacheMegabytes (int): size cap of the VOD segment cache
+
+    """
+    global scratchDir, segmentCache
+    scratchDir = os.path.join(scratchRoot, str(os.getpid()))
+    os.makedirs(scratchDir, exist_ok=True)
+    segmentCache = SegmentCache('output/cache/segments', cacheMegabytes*2**20)
+
+def selectVOD(match:dict, latestVODs:dict, season:dict):
+    """
+    Determines which VOD contains a match
+
+    Args:
+        match (dict): match data dictionary
+        latestVODs (dict): details of VODs found
+        season (dict): match timings (CONFIG['season']), for matches built before their score is posted
+
+    Returns:
+        dict: details of VOD (defaults to the latest VOD)
+    """
+    # an early build has no post time yet, it ends where the score would at the earliest
+    matchEnd = match['post'] if match['post'] is not None else match['start'] + datetime.timedelta(seconds=season['secondsOfMatch'] + season['secondsAfterPost'])
+
+    for vod in reversed(latestVODs.values()):
+        startInVideo = (match['start'] - vod['created_at']).total_seconds() < vod['duration']
+        endInVideo = (matchEnd - vod['created_at']).total_seconds() < vod['duration']
+
+        # video is in the same VOD
+        if startInVideo and endInVideo:
+            break
         
-        # reformat into list and remove ones that are too fresh
-        matches_list = [match for match in matches if (datetime.datetime.now() - match['post']).total_seconds() >= 50] # + datetime.timedelta(seconds=7*60*60)
+        # video is in different VODs (XOR)
+        if startInVideo ^ endInVideo:
+            print('bad times ahead')
 
-        # determine which matches have not already been processed
-        matches_new = listNotInLog('log/seek.txt', matches_list, user_data['event']['code'])
+        # default exit is latest VOD
 
-        # sent matches to builder to be generated, add them to log and count
-        with open('log/seek.txt', 'a') as file:
-            for match in matches_new:
-                match_str = match2str(match, user_data['event']['code'])
-                file.write(match_str+"\n")
-                queue_build.put(match)
-                incrementCountText(QLabelCounter)
-                print('SEEK: '+match_str)
+    # double check VOD and match are on the same day (prevents stale)
+    if (match['start'] - vod['created_at']).total_seconds() > (24*60*60):
+        print('ope!')
 
-        # wait a little bit before looking for new matches
-        time.sleep(100)
+    return vod
 
-def process_queue_build_live(user_data:dict, stop_event, QLabelCounter, latestVODs:dict=VODs):
+def build_match_live(user_data:dict, match:dict, vod:dict):
     """
-    Creates match video using Twitch VOD
+    Creates match video using Twitch VOD, runs in a build worker process
 
     Args:
         user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary
+        vod (dict): details of VOD containing the match
+
+    Returns:
+        dict: {'status': 'built', 'early', 'retry' or 'skip', 'message': str, 'seconds': float}
+    """
+    # match start in VOD time, add stream delay (time from event to server)
+    vodStart = (match['start'] - vod['created_at']).total_seconds() + user_data['video']['streamDelay']
+
+    if vodStart - user_data['season']['secondsBeforeStart'] < 0:
+        return {'status': 'skip', 'message': 'negative start time, do not retry match'}
+
+    def fetch(startOffset:float, endOffset:float):
+        # get only the Twitch segments that contain the range
+        for extension in ['.ts', '.mp4']:
+            closeSource(os.path.join(scratchDir, 'temp'+extension))
+        clip = downloadTwitchSegments(int(vod['id']), vodStart + startOffset, vodStart + endOffset, os.path.join(scratchDir, 'temp'), segmentCache)
+
+        return {'filePath': clip['filePath'], 'offset': vodStart - clip['start'],
+                'cache': {'hits': clip['cacheHits'], 'misses': clip['cacheMisses'], 'bytesSaved': clip['bytesSaved']}}
+
+    return buildLiveMatch(user_data, match, fetch, 'retry')
+
+def build_match_capture(user_data:dict, match:dict):
+    """
+    Creates match video from the local capture of the live stream, runs in a build worker process
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary
+
+    Returns:
+        dict: {'status': 'built', 'early', 'retry' or 'skip', 'message': str, 'seconds': float}
+    """
+    # match start in stream time, add stream delay (time from event to server)
+    streamStart = match['start'] + datetime.timedelta(seconds=user_data['video']['streamDelay'])
+
+    def fetch(startOffset:float, endOffset:float):
+        tempFileName = os.path.join(scratchDir, 'capture.ts')
+        closeSource(tempFileName)
+        fileStart = assembleCapture(streamStart + datetime.timedelta(seconds=startOffset), streamStart + datetime.timedelta(seconds=endOffset), tempFileName, captureDir(user_data))
+
+        return {'filePath': tempFileName, 'offset': (streamStart - fileStart).total_seconds()}
+
+    # not captured (stream down, gap, or FRUIT started late), capture mode does not watch the VODs
+    result = buildLiveMatch(user_data, match, fetch, 'skip')
+    if result['status'] == 'skip':
+        result['message'] += ", build it from the VOD by running the event without recording the stream locally"
+
+    return result
+
+def readPart(partPath:str, engine:str):
+    """
+    Encode settings a part was built with, see buildLiveMatch
+
+    Args:
+        partPath (str): part in output/parts
+        engine (str): engine the score segment would be built with
+
+    Returns:
+        dict: encode profile, None without a part (or one that cannot be joined to)
+    """
+    try:
+        with open(os.path.splitext(partPath)[0]+'.json', 'r') as file:
+            settings = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.exists(partPath) or (settings.get('engine') != engine):
+        return None
+
+    return settings['encode']
+
+def removePart(partPath:str):
+    for path in (partPath, os.path.splitext(partPath)[0]+'.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def buildLiveMatch(user_data:dict, match:dict, fetch, unavailable:str):
+    """
+    Creates match video from a live source, in two phases when the match is released before its score is posted
+        * no post time: only the match segment is built, into output/parts, with its encode settings beside it
+        * post time and a built part: only the score segment is built, with the settings of the part, then joined to the part
+          (the join copies both streams, they must be encoded alike)
+        * post time and no part (or one whose settings are unknown): both segments are built at once, any part is removed
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary ('post' is None before the score is posted)
+        fetch: function(start, end) getting that range (seconds from the match start) of the stream to disk,
+               returning {'filePath': str, 'offset': match start in the file (seconds), 'cache': optional stats}
+        unavailable (str): status to return when the source does not have the range
+
+    Returns:
+        dict: {'status': 'built', 'early', 'retry' or 'skip', 'message': str, 'seconds': float, 'encode': profile used}
+    """
+    timeStart = time.perf_counter()
+    matchString = match2str(match, user_data['event']['code'])
+    outputFilename = 'output/'+matchString+'.mp4'
+    partPath = os.path.join('output/parts', matchString+'.mp4')
+    encode = user_data['build'].get('encode')
+
+    # clip the match and the scores (seconds from the match start)
+    matchSegment = (-user_data['season']['secondsBeforeStart'], user_data['season']['secondsOfMatch'] + user_data['season']['secondsAfterEnd'])
+    if match['post'] is None:
+        segments, target, fades = [matchSegment], os.path.join(scratchDir, 'part.mp4'), (True, False)
+    else:
+        postDelay = (match['post'] - match['start']).total_seconds()
+        scoreSegment = (postDelay - user_data['season']['secondsBeforePost'], postDelay + user_data['season']['secondsAfterPost'])
+        partEncode = readPart(partPath, user_data['build']['engine'])
+        if partEncode is not None:
+            segments, target, fades, encode = [scoreSegment], os.path.join(scratchDir, 'score.mp4'), (False, True), partEncode
+        else:
+            segments, target, fades = [matchSegment, scoreSegment], outputFilename, (True, True)
+
+    try:
+        clip = fetch(min(segment[0] for segment in segments), max(segment[1] for segment in segments))
+    except ValueError as errorText:
+        if match['post'] is None:
+            return {'status': 'early', 'message': f"EARLY: {matchString} not available yet, {errorText}"}
+        return {'status': unavailable, 'message': f"{errorText}, {matchString} not built"}
+
+    try:
+        segments = [(segmentStart + clip['offset'], segmentEnd + clip['offset']) for segmentStart, segmentEnd in segments]
+        renderMatch(clip['filePath'], segments, target, user_data['build']['engine'], scratchDir, fades, user_data['build'].get('encodeWorkers', 1), encode)
+
+        if (match['post'] is None) and os.path.exists(outputFilename):
+            # the whole match was built while this part was
+            os.remove(target)
+        elif match['post'] is None:
+            # the part only counts once it is complete, its settings go first
+            os.makedirs('output/parts', exist_ok=True)
+            with open(os.path.splitext(partPath)[0]+'.json', 'w') as file:
+                json.dump({'engine': user_data['build']['engine'], 'encode': encode}, file)
+            os.replace(target, partPath)
+        elif target != outputFilename:
+            joinParts([partPath, target], outputFilename, scratchDir)
+            removePart(partPath)
+            os.remove(target)
+        else:
+            # a part left from an early build that was still running, or built with other settings
+            removePart(partPath)
+    except ValueError as errorText:
+        if match['post'] is None:
+            return {'status': 'early', 'message': f"EARLY: {matchString} failed, {errorText}"}
+        return {'status': 'retry', 'message': f'AAAHHHHHHH {errorText}'}
+
+    result = {'status': 'early' if match['post'] is None else 'built', 'seconds': time.perf_counter() - timeStart, 'profile': encode['name'], 'encode': encode}
+    if match['post'] is None:
+        result['message'] = f"EARLY: {matchString} match segment built in {result['seconds']:.1f}s"
+    if 'cache' in clip:
+        result['cache'] = clip['cache']
+
+    return result
+
+def build_match_static(user_data:dict, match:dict, recording:dict):
+    """
+    Creates match video using local file, runs in a build worker process
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary
+        recording (dict): alignment of the local file to FMS time, see locateRecording
+
+    Returns:
+        dict: {'status': 'built' or 'skip', 'message': str, 'seconds': float}
+    """
+    timeStart = time.perf_counter()
+
+    segments = staticSegments(user_data, match, recording)
+
+    if segments is None:
+        return {'status': 'skip', 'message': "NOT IN VIDEO: "+match2str(match, user_data['event']['code'])}
+
+    # clip the match and the scores, then merge them together
+    renderMatch(user_data['video']['filePath'], segments, 'output/'+match2str(match, user_data['event']['code'])+'.mp4', user_data['build']['engine'], scratchDir, (True, True), user_data['build'].get('encodeWorkers', 1), user_data['build'].get('encode'))
+
+    return {'status': 'built', 'seconds': time.perf_counter() - timeStart, 'profile': user_data['build']['encode']['name']}
+
+def build_match_window(user_data:dict, match:dict, windowPath:str, segments:list):
+    """
+    Creates match video from a window file of the batch pass, runs in a build worker process
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary
+        windowPath (str): window file holding the match (deleted once built)
+        segments (list): [(start, end) of match, (start, end) of score] in window time
+
+    Returns:
+        dict: {'status': 'built', 'seconds': float}
+    """
+    timeStart = time.perf_counter()
+
+    renderMatch(windowPath, segments, 'output/'+match2str(match, user_data['event']['code'])+'.mp4', user_data['build']['engine'], scratchDir, (True, True), user_data['build'].get('encodeWorkers', 1), user_data['build'].get('encode'))
+
+    closeSource(windowPath)
+    for path in [windowPath, windowPath+'.fruit', windowPath+'.kfi']:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return {'status': 'built', 'seconds': time.perf_counter() - timeStart, 'profile': user_data['build']['encode']['name']}
+
+def staticSegments(user_data:dict, match:dict, recording:dict):
+    """
+    Determines where the match and its score are in a local file
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        match (dict): match data dictionary
+        recording (dict): alignment of the local file to FMS time, see locateRecording
+
+    Returns:
+        list: [(start, end) of match, (start, end) of score] in seconds, None if not in the file
+    """
+    segmentStartDatetime = match['start']-datetime.timedelta(seconds=user_data['season']['secondsBeforePost'])
+    segmentEndDatetime = match['post']+datetime.timedelta(seconds=user_data['season']['secondsAfterPost'])
+
+    if not((segmentStartDatetime >= recording['fileTimeStart'])*(segmentEndDatetime < recording['fileTimeEnd'])):
+        return None
+
+    # determine video timestamps of notable events
+    secStart = (match['start'] - recording['fileMatchStart']).total_seconds() + recording['fileSecStart']
+    secPost = (match['post'] - recording['fileMatchStart']).total_seconds() + recording['fileSecStart']
+
+    return [(secStart - user_data['season']['secondsBeforeStart'], secStart + user_data['season']['secondsOfMatch'] + user_data['season']['secondsAfterEnd']),
+            (secPost - user_data['season']['secondsBeforePost'], secPost + user_data['season']['secondsAfterPost'])]
+
+def locateRecording(user_data:dict, matches:list):
+    """
+    Aligns a local file to FMS time using the reference match from the GUI
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        matches (list): list of matches from FMS
+
+    Returns:
+        dict: {'fileMatchStart', 'fileSecStart', 'fileTimeStart', 'fileTimeEnd'}
+    """
+    fileDuration = openSource(user_data['video']['filePath']).info['duration']
+    fileMatchStart = [match for match in matches if match["id"] == user_data['video']['matchID']][0]['start']
+    fileSecStart = (user_data['video']['matchTime'][0]*60)+user_data['video']['matchTime'][1]
+
+    return {'fileMatchStart': fileMatchStart,
+            'fileSecStart': fileSecStart,
+            'fileTimeStart': fileMatchStart-datetime.timedelta(seconds=fileSecStart),
+            'fileTimeEnd': fileMatchStart+datetime.timedelta(seconds=fileDuration-fileSecStart)}
+
+def uplinkSized(buildConfig:dict):
+    # the copy engine keeps the source bitrate for all but the cut points, see withProfile
+    return (buildConfig.get('uploadBudget', 0) > 0) and (buildConfig['engine'] != 'copy')
+
+def encodeInputs(buildConfig:dict, encode:dict):
+    """
+    Settings of an encode profile that change the video, see buildInputs
+        * the profile name is left out, and so is a bitrate picked from the uplink
+          (a video built at another bitrate is still reused)
+
+    Args:
+        buildConfig (dict): CONFIG['build']
+        encode (dict): encode profile, see selectProfile
+
+    Returns:
+        dict
+    """
+    return {setting: value for setting, value in encode.items() if not((setting == 'name') or ((setting == 'bitrate') and uplinkSized(buildConfig)))}
+
+def buildInputs(user_data:dict, match:dict, source):
+    """
+    Everything that changes the video of a match, see TOOLS/buildcache.py
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI, with the encode profile picked for the build (see withProfile)
+        match (dict): match data dictionary
+        source: what the match is cut from (file & cut points, VOD, capture)
+
+    Returns:
+        dict
+    """
+    return {'match': {'id': match['id'], 'start': match['start'], 'post': match['post']},
+            'season': user_data['season'],
+            'streamDelay': user_data['video'].get('streamDelay'),
+            'source': source,
+            'engine': user_data['build']['engine'],
+            'encode': encodeInputs(user_data['build'], user_data['build']['encode'])}
+
+def staticSource(user_data:dict, match:dict, recording:dict):
+    # the file, and where in it the match is
+    stat = os.stat(user_data['video']['filePath'])
+    return {'file': user_data['video']['filePath'], 'bytes': stat.st_size, 'mtime': stat.st_mtime, 'segments': staticSegments(user_data, match, recording)}
+
+def withProfile(user_data:dict, queueDepth:int):
+    """
+    Copy of user_data for one build, with the encode profile to use (CONFIG['build']['encode'])
+        * the profile is picked when the build is submitted, so it can be changed while running
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        queueDepth (int): matches waiting to be built
+
+    Returns:
+        dict
+    """
+    encode = selectProfile(user_data['build'], queueDepth)
+
+    # size the match so its upload fits the upload budget at the uplink speed seen recently
+    #   (not with the copy engine, which keeps the source bitrate for all but the cut points)
+    if uplinkSized(user_data['build']):
+        season = user_data['season']
+        videoSeconds = season['secondsBeforeStart'] + season['secondsOfMatch'] + season['secondsAfterEnd'] + season['secondsBeforePost'] + season['secondsAfterPost']
+        bitrate = uplink.targetBitrate(videoSeconds, user_data['build']['uploadBudget'])
+        if bitrate is not None:
+            encode['bitrate'] = f"{bitrate//1000}k"
+
+    return {**user_data, 'build': {**user_data['build'], 'encode': encode}}
+
+def logBitrate(matchString:str, encode:dict):
+    """
+    Records the encode settings a match was built with, next to the uplink speed they were chosen for
+
+    Args:
+        matchString (str): see match2str
+        encode (dict): encode profile the match was built with
+
+    """
+    throughput = uplink.throughput()
+
+    with open('log/bitrate.csv', 'a') as file:
+        file.write(f"{matchString},{encode['name']},{encode['bitrate'] or ''},{encode['crf']},{8*throughput/1e6 if throughput else 0:.2f}\n")
+
+def newBuildPool(user_data:dict):
+    """
+    Starts the build worker processes, with fresh scratch directories
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor
+    """
+    # workers are recycled after a few matches, their leaked ffmpeg readers go with them
+    scratchRoot = 'output/scratch'
+    shutil.rmtree(scratchRoot, ignore_errors=True)
+
+    return concurrent.futures.ProcessPoolExecutor(max_workers=user_data['build']['workers'], max_tasks_per_child=user_data['build']['recycleAfter'], initializer=initBuildWorker, initargs=(scratchRoot, user_data['build'].get('cacheMegabytes', 2048)))
+
+def startBuildPool(user_data:dict):
+    """
+    Starts the build worker processes shared by every event, unless they are running already
+        * the build pool thread and batch renders take turns on them, see acquireBuildPool
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI, the pool settings (workers, recycling, segment cache) are taken from it
+
+    """
+    global buildPool
+    with buildPoolLock:
+        if buildPool is None:
+            buildPool = newBuildPool(user_data)
+
+def acquireBuildPool(user_data:dict):
+    """
+    The shared build worker processes, started with the settings of user_data if they are not running
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: hand it back with releaseBuildPool
+    """
+    global buildPoolUsers
+    startBuildPool(user_data)
+    with buildPoolLock:
+        buildPoolUsers += 1
+        return buildPool
+
+def releaseBuildPool():
+    """
+    Stops the shared build worker processes once the last thread using them is done with them
+    """
+    global buildPool, buildPoolUsers
+    with buildPoolLock:
+        buildPoolUsers -= 1
+        if buildPoolUsers == 0:
+            buildPool.shutdown(wait=True)
+            buildPool = None
+
+def process_queue_build_pool(user_data:dict, stop_event, QLabelCounter):
+    """
+    Builds the matches of every event in one pool of worker processes, passing them to the send queue in the order they were taken
+        * each match is built with the CONFIG and video source of its own event, see addPipeline
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI, the pool settings (workers, backlog, disk) are taken from it
         stop_event: (bool) or threading.Event(), used to stop processing
         QLabelCounter: PYQT QLabel() to update respective counter (by 1) in GUI
-        latestVODs (dict): details of VODs found
 
     """
-    while not stop_event.is_set():
-        # if there are no Twitch stream VODs, wait a minute
-        if not latestVODs:
-            print('no VODs!')
-            time.sleep(60)
-            continue
+    workers = user_data['build']['workers']
+    pool = acquireBuildPool(user_data)
+    queue_build.deadlineSeconds = user_data['build'].get('deadline', 15*60)
+    queue_build.maxsize = user_data['build'].get('buildBacklog', buildBacklog)
+    wakeOnStop(stop_event)
+    cacheStats.update({'hits': 0, 'misses': 0, 'bytesSaved': 0})
+
+    # passes a finished build on to the send stage
+    def handOver(match, future, encode, inputs):
+        matchString = match2str(match, match['event'])
 
         try:
-            # grab a match from the build queue, try for 30 seconds then timeout
-            match = queue_build.get(timeout=30)
-
-            # determine which VOD contains the match
-            for vod in reversed(latestVODs.values()):
-                startInVideo = (match['start'] - vod['created_at']).total_seconds() < vod['duration']
-                endInVideo = (match['post'] - vod['created_at']).total_seconds() < vod['duration']
-
-                # video is in the same VOD
-                if startInVideo and endInVideo:
-                    break
-                
-                # video is in different VODs (XOR)
-                if startInVideo ^ endInVideo:
-                    print('bad times ahead')
-
-                # default exit is latest VOD
-
-            # double check VOD and match are on the same day (prevents stale)
-            if (match['start'] - vod['created_at']).total_seconds() > (24*60*60):
-                print('ope!')
-            
-            # prepare VOD cut start-point
-            startSeconds = ((match['start'] - vod['created_at']).total_seconds() +user_data['video']['streamDelay'] -user_data['season']['secondsBeforeStart']) #add stream delay (time from event to server) & subtract countdown
+            result = future.result()
+        except Exception as errorText:
+            print(f"BUILD FAILED: {matchString} {errorText}")
+            # an early build stays early, seek queues the whole match once its score is posted (see JobLedger.claim)
+            if match['post'] is not None:
+                settle(match, 'failed')
+            return
+
+        if result['status'] == 'built':
+            # the score of an early build follows the settings of its part
+            encode = result.get('encode', encode)
+            jobLedger.transition(matchString, 'built', artifact='output/'+matchString+'.mp4', buildSeconds=result['seconds'])
+            if inputs is not None:
+                recordArtifact('output/'+matchString+'.mp4', buildKey({**inputs, 'encode': encodeInputs(pipelineOf(match)['config']['build'], encode)}))
+            queue_send.offer(match, stop_event)
+            incrementCountText(QLabelCounter)
+            print(f"BUILT: {matchString} in {result['seconds']:.1f}s ({3600/result['seconds']:.0f} matches/hour per worker, {pipelineOf(match)['config']['build']['engine']}, {result['profile']}, {encode['bitrate'] or 'crf '+str(encode['crf'])})")
+            logBitrate(matchString, encode)
+            if 'cache' in result:
+                for stat in cacheStats:
+                    cacheStats[stat] += result['cache'][stat]
+                print(f"CACHE: {100*cacheStats['hits']/max(cacheStats['hits']+cacheStats['misses'], 1):.0f}% of VOD segments reused, {cacheStats['bytesSaved']/2**20:.1f} MiB saved this run")
+        elif result['status'] == 'resume':
+            jobLedger.transition(matchString, 'built')
+            queue_send.offer(match, stop_event)
+            incrementCountText(QLabelCounter)
+            print(f"RESUME: {matchString} has an interrupted upload, not rebuilding")
+        elif result['status'] == 'cached':
+            jobLedger.transition(matchString, 'built', artifact='output/'+matchString+'.mp4')
+            queue_send.offer(match, stop_event)
+            incrementCountText(QLabelCounter)
+            print(f"CACHED: {matchString} was already built from the same inputs, not rebuilding")
+        elif result['status'] == 'retry':
+            # the VOD does not reach the match yet, try again once it may have caught up
+            print(result['message'])
+            jobLedger.transition(matchString, 'seen')
+            queue_build.requeue(match, buildRetrySeconds)
+        elif result['status'] == 'early':
+            print(result['message'])
+        else:
+            print(result['message'])
+            settle(match, 'skipped')
+
+    # builds in the order they were taken from the queue
+    pending = collections.deque()
 
-            if startSeconds < 0:
-                raise ValueError("Negative start time.")
+    held = False
 
-            trim = startSeconds % 10
-            if trim > 9:
-                startSegment = ((math.ceil(startSeconds)//10)-1)*10
+    while not stop_event.is_set():
+        # set again by anything that changes below: a match queued or handed out, a build finishing, stopping
+        queueChanged.clear()
+
+        # hold new builds while the send stage or the disk is behind (backpressure)
+        backlog = queue_send.qsize() + len(pending) >= user_data['build'].get('sendBacklog', sendBacklog)
+        lowDisk = shutil.disk_usage('output').free < user_data['build'].get('minFreeMegabytes', minFreeMegabytes)*2**20
+        if (backlog or lowDisk) != held:
+            held = backlog or lowDisk
+            if held:
+                print(f"BACKPRESSURE: holding builds, {queue_send.qsize()} videos waiting to be sent{', output disk low' if lowDisk else ''}")
             else:
-                startSegment = (math.ceil(startSeconds)//10)*10
-            
-            # prepare VOD clip duration
-            postStartDuration = (match['post'] - match['start']).total_seconds() - user_data['season']['secondsBeforePost']
-            postEndDuration = (match['post'] - match['start']).total_seconds() + user_data['season']['secondsAfterPost']
-            downloadDuration = str(datetime.timedelta(seconds=(((trim + postEndDuration) // 10)+2)*10))
+                print("BACKPRESSURE: released")
 
-            # get clip from Twitch that contains both match + its score
-            downloadTwitchClip(int(vod['id']), str(datetime.timedelta(seconds=(startSegment))), downloadDuration, 'output/temp.mp4')
+        # keep every worker busy, plus one waiting
+        match = queue_build.take(stop_event, block=False) if (len(pending) <= workers) and not held else None
+        if match is not None:
+            pipeline = pipelineOf(match)
+            eventData = pipeline['config']
 
-            # update trim to start of match (didn't do this before such that we make sure to grab that Twitch segment)
-            trim += user_data['season']['secondsBeforeStart']
+            # the video of an interrupted upload is already built, finish the upload instead
+            if hasUploadSession('output/'+match2str(match, match['event'])+'.mp4'):
+                resumed = concurrent.futures.Future()
+                resumed.set_result({'status': 'resume'})
+                pending.append((match, resumed, None, None))
+                continue
 
+            # reuse the video if it was built from the same inputs, with the encode settings it would be built with now
+            jobData = withProfile(eventData, queue_build.qsize() + len(pending))
             try:
-                with VideoFileClip('output/temp.mp4') as video:
+                inputs = buildInputs(jobData, match, pipeline['describeSource'](match)) if match['post'] is not None else None
+                if (inputs is not None) and validArtifact('output/'+match2str(match, match['event'])+'.mp4', buildKey(inputs)):
+                    cached = concurrent.futures.Future()
+                    cached.set_result({'status': 'cached'})
+                    pending.append((match, cached, None, None))
+                    continue
 
-                    # clip the match and the scores, adding audio fades to taste
-                    seg_match = audio_fadein(video.subclip(trim - user_data['season']['secondsBeforeStart'], trim + user_data['season']['secondsOfMatch'] + user_data['season']['secondsAfterEnd']), 0.5)
-                    seg_score = audio_fadeout(video.subclip(trim + postStartDuration, trim + postEndDuration), 2)
+                future = pool.submit(*pipeline['prepareJob'](match, jobData))
+            except Exception as errorText:
+                # one match that cannot be set up must not stop the stage, it fails like a build that raised (see handOver)
+                future = concurrent.futures.Future()
+                future.set_exception(errorText)
+                inputs = None
+            future.add_done_callback(lambda future: queueChanged.set())
+            pending.append((match, future, jobData['build']['encode'], inputs))
+            if match['post'] is not None:
+                jobLedger.transition(match2str(match, match['event']), 'building')
+            continue
 
-                    # merge together match and scores
-                    final = concatenate_videoclips([seg_match, seg_score])
+        # hand over finished builds, holding back any that finished ahead of an earlier match
+        while pending and pending[0][1].done():
+            handOver(*pending.popleft())
 
-                    # save the results as a file
-                    final.write_videofile('output/'+match2str(match, user_data['event']['code'])+'.mp4', audio_codec='aac')
-                
-                queue_send.put(match)
-                incrementCountText(QLabelCounter)
-                print("BUILT: "+match2str(match, user_data['event']['code']))
+        # each capture may drop video from before the oldest match of its event still to be built
+        waiting = [match for match, future, encode, inputs in pending] + queue_build.matches()
+        for event, pipeline in list(pipelines.items()):
+            if pipeline['capture'] is not None:
+                starts = [match['start'] for match in waiting if match['event'] == event]
+                pipeline['capture'].keepFrom = min(starts) - datetime.timedelta(seconds=pipeline['config']['season']['secondsBeforeStart']+60) if starts else None
 
-            except ValueError as errorText:
-                print(f'AAAHHHHHHH {errorText}')
-                queue_build.put(match)
-            
-        except queue.Empty:
-            continue
-        except ValueError:
-            print('negative start time, do not retry match')
+        # wait for a match to be queued or come due, a build to finish or the send stage to take a video
+        #   (freed disk space is not signalled, it is checked again every minute while low)
+        timeouts = [timeout for timeout in (queue_build.nextDue(), 60 if lowDisk else None) if timeout is not None]
+        queueChanged.wait(min(timeouts) if timeouts else None)
 
-def process_queue_build_static(user_data:dict, stop_event, QLabelCounter, matches, latestVODs:dict=VODs):
+    # builds that finished (or were running) when stopped are handed over, not left 'building'
+    #   (a batch render may still be using the workers, only this thread's builds are cancelled)
+    for match, future, encode, inputs in pending:
+        future.cancel()
+    concurrent.futures.wait([future for match, future, encode, inputs in pending])
+    releaseBuildPool()
+    for match, future, encode, inputs in pending:
+        if not future.cancelled():
+            handOver(match, future, encode, inputs)
+
+def process_queue_source_live(user_data:dict, stop_event):
     """
-    Creates match video using local file
+    Readies the Twitch VODs (or the local capture) of an event as its video source, then releases its matches to the build pool
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        stop_event: (bool) or threading.Event(), used to stop processing
+
+    """
+    pipeline = pipelines[user_data['event']['code']]
+
+    # cut from the local capture, no VODs needed
+    if user_data['video'].get('capture', False):
+        pipeline['prepareJob'] = lambda match, jobData: (build_match_capture, jobData, match)
+        pipeline['describeSource'] = lambda match: {'capture': user_data['video']['twitchUser']}
+        queue_build.release(user_data['event']['code'])
+        return
+
+    # if there are no Twitch stream VODs, wait for watch to find one
+    if not pipeline['VODs']:
+        print(f"no VODs for {user_data['event']['code']}!")
+    while not (pipeline['VODs'] or pipeline['vodsFound'].wait(timeout=5)):
+        if stop_event.is_set():
+            return
+
+    pipeline['prepareJob'] = lambda match, jobData: (build_match_live, jobData, match, selectVOD(match, pipeline['VODs'], user_data['season']))
+    pipeline['describeSource'] = lambda match: {'vod': selectVOD(match, pipeline['VODs'], user_data['season'])['id']}
+    queue_build.release(user_data['event']['code'])
+
+def process_queue_source_static(user_data:dict, stop_event, matches:list):
+    """
+    Aligns the local file of an event to FMS time as its video source, then releases its matches to the build pool
 
     Args:
         user_data (dict): user inputs from FRUIT GUI
         stop_event: (bool) or threading.Event(), used to stop processing
-        QLabelCounter: PYQT QLabel() to update respective counter (by 1) in GUI
         matches (list): list of matches from FMS
-        latestVODs (dict): details of VODs found
 
     """
+    pipeline = pipelines[user_data['event']['code']]
+    recording = locateRecording(user_data, matches)
 
-    fileDuration = VideoFileClip(user_data['video']['filePath']).duration
-    fileMatchStart = [match for match in matches if match["id"] == user_data['video']['matchID']][0]['start']
-    fileSecStart = (user_data['video']['matchTime'][0]*60)+user_data['video']['matchTime'][1]
-    fileTimeStart = fileMatchStart-datetime.timedelta(seconds=fileSecStart)
-    fileTimeEnd = fileMatchStart+datetime.timedelta(seconds=fileDuration-fileSecStart)
+    pipeline['prepareJob'] = lambda match, jobData: (build_match_static, jobData, match, recording)
+    pipeline['describeSource'] = lambda match: staticSource(user_data, match, recording)
+    queue_build.release(user_data['event']['code'])
 
-    while not stop_event.is_set():
+def process_queue_build_batch(user_data:dict, stop_event, QLabelCounter, matches:list):
+    """
+    Creates every match video of a local file in a single pass over it, instead of seeking per match
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        stop_event: (bool) or threading.Event(), used to stop processing
+        QLabelCounter: PYQT QLabel() to update respective counter (by 1) in GUI, None when headless
+        matches (list): list of matches from FMS
+
+    """
+    timeStart = time.perf_counter()
+    recording = locateRecording(user_data, matches)
+
+    # every match in the file that has not been processed yet
+    for match in matches:
+        match['event'] = user_data['event']['code']
+    jobs = []
+    matchStrings = [match2str(match, user_data['event']['code']) for match in matches]
+    unbuilt = {match2str(match, user_data['event']['code']) for state, match in jobLedger.unfinished(user_data['event']['code']) if not(state in ('built', 'uploading'))}
+    claimed = jobLedger.claim(matches, matchStrings, user_data['event']['code'])
+    for match in [match for match, matchString in zip(matches, matchStrings) if (match in claimed) or (matchString in unbuilt)]:
+        segments = staticSegments(user_data, match, recording)
+        matchString = match2str(match, user_data['event']['code'])
+        if segments is None:
+            print("NOT IN VIDEO: "+matchString)
+            settle(match, 'skipped')
+        elif validArtifact('output/'+matchString+'.mp4', buildKey(buildInputs(withProfile(user_data, 0), match, staticSource(user_data, match, recording)))):
+            # already built from the same inputs (and the settings the first window would be encoded with)
+            jobLedger.transition(matchString, 'built', artifact='output/'+matchString+'.mp4')
+            queue_send.offer(match, stop_event)
+            incrementCountText(QLabelCounter)
+            print(f"CACHED: {matchString} was already built from the same inputs, not rebuilding")
+        else:
+            jobs.append((match, segments))
+
+    # render each match as soon as the pass has read past it, on the workers shared with the other events
+    workers = user_data['build']['workers']
+    pool = acquireBuildPool(user_data)
+    pending = collections.deque()   # (i, future) in the order the windows were read
+    jobDatas = {}
+    built = []
+
+    # passes a finished build on to the send stage
+    def handOver(i, future):
+        matchString = match2str(jobs[i][0], user_data['event']['code'])
         try:
-            match = queue_build.get(timeout=30)
+            result = future.result()
+        except Exception as errorText:
+            print(f"BUILD FAILED: {matchString} {errorText}")
+            settle(jobs[i][0], 'failed')
+            return
 
-            segmentStartDatetime = match['start']-datetime.timedelta(seconds=user_data['season']['secondsBeforePost'])
-            segmentEndDatetime = match['post']+datetime.timedelta(seconds=user_data['season']['secondsAfterPost'])
+        jobLedger.transition(matchString, 'built', artifact='output/'+matchString+'.mp4', buildSeconds=result['seconds'])
+        recordArtifact('output/'+matchString+'.mp4', buildKey(buildInputs(jobDatas[i], jobs[i][0], staticSource(user_data, jobs[i][0], recording))))
+        queue_send.offer(jobs[i][0], stop_event)
+        incrementCountText(QLabelCounter)
+        built.append(i)
+        print(f"BUILT: {matchString} in {result['seconds']:.1f}s ({user_data['build']['engine']}, {result['profile']}, batch)")
 
-            if (segmentStartDatetime >= fileTimeStart)*(segmentEndDatetime < fileTimeEnd):
-                # determine video timestamps of notable events
-                secStart = (match['start'] - fileMatchStart).total_seconds() + fileSecStart 
-                secPost = (match['post'] - fileMatchStart).total_seconds() + fileSecStart
+    def onWindow(i, windowPath, windowStart):
+        # hand over finished builds, holding back any that finished ahead of an earlier match
+        while pending and pending[0][1].done():
+            handOver(*pending.popleft())
 
-                outputFilename = 'output/'+match2str(match, user_data['event']['code'])+'.mp4'
+        # window files wait on disk until built, the pass waits while every worker has one (as the live pool takes matches)
+        while len(pending) > workers:
+            concurrent.futures.wait([pending[0][1]])
+            while pending and pending[0][1].done():
+                handOver(*pending.popleft())
 
-                with VideoFileClip(user_data['video']['filePath']) as video:
-                    # clip the match and the scores, adding audio fades to taste
-                    seg_match = audio_fadein(video.subclip(secStart - user_data['season']['secondsBeforeStart'], secStart + user_data['season']['secondsOfMatch'] + user_data['season']['secondsAfterEnd']), 0.5)
-                    seg_score = audio_fadeout(video.subclip(secPost - user_data['season']['secondsBeforePost'], secPost + user_data['season']['secondsAfterPost']), 2)
+        segments = [(segmentStart - windowStart, segmentEnd - windowStart) for segmentStart, segmentEnd in jobs[i][1]]
+        jobDatas[i] = withProfile(user_data, len(pending))
+        pending.append((i, pool.submit(build_match_window, jobDatas[i], jobs[i][0], windowPath, segments)))
 
-                    # merge together match and scores
-                    final = concatenate_videoclips([seg_match, seg_score])
+    windows = [(min(segment[0] for segment in segments), max(segment[1] for segment in segments)) for match, segments in jobs]
+    missing, unread = renderBatch(user_data['video']['filePath'], windows, onWindow, 'output/scratch', stop_event)
 
-                    # save the results as a file
-                    final.write_videofile(outputFilename, audio_codec='aac')
-                
-                queue_send.put(match)
-                incrementCountText(QLabelCounter)
-                print("BUILT: "+match2str(match, user_data['event']['code']))
-            else:
-                print("NOT IN VIDEO: "+match2str(match, user_data['event']['code']))
-        
-        except queue.Empty:
+    for i in missing:
+        print("NOT IN VIDEO: "+match2str(jobs[i][0], user_data['event']['code']))
+        settle(jobs[i][0], 'skipped')
+
+    # the pass stopped before reaching these, resume builds them
+    for i in unread:
+        print("BUILD FAILED: "+match2str(jobs[i][0], user_data['event']['code'])+" was not reached by the batch pass")
+        settle(jobs[i][0], 'failed')
+
+    # the builds still running after the pass
+    while pending:
+        handOver(*pending.popleft())
+
+    releaseBuildPool()
+
+    timeBatch = time.perf_counter() - timeStart
+    if built:
+        print(f"BATCH: {len(built)} matches in {timeBatch:.1f}s ({3600*len(built)/timeBatch:.0f} matches/hour)")
+
+def logLatency(match:dict, matchString:str):
+    """
+    Records how long after its score was posted a match was sent, and prints the distribution so far
+
+    Args:
+        match (dict): match data dictionary
+        matchString (str): see match2str
+
+    """
+    latency = (datetime.datetime.now() - match['post']).total_seconds()
+    latencies.append(latency)
+
+    with open('log/latency.csv', 'a') as file:
+        file.write(f"{matchString},{latency:.1f}\n")
+
+    ordered = sorted(latencies)
+    print(f"LATENCY: {matchString} sent {latency:.0f}s after its score was posted (median {ordered[len(ordered)//2]:.0f}s, p90 {ordered[int(0.9*(len(ordered)-1))]:.0f}s, max {ordered[-1]:.0f}s over {len(ordered)} matches)")
+
+def process_queue_metadata(user_data, stop_event, YouTube_Session):
+    """
+    Sets thumbnails and playlist entries of uploaded videos, batching the videos that finished close together
+        * runs beside the send workers so the next upload does not wait on them
+        * the calls wait in the quota ledger, so none are lost on stop, and failed ones go back to it
+        * when idle, sends the calls deferred while quota was tight
+
+    Args:
+        user_data (dict): user inputs from FRUIT GUI
+        stop_event: (bool) or threading.Event(), used to stop processing
+        YouTube_Session
+
+    """
+    # calls deferred in the last run are tried right away
+    metadataReady.set()
+
+    while not stop_event.is_set():
+        # woken by the send workers (a video uploaded, or quota held for one given back), or at the quota reset for calls deferred while quota was tight
+        if metadataReady.wait(timeout=max((nextReset() - datetime.datetime.now()).total_seconds(), 1)):
+            # coalesce with the videos finishing right after
+            stop_event.wait(metadataWait)
+        metadataReady.clear()
+        if stop_event.is_set():
+            break
+
+        extrasList = []
+        while len(extrasList) < metadataBatch and quotaLedger.canAfford((len(extrasList)+1)*(thumbnailCost + playlistCost), reserve=queue_send.qsize()*uploadCost):
+            extras = quotaLedger.takeDeferred()
+            if extras is None:
+                break
+            extrasList.append(extras)
+        if not extrasList:
             continue
 
+        timeStart = time.perf_counter()
+        try:
+            failed = upload_extras_batch(YouTube_Session, extrasList, quotaLedger)
+        except Exception as errorText:
+            # keep the stage running, the whole batch is tried again after a backoff
+            print(f"METADATA FAILED: {errorText}")
+            failed = extrasList
+            stop_event.wait(30)
+            metadataReady.set()
+        for extras in failed:
+            quotaLedger.defer(extras, tight=False)
+        print(f"METADATA: {len(extrasList)-len(failed)} of {len(extrasList)} videos in {time.perf_counter()-timeStart:.1f}s")
+
 def process_queue_send(user_data, stop_event, QLabelCounter, YouTube_Session):
     """
-    Send video to YouTube and other services
+    Send video to YouTube and other services, run by several workers at once (see YouTube 'workers')
+        * the workers send the matches of every event, each with the CONFIG of its own event (see addPipeline)
+        * uploads wait for the quota reset once the day's quota is spent, failed ones are retried a minute later (see MatchQueue.requeue)
+        * thumbnail/playlist calls go to the metadata stage (see process_queue_metadata), or are deferred while quota is needed for the uploads waiting
 
     Args:
-        user_data (dict): user inputs from FRUIT GUI
+        user_data (dict): user inputs from FRUIT GUI, the quota and deadline are taken from it
         stop_event: (bool) or threading.Event(), used to stop processing
         QLabelCounter: PYQT QLabel() to update respective counter (by 1) in GUI
         YouTube_Session
 
     """
+    quotaLedger.dailyQuota = user_data['YouTube'].get('dailyQuota', 10000)
+    queue_send.deadlineSeconds = user_data['build'].get('deadline', 15*60)
+    queue_send.maxsize = user_data['build'].get('sendBacklog', sendBacklog)
+    wakeOnStop(stop_event)
+
     while not stop_event.is_set():
-        try:
-            match = queue_send.get(timeout=30)
-
-            matchString = match2str(match, user_data['event']['code'])
-
-            if YouTube_Session != None:
-                # generate match thumbnail
-                if user_data['program'] == 'FRC':
-                    programImagePath = './images/FIRSTRobotics_IconVert_RGB.png'
-                elif user_data['program'] == 'FTC':
-                    programImagePath = './images/FIRSTTech_IconVert_RGB.png'
-                
-                if user_data['event']['forceDetails']:
-                    thumbnailLoc = generateThumbnail(match, programImagePath, user_data['event']['details'], None)
-                elif user_data['event']['logoSponsor'] != None:
-                    thumbnailLoc = generateThumbnail(match, programImagePath, None, user_data['event']['logoSponsor'])
-                else:
-                    thumbnailLoc = generateThumbnail(match, programImagePath, user_data['event']['details'], None)
-
-                title = formatYouTubeTitle(match["id"], user_data['event']['name'], user_data['season']['year']) #FTC FMS doesn't report replay?
-                
-                request_body = {
-                    "snippet": {
-                        "title": title,
-                        "description": user_data['YouTube']['description'],
-                        "categoryId": "28",  # Category ID for "Science & Technology"
-                        "tags": user_data['YouTube']['tags'].split(',') + [user_data['event']['code'], str(user_data['season']['year']), match["id"], "FRUIT_BCC"] + [user_data['program'], {'FRC':'FIRST Robotics Competition', 'FTC':'FIRST Tech Challenge'}[user_data['program']]]
-                    },
-                    "status": {
-                        "privacyStatus": "unlisted"
-                    }
-                }
+        match = queue_send.take(stop_event)
+        if match is None:
+            continue
 
-                videoID = upload_video(YouTube_Session, 'output/'+matchString+'.mp4', request_body, thumbnailLoc, user_data['YouTube']['playlist'])
+        timeStart = time.perf_counter()
+        pipeline = pipelineOf(match)
+        eventData = pipeline['config']
+        matchString = match2str(match, match['event'])
+        jobLedger.transition(matchString, 'uploading')
 
-                if (user_data['program'] == 'FRC') and (user_data['TBA']['eventKey'] != ''):
-                    data = {translateMatchString(match['id']): videoID}
-                    postTheBlueAlliance(user_data['TBA']['Auth_Id'], user_data['TBA']['Auth_Secret'], user_data['TBA']['eventKey'], data)
+        if YouTube_Session != None:
+            # a match uploaded before a restart only needs its thumbnail/playlist and TBA
+            videoID = jobLedger.videoOf(matchString)
+
+            # hold the units of the upload before starting it (a resumed upload was charged when it started)
+            charged = (videoID is None) and not hasUploadSession('output/'+matchString+'.mp4')
+            if charged and not quotaLedger.reserve(uploadCost):
+                print(f"QUOTA: {quotaLedger.remaining()} left, {matchString} waits for the reset at {nextReset():%H:%M}")
+                queue_send.requeue(match, min(600, max((nextReset() - datetime.datetime.now()).total_seconds(), 1)))
+                continue
+
+            # generate match thumbnail
+            if eventData['program'] == 'FRC':
+                programImagePath = './images/FIRSTRobotics_IconVert_RGB.png'
+            elif eventData['program'] == 'FTC':
+                programImagePath = './images/FIRSTTech_IconVert_RGB.png'
             
-            with open('log/send.txt', 'a') as file:
-                file.write(matchString+"\n")
-            incrementCountText(QLabelCounter)
-            print("SENT: "+matchString)
+            if eventData['event']['forceDetails']:
+                thumbnailLoc = generateThumbnail(match, programImagePath, eventData['event']['details'], None, './output/thumbnails/'+matchString)
+            elif eventData['event']['logoSponsor'] != None:
+                thumbnailLoc = generateThumbnail(match, programImagePath, None, eventData['event']['logoSponsor'], './output/thumbnails/'+matchString)
+            else:
+                thumbnailLoc = generateThumbnail(match, programImagePath, eventData['event']['details'], None, './output/thumbnails/'+matchString)
+
+            title = formatYouTubeTitle(match["id"], eventData['event']['name'], eventData['season']['year']) #FTC FMS doesn't report replay?
+            
+            request_body = {
+                "snippet": {
+                    "title": title,
+                    "description": eventData['YouTube']['description'],
+                    "categoryId": "28",  # Category ID for "Science & Technology"
+                    "tags": eventData['YouTube']['tags'].split(',') + [eventData['event']['code'], str(eventData['season']['year']), match["id"], "FRUIT_BCC"] + [eventData['program'], {'FRC':'FIRST Robotics Competition', 'FTC':'FIRST Tech Challenge'}[eventData['program']]]
+                },
+                "status": {
+                    "privacyStatus": "unlisted"
+                }
+            }
+
+            if videoID is None:
+                try:
+                    videoID = upload_video(YouTube_Session, 'output/'+matchString+'.mp4', request_body, thumbnailLoc, eventData['YouTube']['playlist'], uplink, eventData['YouTube'].get('chunkMegabytes', 8), quotaLedger, False)
+                except (googleapiclient.errors.HttpError, OSError, httplib2.HttpLib2Error) as errorText:
+                    # try the match again later, out of quota it waits for the reset
+                    print(f"UPLOAD FAILED: {matchString} {errorText}")
+                    if isinstance(errorText, googleapiclient.errors.HttpError) and (errorText.resp.status == 403) and (b'quotaExceeded' in errorText.content):
+                        quotaLedger.exhaust()
+                    jobLedger.transition(matchString, 'built')
+                    queue_send.requeue(match, 60)
+                    continue
+                finally:
+                    if charged:
+                        quotaLedger.release(uploadCost)
+                    # quota given back may pay for deferred calls
+                    metadataReady.set()
+                jobLedger.transition(matchString, 'uploading', videoID=videoID)
+            else:
+                print(f"RESUME: {matchString} was uploaded as {videoID}, not uploading it again")
 
-        except queue.Empty:
-            continue
\ No newline at end of file
+            # thumbnail & playlist go to the metadata stage through the quota ledger, keeping quota for the uploads already waiting
+            # (a match uploaded before a restart may still have them waiting)
+            extras = {'videoID': videoID, 'thumbnail': thumbnailLoc, 'playlistID': eventData['YouTube']['playlist']}
+            if not quotaLedger.isDeferred(videoID):
+                if quotaLedger.canAfford(thumbnailCost + playlistCost, reserve=queue_send.qsize()*uploadCost):
+                    quotaLedger.defer(extras, tight=False)
+                    metadataReady.set()
+                else:
+                    quotaLedger.defer(extras)
+
+            if pipeline['publisher'] is not None:
+                pipeline['publisher'].add(translateMatchString(match['id']), videoID)
+                jobLedger.transition(matchString, 'uploading', tbaKey=translateMatchString(match['id']))
+        
+        incrementCountText(QLabelCounter)
+        sendSeconds.append(time.perf_counter() - timeStart)
+        settle(match, 'sent', sendSeconds=sendSeconds[-1])
+        ordered = sorted(sendSeconds)
+        print(f"SENT: {matchString} in {sendSeconds[-1]:.1f}s (median {ordered[len(ordered)//2]:.1f}s over {len(ordered)} matches)")
+        with open('log/sendstage.csv', 'a') as file:
+            file.write(f"{matchString},{sendSeconds[-1]:.1f}\n")
+        logLatency(match, matchString)
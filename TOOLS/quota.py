@@ -0,0 +1,219 @@
+"""
+YouTube Data API quota ledger
+    * the daily quota resets at midnight Pacific time, units spent are kept per Pacific day in log/quota.json across restarts
+    * thumbnail and playlist calls of uploaded videos wait in the same file for the metadata stage, and stay there while quota is tight
+    * projected exhaustion assumes the rest of the day spends at the rate so far
+    * uploads reserve their units before they start, so several send workers never start more uploads than the quota left allows
+"""
+
+import datetime     # quota day and projections
+import json         # ledger file
+import threading    # shared between the send workers
+import zoneinfo     # YouTube quota resets at midnight Pacific time
+
+from TOOLS.files import atomicWrite
+
+# quota cost of each call, see https://developers.google.com/youtube/v3/determine_quota_cost
+uploadCost = 1600
+thumbnailCost = 50
+playlistCost = 50
+
+pacific = zoneinfo.ZoneInfo('America/Los_Angeles')
+
+
+def quotaDay(now:datetime.datetime=None):
+    """
+    Pacific date the quota of a moment counts against
+
+    Args:
+        now (datetime.datetime): moment, defaults to now
+
+    Returns:
+        str: YYYY-MM-DD
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    return now.astimezone(pacific).date().isoformat()
+
+def nextReset():
+    """
+    Local (device) time the quota resets next
+    """
+    tomorrow = datetime.datetime.now(pacific).date() + datetime.timedelta(days=1)
+
+    return datetime.datetime.combine(tomorrow, datetime.time(), pacific).astimezone().replace(tzinfo=None)
+
+
+class QuotaLedger:
+    """
+    Quota units spent per Pacific day, and the extras (thumbnail, playlist) waiting for quota
+    """
+
+    def __init__(self, ledgerPath:str='log/quota.json', dailyQuota:int=10000):
+        self.ledgerPath = ledgerPath
+        self.dailyQuota = dailyQuota
+        self.lock = threading.Lock()
+        # units held by uploads in progress (this process only), see reserve
+        self.reserved = 0
+        # the current Pacific day and its entry in the file ({'spent', 'first'} or None), read again when the day rolls over
+        self.day = None
+        self.today = None
+
+    def current(self):
+        # today's entry, called with the lock held
+        if self.day != quotaDay():
+            self.day = quotaDay()
+            self.today = self.load()['days'].get(self.day)
+
+        return self.today
+
+    def load(self):
+        try:
+            with open(self.ledgerPath, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'days': {}, 'deferred': []}
+
+    def save(self, ledger:dict):
+        # a crash must not lose the day's spend
+        atomicWrite(self.ledgerPath, json.dumps(ledger, indent=2))
+
+    def spend(self, units:int, label:str):
+        """
+        Records quota spent
+
+        Args:
+            units (int): quota units
+            label (str): what it was spent on, for the printout
+
+        """
+        with self.lock:
+            self.current()
+            ledger = self.load()
+            day = ledger['days'].setdefault(self.day, {'spent': 0, 'first': datetime.datetime.now().isoformat()})
+            day['spent'] += units
+            self.save(ledger)
+            self.today = day
+
+        print(f"QUOTA: {units} for {label}, {self.remaining()} left today")
+
+    def spent(self):
+        with self.lock:
+            return (self.current() or {'spent': 0})['spent']
+
+    def remaining(self):
+        with self.lock:
+            return max(self.dailyQuota - (self.current() or {'spent': 0})['spent'] - self.reserved, 0)
+
+    def reserve(self, units:int):
+        """
+        Holds units for a call about to be made, if they are left
+
+        Args:
+            units (int): quota units
+
+        Returns:
+            bool: whether the units were reserved, release them once the call has spent them (or failed)
+        """
+        with self.lock:
+            if self.dailyQuota - (self.current() or {'spent': 0})['spent'] - self.reserved < units:
+                return False
+            self.reserved += units
+
+        return True
+
+    def release(self, units:int):
+        with self.lock:
+            self.reserved = max(self.reserved - units, 0)
+
+    def exhaust(self):
+        """
+        Marks today's quota as spent, after YouTube said so (quota spent elsewhere, e.g. other apps on the project)
+        """
+        with self.lock:
+            self.current()
+            ledger = self.load()
+            day = ledger['days'].setdefault(self.day, {'spent': 0, 'first': datetime.datetime.now().isoformat()})
+            day['spent'] = max(day['spent'], self.dailyQuota)
+            self.save(ledger)
+            self.today = day
+
+        print("QUOTA: YouTube reports the quota exceeded, waiting for the reset")
+
+    def canAfford(self, units:int, reserve:int=0):
+        """
+        Whether units can be spent today while keeping reserve units
+
+        Args:
+            units (int): quota units to spend
+            reserve (int): quota units to keep for later calls
+
+        Returns:
+            bool
+        """
+        return self.remaining() >= units + reserve
+
+    def projectedExhaustion(self):
+        """
+        Local time today's quota runs out at today's rate of spending
+
+        Returns:
+            datetime.datetime: None if nothing was spent yet or it lasts until the reset
+        """
+        with self.lock:
+            day = self.current()
+
+        if day is None or day['spent'] == 0:
+            return None
+
+        elapsed = (datetime.datetime.now() - datetime.datetime.fromisoformat(day['first'])).total_seconds()
+        if elapsed <= 0:
+            return None
+
+        exhaustion = datetime.datetime.now() + datetime.timedelta(seconds=max(self.dailyQuota - day['spent'], 0) * elapsed / day['spent'])
+
+        return exhaustion if exhaustion < nextReset() else None
+
+    def defer(self, extras:dict, tight:bool=True):
+        """
+        Keeps the thumbnail/playlist calls of an uploaded video until they are made, across restarts
+
+        Args:
+            extras (dict): {'videoID': str, 'thumbnail': path or None, 'playlistID': str}
+            tight (bool): kept because quota is tight (printed)
+
+        """
+        with self.lock:
+            ledger = self.load()
+            ledger['deferred'].append(extras)
+            self.save(ledger)
+
+        if tight:
+            print(f"QUOTA: tight, thumbnail/playlist of {extras['videoID']} deferred")
+
+    def isDeferred(self, videoID:str):
+        """
+        Whether calls of an uploaded video are still waiting for the metadata stage
+
+        Args:
+            videoID (str): YouTube video ID
+
+        Returns:
+            bool
+        """
+        with self.lock:
+            return any(extras['videoID'] == videoID for extras in self.load()['deferred'])
+
+    def takeDeferred(self):
+        """
+        Removes and returns the oldest deferred extras, None if there are none
+        """
+        with self.lock:
+            ledger = self.load()
+            if not ledger['deferred']:
+                return None
+            extras = ledger['deferred'].pop(0)
+            self.save(ledger)
+
+        return extras
@@ -0,0 +1,115 @@
+"""
+Disk-backed LRU cache of downloaded Twitch VOD segments
+    * keyed by (VOD id, segment index), one file per segment so build workers in other processes share it
+    * recency and size are kept in memory, the directory is only scanned when the cache is opened
+    * each build worker process opens its own (workers are recycled every few matches), the file modification time
+      is touched on every hit so a new scan finds the recency the other workers saw
+    * the least recently used segments are evicted once the cache is over its size cap
+"""
+
+import collections  # LRU order
+import os           # file IO
+import threading    # sharing the cache between download threads
+
+from TOOLS.files import atomicWrite
+
+
+class SegmentCache:
+    """
+    Cache of VOD segments on disk, capped at maxBytes
+    """
+
+    def __init__(self, cacheDir:str, maxBytes:int):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+
+        # path: bytes, least recently used first
+        self.index = collections.OrderedDict()
+        self.totalBytes = 0
+        self.scan()
+
+    def scan(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cacheDir):
+            for name in files:
+                if name.endswith('.seg'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        for mtime, size, path in sorted(entries):
+            self.index[path] = size
+        self.totalBytes = sum(self.index.values())
+
+    def touch(self, path:str, size:int):
+        # most recently used, with its (new) size
+        self.totalBytes += size - self.index.pop(path, 0)
+        self.index[path] = size
+
+    def segmentPath(self, vod_id:int, index):
+        return os.path.join(self.cacheDir, str(vod_id), f"{index}.seg")
+
+    def get(self, vod_id:int, index):
+        """
+        Cached segment, None on a miss
+
+        Args:
+            vod_id (int): twitch VOD ID
+            index: position of the segment in the VOD playlist ('init' for the fMP4 header)
+
+        Returns:
+            bytes or None
+        """
+        path = self.segmentPath(vod_id, index)
+
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            os.utime(path)
+        except OSError:
+            # never cached, or evicted by another worker
+            with self.lock:
+                self.totalBytes -= self.index.pop(path, 0)
+            return None
+
+        with self.lock:
+            self.touch(path, len(content))
+
+        return content
+
+    def put(self, vod_id:int, index, content:bytes):
+        """
+        Stores a segment, then evicts the least recently used segments if over the cap
+
+        Args:
+            vod_id (int): twitch VOD ID
+            index: position of the segment in the VOD playlist ('init' for the fMP4 header)
+            content (bytes): the segment
+
+        """
+        path = self.segmentPath(vod_id, index)
+
+        # other workers may be reading it
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomicWrite(path, content)
+        except OSError as errorText:
+            print(f"unable to cache segment {index} of VOD {vod_id}: {errorText}")
+            return
+
+        with self.lock:
+            self.touch(path, len(content))
+            self.evict()
+
+    def evict(self):
+        # least recently used first, called with the lock held
+        while (self.totalBytes > self.maxBytes) and self.index:
+            path, size = self.index.popitem(last=False)
+            self.totalBytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
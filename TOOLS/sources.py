@@ -0,0 +1,194 @@
+import json         # sidecar handling
+import os           # file IO
+import re           # parsing ffmpeg output
+import subprocess   # running ffmpeg
+import threading    # sharing readers between threads
+
+from moviepy.config import get_setting
+from moviepy.editor import VideoFileClip
+
+from TOOLS.files import atomicWrite
+
+# use the same ffmpeg binary as moviepy (imageio-ffmpeg ships one on venue laptops)
+FFMPEG_BINARY = get_setting('FFMPEG_BINARY')
+
+# readers opened by this process, see openSource
+openReaders = {}
+openReadersLock = threading.Lock()
+
+
+def runFFMPEG(arguments:list):
+    """
+    Runs ffmpeg quietly, raising if it fails
+
+    Args:
+        arguments (list): ffmpeg arguments (without the binary)
+
+    Returns:
+        str: stdout of ffmpeg
+
+    Raises:
+        ValueError: ffmpeg exited with an error
+    """
+    result = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-nostdin', '-v', 'error', '-y'] + arguments, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise ValueError(f"ffmpeg failed: {result.stderr.strip()[-500:]}")
+
+    return result.stdout
+
+
+def probeSource(filePath:str):
+    """
+    Reads container information about a video without decoding it
+
+    Args:
+        filePath (str): path to video file
+
+    Returns:
+        dict: {'duration': float, 'start': float, 'fps': float, 'videoCodec': str,
+               'profile': str, 'pixFmt': str, 'level': int (level_idc), 'timescale': int}, the last four None if not reported
+    """
+    # ffmpeg prints the stream information to stderr when no output is given
+    result = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-nostdin', '-i', filePath], capture_output=True, text=True)
+
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+\.\d+), start: (-?\d+\.\d+)", result.stderr)
+    video = re.search(r"Stream #\d+:\d+.*?: Video: (\w+).*?, ([\d.]+) fps", result.stderr)
+
+    if duration is None or video is None:
+        raise ValueError(f"unable to read video information from {filePath}")
+
+    # e.g. Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, bt709, progressive), 1920x1080 [SAR 1:1 DAR 16:9], 6000 kb/s, 30 fps, 30 tbr, 90k tbn
+    line = re.search(r"Stream #\d+:\d+.*?: Video: (.*)", result.stderr).group(1)
+    profile = re.match(r"\w+ \(([^)/]+)\)", line)
+    pixFmt = re.search(r"\), (\w+)[(,]|^\w+, (\w+)[(,]", line)
+    timescale = re.search(r"([\d.]+)(k?) tbn", line)
+
+    # the level is only in the bitstream, read from the headers of the first frame
+    trace = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-nostdin', '-v', 'verbose', '-i', filePath, '-map', '0:v:0', '-c', 'copy', '-bsf:v', 'trace_headers', '-frames:v', '1', '-f', 'null', '-'], capture_output=True, text=True)
+    level = re.search(r"level_idc\s+[01]+ = (\d+)", trace.stderr)
+
+    return {'duration': int(duration.group(1))*3600 + int(duration.group(2))*60 + float(duration.group(3)),
+            'start': float(duration.group(4)),
+            'fps': float(video.group(2)),
+            'videoCodec': video.group(1),
+            'profile': profile.group(1) if profile else None,
+            'pixFmt': (pixFmt.group(1) or pixFmt.group(2)) if pixFmt else None,
+            'level': int(level.group(1)) if level else None,
+            'timescale': round(float(timescale.group(1))*(1000 if timescale.group(2) else 1)) if timescale else None}
+
+
+class SourceReader:
+    """
+    Long-lived reader of a source video, opened once per build worker
+        * probe results are kept in a sidecar (<video>.fruit) and keyframes in an index (<video>.kfi) so restarts are instant
+        * the moviepy clip is opened on first use and shared, hold the lock while using it
+    """
+
+    def __init__(self, filePath:str):
+        self.filePath = filePath
+        self.sidecarPath = filePath+'.fruit'
+        self.lock = threading.Lock()
+        self._clip = None
+        self._index = None
+
+        stat = os.stat(filePath)
+        self.signature = [stat.st_size, stat.st_mtime]
+
+        # reuse the sidecar if it describes this exact file
+        self.sidecar = {}
+        try:
+            with open(self.sidecarPath, 'r') as file:
+                sidecar = json.load(file)
+            if sidecar['signature'] == self.signature:
+                self.sidecar = sidecar
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # sidecars from before the stream settings were probed are read again
+        if not ('info' in self.sidecar) or not ('pixFmt' in self.sidecar['info']):
+            self.sidecar = {'signature': self.signature, 'info': probeSource(filePath)}
+            self.saveSidecar()
+
+        self.info = self.sidecar['info']
+
+    def saveSidecar(self):
+        # other workers may be reading (or writing) it
+        try:
+            atomicWrite(self.sidecarPath, json.dumps(self.sidecar))
+        except OSError as errorText:
+            print(f"unable to save {self.sidecarPath}: {errorText}")
+
+    @property
+    def index(self):
+        with self.lock:
+            if self._index is None:
+                # imported here, keyframes takes FFMPEG_BINARY from this module
+                from TOOLS.keyframes import loadKeyframeIndex
+                self._index = loadKeyframeIndex(self.filePath, self.info['start'])
+
+        return self._index
+
+    def keyframesBetween(self, startSeconds:float, endSeconds:float):
+        """
+        Keyframe times within [startSeconds, endSeconds]
+        """
+        return self.index.between(startSeconds, endSeconds)
+
+    @property
+    def clip(self):
+        if self._clip is None:
+            self._clip = VideoFileClip(self.filePath)
+
+        return self._clip
+
+    def isCurrent(self):
+        try:
+            stat = os.stat(self.filePath)
+        except OSError:
+            return False
+
+        return [stat.st_size, stat.st_mtime] == self.signature
+
+    def close(self):
+        with self.lock:
+            if self._clip is not None:
+                self._clip.close()
+                self._clip = None
+
+
+def openSource(filePath:str):
+    """
+    Returns this process' reader for a video, reopening it if the file has changed
+
+    Args:
+        filePath (str): path to video file
+
+    Returns:
+        SourceReader
+    """
+    with openReadersLock:
+        reader = openReaders.get(filePath)
+
+        if (reader is None) or not reader.isCurrent():
+            if reader is not None:
+                reader.close()
+            reader = SourceReader(filePath)
+            openReaders[filePath] = reader
+
+    return reader
+
+
+def closeSource(filePath:str):
+    """
+    Closes this process' reader for a video (needed before the file can be replaced on Windows)
+
+    Args:
+        filePath (str): path to video file
+
+    """
+    with openReadersLock:
+        reader = openReaders.pop(filePath, None)
+
+    if reader is not None:
+        reader.close()
@@ -0,0 +1,73 @@
+"""
+Uplink-aware bitrate targeting
+    * every YouTube upload reports its size and duration, the recent ones give the achieved throughput
+    * builds pick a video bitrate so the upload of a match fits in the upload budget (seconds per match)
+"""
+
+import threading    # shared between the send and build threads
+
+# uploads the throughput is measured over
+recentUploads = 5
+
+# share of the measured throughput to plan with (the livestream shares the uplink)
+headroom = 0.8
+
+# audio is encoded separately at about this rate (bits/second)
+audioBitrate = 128000
+
+# never go below or above these video bitrates (bits/second)
+minimumBitrate = 500000
+maximumBitrate = 12000000
+
+
+class UplinkMonitor:
+    """
+    Upload throughput of the last few uploads, and the bitrate that keeps uploads within budget
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.lock = threading.Lock()
+
+    def record(self, uploadBytes:int, seconds:float):
+        """
+        Adds a finished upload
+
+        Args:
+            uploadBytes (int): size of the uploaded file
+            seconds (float): time the upload took
+
+        """
+        with self.lock:
+            self.uploads = (self.uploads + [(uploadBytes, seconds)])[-recentUploads:]
+
+        print(f"UPLINK: {8*uploadBytes/seconds/1e6:.1f} Mbit/s this upload, {8*self.throughput()/1e6:.1f} Mbit/s recently")
+
+    def throughput(self):
+        """
+        Bytes/second over the recent uploads, None before the first upload
+        """
+        with self.lock:
+            if not self.uploads:
+                return None
+
+            return sum(upload[0] for upload in self.uploads) / sum(upload[1] for upload in self.uploads)
+
+    def targetBitrate(self, videoSeconds:float, budgetSeconds:float):
+        """
+        Video bitrate for a match so its upload takes at most budgetSeconds
+
+        Args:
+            videoSeconds (float): duration of the match video
+            budgetSeconds (float): upload time allowed per match
+
+        Returns:
+            int: bits/second, None before the first upload (keep the profile's quality setting)
+        """
+        throughput = self.throughput()
+        if throughput is None:
+            return None
+
+        bitrate = 8*throughput*headroom*budgetSeconds/videoSeconds - audioBitrate
+
+        return int(min(max(bitrate, minimumBitrate), maximumBitrate))